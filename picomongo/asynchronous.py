@@ -0,0 +1,239 @@
+'''Asynchronous module, use asynchronous.AsyncDocument for documents whose
+database methods can return futures instead of blocking.
+
+Calls are run by a pool of threads, sized by the 'async_workers' default
+configuration (see ConnectionManager.configure). Futures are
+concurrent.futures ones, provided on python 2 by the 'futures' package:
+they can be waited for, given callbacks, or yielded by coroutines of
+frameworks supporting them (tornado for example).
+'''
+
+import threading
+
+from collections import deque
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = ThreadPoolExecutor = None
+
+from connection_manager import ConnectionManager
+from document import Document
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    '''Return the executor running asynchronous calls, it is replaced when
+    the configured number of workers changes.
+    '''
+    global _executor, _executor_workers
+
+    workers = ConnectionManager.async_workers
+    if _executor is None or _executor_workers != workers:
+        with _executor_lock:
+            if _executor is None or _executor_workers != workers:
+                if ThreadPoolExecutor is None:
+                    raise ImportError('The futures package is needed to use '
+                                      'asynchronous documents.')
+                if _executor is not None:
+                    _executor.shutdown(wait=False)
+                _executor = ThreadPoolExecutor(workers)
+                _executor_workers = workers
+    return _executor
+
+def run_async(func, *args, **kwargs):
+    '''Run func in the asynchronous pool, return its future.
+    '''
+    return get_executor().submit(func, *args, **kwargs)
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _then(previous, func):
+    '''Run func in the asynchronous pool once the previous future is done
+    (now if it is None), return the future of func.
+    '''
+    future = Future()
+
+    def done(call):
+        error = call.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(call.result())
+
+    def start(_=None):
+        try:
+            run_async(func).add_done_callback(done)
+        except Exception as error:
+            future.set_exception(error)
+
+    if previous is None:
+        start()
+    else:
+        previous.add_done_callback(start)
+    return future
+
+class AsyncCursor(object):
+    '''Asynchronous version of a DocumentCursor.
+
+    Modifiers (limit, sort, ...) are chainable as for DocumentCursor, results
+    are read by batches in the asynchronous pool, one read after the other:
+    a fetch_next, to_list or close waits for the previous ones. Example:
+    >>> cursor = UserDocument.find_async({'name': 'Mike'})
+    >>> while (yield cursor.fetch_next):
+    ...     user = cursor.next_object()
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+        self._batches = None
+        self._buffer = deque()
+        self._exhausted = False
+
+        #Future of the last read, reads are chained to run one at a time
+        self._last_read = None
+        self._lock = threading.Lock()
+
+    def _read(self, func):
+        with self._lock:
+            self._last_read = _then(self._last_read, func)
+            return self._last_read
+
+    def _fetch(self):
+        if self._batches is None:
+            self._batches = self.cursor.batches()
+        while not self._buffer:
+            batch = next(self._batches, None)
+            if batch is None:
+                self._exhausted = True
+                return False
+            self._buffer.extend(batch)
+        return True
+
+    @property
+    def fetch_next(self):
+        '''Future of True when a document can be got with next_object, of
+        False when there are no more documents.
+        '''
+        if self._buffer or self._exhausted:
+            return _completed(bool(self._buffer))
+        return self._read(self._fetch)
+
+    def next_object(self):
+        '''Return the next document fetched by fetch_next, None if there is
+        none.
+        '''
+        return self._buffer.popleft() if self._buffer else None
+
+    def to_list(self, length=None):
+        '''Future of the list of the (next length) documents.
+        '''
+        def read():
+            documents = []
+            while length is None or len(documents) < length:
+                if not self._fetch():
+                    break
+                while self._buffer and (length is None or
+                                        len(documents) < length):
+                    documents.append(self._buffer.popleft())
+            return documents
+        return self._read(read)
+
+    def count(self, with_limit_and_skip=False):
+        '''Future of the number of documents, see Cursor.count.
+        '''
+        return run_async(self.cursor.count, with_limit_and_skip)
+
+    def close(self):
+        '''Future of the closing of the cursor.
+        '''
+        return self._read(self.cursor.close)
+
+    def limit(self, limit):
+        self.cursor.limit(limit)
+        return self
+
+    def skip(self, skip):
+        self.cursor.skip(skip)
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self.cursor.sort(key_or_list, direction)
+        return self
+
+    def hint(self, index):
+        self.cursor.hint(index)
+        return self
+
+    def batch_size(self, batch_size):
+        self.cursor.batch_size(batch_size)
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self.cursor.max_time_ms(max_time_ms)
+        return self
+
+    def comment(self, comment):
+        self.cursor.comment(comment)
+        return self
+
+class AsyncDocument(Document):
+    '''Document with asynchronous versions of its database methods, named
+    with an _async suffix and returning futures.
+
+    Documents, configurations and collections are resolved as for Document,
+    so synchronous methods stay available. Calls run in other threads, they
+    are not part of the caller session (see session.Session).
+
+    Example:
+    >>> class UserDocument(AsyncDocument):
+    ...     pass
+    >>> user = yield UserDocument.find_one_async({'name': 'Mike'})
+    >>> user.views += 1
+    >>> yield user.save_async()
+    '''
+
+    @classmethod
+    def find_one_async(cls, *args, **kwargs):
+        '''Future of Document.find_one.
+        '''
+        return run_async(cls.find_one, *args, **kwargs)
+
+    @classmethod
+    def find_async(cls, *args, **kwargs):
+        '''Return an AsyncCursor on the results of Document.find.
+        '''
+        return AsyncCursor(cls.find(*args, **kwargs))
+
+    @classmethod
+    def get_many_async(cls, ids, **kwargs):
+        '''Future of Document.get_many.
+        '''
+        return run_async(cls.get_many, ids, **kwargs)
+
+    @classmethod
+    def paginate_async(cls, *args, **kwargs):
+        '''Future of Document.paginate.
+        '''
+        return run_async(cls.paginate, *args, **kwargs)
+
+    def save_async(self, *args, **kwargs):
+        '''Future of Document.save.
+        '''
+        return run_async(self.save, *args, **kwargs)
+
+    def delete_async(self, *args, **kwargs):
+        '''Future of Document.delete.
+        '''
+        return run_async(self.delete, *args, **kwargs)
+
+    def reload_async(self):
+        '''Future of Document.reload.
+        '''
+        return run_async(self.reload)
@@ -0,0 +1,90 @@
+'''Document cache module, use cache.DocumentCache to keep documents in memory
+by _id.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from bson import BSON
+
+class DocumentCache(object):
+    '''Least recently used cache of documents, by _id.
+
+    Documents are stored encoded as BSON: cached values can not be modified
+    by callers and their size is known. Entries expire ttl seconds after being
+    stored (if ttl is given), and least recently used entries are evicted
+    when there are more than max_entries entries or, if given, when their
+    total size exceeds max_bytes.
+    '''
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        #_id -> (expiration time, BSON data)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, _id):
+        '''Return a copy of the cached document, None if not cached.
+        '''
+        with self._lock:
+            entry = self._entries.pop(_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expiration, data = entry
+            if expiration is not None and expiration < time.time():
+                self._bytes -= len(data)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries[_id] = entry
+            self.hits += 1
+        return BSON(data).decode()
+
+    def set(self, document):
+        '''Cache a document, it must have an _id.
+        '''
+        data = BSON.encode(document)
+        expiration = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            previous = self._entries.pop(document['_id'], None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            self._entries[document['_id']] = (expiration, data)
+            self._bytes += len(data)
+
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, _id):
+        with self._lock:
+            entry = self._entries.pop(_id, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations,
+                'entries': len(self._entries), 'bytes': self._bytes}
@@ -2,32 +2,180 @@
 access a shared state ConnectionManager.
 '''
 
-from collections import namedtuple
+import os
+import threading
+import time
+
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 from pymongo import Connection
 from pymongo import ReplicaSetConnection
+from pymongo import uri_parser
 from pymongo.read_preferences import ReadPreference
 
 from exceptions import NotConfiguredYet
+from memory import MemoryConnection, is_memory_uri
+
+#Configuration keys setting how databases and collections are read
+READ_OPTIONS = ('read_preference', 'tag_sets',
+                'secondary_acceptable_latency_ms')
+
+def parse_read_preference(read_preference):
+    '''Return a ReadPreference given its name ('secondary_preferred' for
+    example) or itself.
+    '''
+    if isinstance(read_preference, basestring):
+        try:
+            return getattr(ReadPreference, read_preference.upper())
+        except AttributeError:
+            raise ValueError('Unknown read preference: %r' % read_preference)
+    return read_preference
+
+def _open_connection(connection_uri, options):
+    if is_memory_uri(connection_uri):
+        con = MemoryConnection(connection_uri, **options)
+    elif 'replicaSet=' in connection_uri:
+        con = ReplicaSetConnection(connection_uri, read_preference=ReadPreference.PRIMARY_PREFERRED, **options)
+    else:
+        con = Connection(connection_uri, **options)
+    return con
+
+class _ConnectionHandle(object):
+    '''Shared connection to a uri, opened on first access.
+    '''
+
+    def __init__(self, connection_uri, options):
+        self.uri = connection_uri
+        self.options = options
+
+        self.connection = None
+        #Time spent opening the connection, in seconds
+        self.open_time = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''Return the connection, open it if needed.
+        '''
+        if self.connection is None:
+            with self._lock:
+                if self.connection is None:
+                    start = time.time()
+                    self.connection = _open_connection(self.uri, self.options)
+                    self.open_time = time.time() - start
+        return self.connection
+
+class Config(object):
+    '''Configuration of a document: connection, database and collection.
+
+    Nothing is opened until con, db or col is accessed.
+    '''
+
+    def __init__(self, handle, db_name, col_name=None, cache=None,
+                 read_options=None, write_behind=None, slow_log=None):
+        self._handle = handle
+        self.db_name = db_name
+        self.col_name = col_name
+        #DocumentCache options, None if documents are not cached
+        self.cache = cache
+        #Read preference, tag sets, ... set on the database
+        self.read_options = read_options or {}
+        #WriteBehindBuffer options, None if documents are saved directly
+        self.write_behind = write_behind
+        #SlowLog options, None if slow operations are not logged
+        self.slow_log = slow_log
+
+        self._db = None
+        self._col = None
 
-CONFIG = namedtuple('Config', ['con', 'db', 'col'])
+    @property
+    def con(self):
+        return self._handle.get()
+
+    @property
+    def db(self):
+        if self._db is None:
+            db = self.con[self.db_name]
+            for name, value in self.read_options.iteritems():
+                setattr(db, name, value)
+            self._db = db
+        return self._db
+
+    @property
+    def col(self):
+        if self._col is None and self.col_name:
+            self._col = self.db[self.col_name]
+        return self._col
+
+CONFIG = Config
 
 class _ConnectionManager(object):
     '''Manage connection configuration (connection uri, database and collection for document classes).
 
     It use default host/port (localhost on 27017) if no uri is specified.
     It use default database (test) if no database is specified.
+
+    Connections are shared: all configurations using the same connection uri
+    (once normalized) use the same pymongo connection and thus the same
+    socket pool, sized with the largest max_pool_size of these
+    configurations.
+
+    Connections no more used after a reconfiguration are not disconnected,
+    as other threads may still be using them, they are closed when garbage
+    collected.
+
+    When configured with lazy=True, connections are only opened when a
+    configuration con, db or col is first accessed.
+
+    Configurations are read without locking: they are replaced, never
+    modified. Connections are not shared with forked processes: when the
+    process changes, the last configuration is applied again, lazily, so
+    each process opens its own connections on first use.
     '''
 
     def __init__(self):
         #Existing configurations
         self._configurations = {}
+        #Last configure arguments, applied again after a fork
+        self._config = None
+        self._pid = os.getpid()
+        #Replaced in a forked child by the threading module, so that a fork
+        #is detected without calling os.getpid() on each resolution
+        self._fork_marker = threading._active_limbo_lock
+        #Held while configurations are replaced
+        self._lock = threading.RLock()
+        #pid -> lock serializing reset_after_fork in this process
+        self._reset_locks = {}
+
+        #Shared connections, indexed by normalized uri
+        self._connections = {}
+        self._released_connections = {}
+        #Connection options, indexed by normalized uri
+        self._uri_options = {}
+        self._lazy = False
+
+        self._generation = 0
+        #True if a document configuration enables the slow log
+        self.slow_log_configured = False
 
         #Default config
         self._default_con_uri = 'mongodb://localhost'
         self._default_db_name = 'test'
+        self._default_options = {}
+        self._default_read_options = {}
+        #Threads running asynchronous.AsyncDocument calls
+        self.async_workers = 10
+
+    @property
+    def generation(self):
+        '''Incremented on each configuration (and after a fork), used to
+        invalidate resolution caches.
+        '''
+        if threading._active_limbo_lock is not self._fork_marker:
+            self._check_fork()
+        return self._generation
 
-    def configure(self, config = None):
+    def configure(self, config = None, lazy=False):
         '''Configure the connection manager.
 
         Take configuration as:
@@ -36,8 +184,33 @@ class _ConnectionManager(object):
          'document_name2': *
         }
 
+        Each configuration may also set 'max_pool_size', the maximum number
+        of sockets opened by the connection to its uri. Configurations using
+        the same uri share its connection, the largest max_pool_size is used.
+
+        Each configuration may also set how its documents are read, by
+        default: 'read_preference' (a pymongo ReadPreference or its name, as
+        'secondary_preferred'), 'tag_sets' and
+        'secondary_acceptable_latency_ms'.
+
+        The default configuration may set 'async_workers', the number of
+        threads running asynchronous.AsyncDocument calls.
+
+        Document configurations may set 'cache' to cache documents got by _id
+        with find_one, its value is a dict of cache.DocumentCache arguments,
+        for example: {'max_entries': 1000, 'max_bytes': 2 ** 20, 'ttl': 60}
+
+        Document configurations may set 'write_behind' to save documents in
+        background, its value is a dict of writebehind.WriteBehindBuffer
+        arguments, for example: {'batch_size': 500, 'max_delay': 1}
+
+        Document configurations may set 'slow_log' to log slow find and
+        find_one calls, its value is a dict of slowlog.SlowLog arguments, for
+        example: {'slow_ms': 100, 'explain': True}
+
         Uri must be a valid mongodb connection uri as described in this doc
         page: http://www.mongodb.org/display/DOCS/Connections
+        or 'memory://' to use the in memory backend (see memory module).
 
         Rules:
         * In default configuration:
@@ -47,33 +220,144 @@ class _ConnectionManager(object):
           * If uri is not present, use default uri
           * If db is not present, use default db
           * If col is not preset, use document class name
+          * If max_pool_size is not present, use default max_pool_size
+          * If read options are not present, use default ones
+
+        If lazy is True, connections are not opened during configuration but
+        on first use, see warmup to open them all at once. Configuring with
+        lazy=True before forking (with a preloading server for example)
+        avoids opening connections in the parent process.
         '''
         if config == None:
             config = {}
 
-        self._configurations = {}
-        default = config.copy().pop('_default_', {})
+        if threading._active_limbo_lock is not self._fork_marker:
+            self._check_fork()
+        with self._lock:
+            self._configure(deepcopy(config), lazy)
+
+    def _configure(self, config, lazy):
+        self._config = config
+        self._lazy = lazy
+        self._released_connections = self._connections
+        self._connections = {}
+
+        config = config.copy()
+        default = config.pop('_default_', {})
+        configurations = {}
 
         #Default
         self._default_con_uri = default.get('uri', self._default_con_uri)
-        con = self._get_connection(self._default_con_uri)
+        self._default_options = self._connection_options(default)
+        self._uri_options = self._gen_uri_options(default, config.values())
+        handle = self._get_connection(self._default_con_uri)
 
         self._default_db_name = default.get('db', self._default_db_name)
-        db = con[self._default_db_name]
+        self._default_read_options = self._read_options(default)
+        self.async_workers = default.get('async_workers', self.async_workers)
 
-        self._configurations['_default_'] = CONFIG(con, db, None)
+        configurations['_default_'] = Config(
+            handle, self._default_db_name,
+            read_options=self._default_read_options)
 
         #Gen others
         for name, document_config in config.iteritems():
-            self._gen_config(name, document_config)
+            configurations[name] = self._gen_config(name, document_config)
+
+        self._configurations = configurations
+        self.slow_log_configured = any(
+            document_config.get('slow_log') is not None
+            for document_config in config.itervalues())
+        self._generation += 1
+
+        #Connections no more used are left to the garbage collector
+        self._released_connections = {}
 
     @staticmethod
-    def _get_connection(connection_uri):
-        if 'replicaSet=' in connection_uri:
-            con = ReplicaSetConnection(connection_uri, read_preference=ReadPreference.PRIMARY_PREFERRED)
-        else:
-            con = Connection(connection_uri)
-        return con
+    def _connection_options(config, default=None):
+        options = dict(default or {})
+        if 'max_pool_size' in config:
+            options['max_pool_size'] = config['max_pool_size']
+        return options
+
+    def _gen_uri_options(self, default, document_configs):
+        '''Return connection options indexed by normalized uri, merged from
+        all the configurations using this uri.
+        '''
+        uri_options = {}
+        for config in [default] + list(document_configs):
+            key = self._connection_key(config.get('uri',
+                                                  self._default_con_uri))
+            options = self._connection_options(config, self._default_options)
+            merged = uri_options.setdefault(key, {})
+            if 'max_pool_size' in options:
+                merged['max_pool_size'] = max(merged.get('max_pool_size', 0),
+                                              options['max_pool_size'])
+        return uri_options
+
+    @staticmethod
+    def _read_options(config, default=None):
+        options = dict(default or {})
+        for name in READ_OPTIONS:
+            if name in config:
+                options[name] = config[name]
+        if 'read_preference' in options:
+            options['read_preference'] = \
+                parse_read_preference(options['read_preference'])
+        return options
+
+    @staticmethod
+    def _connection_key(connection_uri):
+        '''Normalize a connection uri, two equivalent uris (hosts order,
+        options order, ...) give the same key.
+        '''
+        if is_memory_uri(connection_uri):
+            return connection_uri.rstrip('/')
+        parsed = uri_parser.parse_uri(connection_uri)
+        uri_options = sorted((name.lower(), value) for name, value
+                             in parsed['options'].iteritems())
+        return (tuple(sorted(parsed['nodelist'])), parsed['username'],
+                parsed['password'], parsed['database'], tuple(uri_options))
+
+    def _get_connection(self, connection_uri):
+        '''Return the shared connection handle for this uri, open it unless
+        the connection manager is lazy.
+        '''
+        key = self._connection_key(connection_uri)
+
+        handle = self._connections.get(key)
+        if handle is None:
+            options = self._uri_options.get(key, {})
+            handle = self._released_connections.pop(key, None)
+            if handle is None or handle.options != options:
+                handle = _ConnectionHandle(connection_uri, options)
+            self._connections[key] = handle
+        if not self._lazy:
+            handle.get()
+        return handle
+
+    def get_connections(self):
+        '''Return the list of distinct connections currently opened.
+        '''
+        return [handle.connection for handle in self._connections.values()
+                if handle.connection is not None]
+
+    def warmup(self, workers=None):
+        '''Open all configured connections concurrently.
+
+        Return a dict giving for each connection uri the time spent opening
+        its connection, in seconds.
+        '''
+        handles = self._connections.values()
+        pending = [handle for handle in handles if handle.connection is None]
+        if pending:
+            pool = ThreadPool(workers or len(pending))
+            try:
+                pool.map(_ConnectionHandle.get, pending)
+            finally:
+                pool.close()
+                pool.join()
+        return dict((handle.uri, handle.open_time) for handle in handles)
 
     def _gen_config(self, name, config=None):
         """Gen a config for a specified document name, use default values if
@@ -82,17 +366,68 @@ class _ConnectionManager(object):
         if config == None:
             config = {}
 
-        connection = self._get_connection(config.get('uri', self._default_con_uri))
-        db = connection[config.get('db', self._default_db_name)]
-        col = db[config.get('col')] if config.get('col') else None
-        self._configurations[name] = CONFIG(connection, db, col)
+        handle = self._get_connection(config.get('uri', self._default_con_uri))
+        return Config(handle,
+                      config.get('db', self._default_db_name),
+                      config.get('col'),
+                      config.get('cache'),
+                      self._read_options(config, self._default_read_options),
+                      config.get('write_behind'),
+                      config.get('slow_log'))
 
     def get_config(self, document_name):
-        if not self._configurations:
+        if threading._active_limbo_lock is not self._fork_marker:
+            self._check_fork()
+
+        configurations = self._configurations
+        config = configurations.get(document_name)
+        if config is not None:
+            return config
+        if not configurations:
             exc_msg = 'The connection manager has not yet been configured.'
             raise NotConfiguredYet(exc_msg)
-        if not document_name in self._configurations:
-            self._gen_config(document_name)
-        return self._configurations[document_name]
+
+        with self._lock:
+            configurations = self._configurations
+            config = configurations.get(document_name)
+            if config is None:
+                config = self._gen_config(document_name)
+                configurations = dict(configurations)
+                configurations[document_name] = config
+                self._configurations = configurations
+        return config
+
+    def _check_fork(self):
+        '''Reset after a fork if the process changed, see reset_after_fork.
+        '''
+        if self._pid != os.getpid():
+            self.reset_after_fork()
+        else:
+            self._fork_marker = threading._active_limbo_lock
+
+    def reset_after_fork(self):
+        '''Forget connections inherited from the parent process and apply the
+        last configuration again, lazily: connections of this process are
+        opened on first use.
+
+        It is called when a process change is detected, and can be called
+        by a post fork hook. It does nothing if it already ran in this
+        process.
+        '''
+        pid = os.getpid()
+        #Locks of the parent process may have been held by its other threads
+        with self._reset_locks.setdefault(pid, threading.Lock()):
+            if self._pid == pid:
+                return
+            self._lock = threading.RLock()
+            with self._lock:
+                #Inherited sockets must not be used nor closed by this process
+                self._connections = {}
+                if self._config is not None:
+                    self._configure(self._config, lazy=True)
+            #Other threads wait for the reset until the new configurations
+            #are installed
+            self._fork_marker = threading._active_limbo_lock
+            self._pid = pid
 
 ConnectionManager = _ConnectionManager()
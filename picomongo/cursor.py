@@ -0,0 +1,350 @@
+'''Cursor module, use cursor.DocumentCursor to iterate over query results as
+Documents.
+'''
+
+import sys
+import threading
+import time
+
+from collections import deque
+from itertools import islice
+from Queue import Queue, Full
+
+from pymongo.cursor import Cursor
+
+import monitoring
+
+from connection_manager import ConnectionManager
+
+#Size of the first batch returned by the server when no batch size is set
+DEFAULT_BATCH_SIZE = 101
+
+def _raw_batches(cursor, size):
+    '''Yield the results of cursor as lists, one per batch returned by the
+    server: each batch is taken from the pymongo cursor buffer at once,
+    instead of document by document. Other cursors are read by chunks of
+    size documents.
+    '''
+    if not isinstance(cursor, Cursor):
+        while True:
+            batch = list(islice(cursor, size))
+            if not batch:
+                return
+            yield batch
+
+    if cursor._Cursor__empty:
+        return
+    collection = cursor.collection
+    fix_outgoing = collection.database._fix_outgoing \
+        if cursor._Cursor__manipulate else None
+    #_refresh gets the next batch from the server when the buffer is empty
+    while cursor._Cursor__data or cursor._refresh():
+        data = cursor._Cursor__data
+        batch = list(data)
+        data.clear()
+        if fix_outgoing is not None:
+            batch = [fix_outgoing(son, collection) for son in batch]
+        yield batch
+
+#Prefetcher queue markers
+_END = object()
+
+class _Error(object):
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class _Prefetcher(object):
+    '''Read batches of a cursor from a background thread, at most size
+    batches ahead of the consumer.
+    '''
+
+    def __init__(self, cursor, batch_size, size):
+        self._cursor = cursor
+        self._queue = Queue(size)
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, args=(batch_size,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, batch_size):
+        try:
+            try:
+                for batch in _raw_batches(self._cursor, batch_size):
+                    if not self._put(batch):
+                        return
+            finally:
+                self._cursor.close()
+        except Exception:
+            self._put(_Error(sys.exc_info()))
+        else:
+            self._put(_END)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(self):
+        '''Return the next batch, raise StopIteration when the cursor is
+        exhausted and re-raise errors of the background thread.
+        '''
+        item = self._queue.get()
+        if item is _END:
+            self._queue.put(_END)
+            raise StopIteration()
+        if isinstance(item, _Error):
+            self._queue.put(item)
+            exc_type, exc_value, traceback = item.exc_info
+            raise exc_type, exc_value, traceback
+        return item
+
+    def stop(self, wait=True):
+        '''Stop the background thread, it closes the cursor. If wait is
+        True, wait for it to finish.
+        '''
+        self._stopped.set()
+        if wait:
+            self._thread.join()
+
+def _query(cursor):
+    '''Return the spec, sort and fields of a pymongo cursor, None if they
+    are unknown.
+    '''
+    try:
+        spec = cursor._Cursor__spec
+    except AttributeError:
+        return None
+    ordering = cursor._Cursor__ordering
+    return {'spec': spec, 'sort': ordering.items() if ordering else None,
+            'fields': cursor._Cursor__fields}
+
+class DocumentCursor(object):
+    '''Wrap a pymongo cursor and return its results as Documents.
+
+    Cursor modifiers (limit, skip, sort, hint, batch_size, ...) return the
+    DocumentCursor itself so they can be chained. Other attributes (count,
+    explain, distinct, alive, ...) are the wrapped cursor ones.
+
+    With prefetch, batches are read by a background thread, ahead of the
+    consumer, see prefetch.
+
+    When monitoring listeners are registered, a 'find' event is published
+    once the cursor is exhausted, closed or fails: its duration is the time
+    spent reading results, not the time spent by the consumer between them.
+    It is also sent to the slow log of the document class, if enabled.
+    '''
+
+    def __init__(self, cursor, document_class):
+        self.cursor = cursor
+        self.document_class = document_class
+
+        self._batch_size = 0
+
+        self._prefetch = 0
+        self._prefetcher = None
+        self._buffer = deque()
+
+        #[duration, documents] read so far, None when not monitored
+        self._slow_log = document_class._slow_log \
+            if ConnectionManager.slow_log_configured else None
+        self._monitor = [0.0, 0] if monitoring.enabled() or \
+            self._slow_log is not None else None
+
+    def __del__(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop(wait=False)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._monitor is None:
+            return self._next()
+
+        start = time.time()
+        try:
+            document = self._next()
+        except StopIteration:
+            self._monitor[0] += time.time() - start
+            self._publish()
+            raise
+        except Exception:
+            exc_info = sys.exc_info()
+            self._monitor[0] += time.time() - start
+            self._publish(exc_info[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._monitor[0] += time.time() - start
+        self._monitor[1] += 1
+        return document
+
+    def _next(self):
+        if self._prefetch:
+            if not self._buffer:
+                self._buffer.extend(self._next_prefetched())
+            return self.document_class._load(self._buffer.popleft())
+        return self.document_class._load(self.cursor.next())
+
+    def _publish(self, error=None):
+        '''Publish the monitoring event of the cursor, once.
+        '''
+        monitor = self._monitor
+        if monitor is None:
+            return
+        self._monitor = None
+        monitoring.publish(self.document_class, 'find', monitor[0],
+                           monitor[1], error=error, query=_query(self.cursor),
+                           slow_log=self._slow_log)
+
+    def _next_prefetched(self):
+        if self._prefetcher is None:
+            self._prefetcher = _Prefetcher(self.cursor,
+                self._batch_size or DEFAULT_BATCH_SIZE, self._prefetch)
+        return self._prefetcher.get()
+
+    def __getitem__(self, index):
+        result = self.cursor[index]
+        if isinstance(index, slice):
+            return self
+        return self.document_class._load(result)
+
+    def __getattr__(self, attr_name):
+        return getattr(self.cursor, attr_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Close the cursor, stop prefetching.
+        '''
+        self._publish()
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+        else:
+            self.cursor.close()
+
+    def prefetch(self, batches=2):
+        '''Read the results from a background thread, at most batches server
+        batches ahead of the consumer.
+
+        It must be called before starting to iterate. Errors raised while
+        reading are re-raised by the consumer, and closing the cursor stops
+        the background thread.
+        '''
+        self._prefetch = batches
+        return self
+
+    def clone(self):
+        '''Return an unevaluated copy of this cursor.
+        '''
+        clone = DocumentCursor(self.cursor.clone(), self.document_class)
+        clone._batch_size = self._batch_size
+        return clone
+
+    def limit(self, limit):
+        self.cursor.limit(limit)
+        return self
+
+    def skip(self, skip):
+        self.cursor.skip(skip)
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self.cursor.sort(key_or_list, direction)
+        return self
+
+    def hint(self, index):
+        self.cursor.hint(index)
+        return self
+
+    def batch_size(self, batch_size):
+        self.cursor.batch_size(batch_size)
+        self._batch_size = batch_size
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self.cursor.max_time_ms(max_time_ms)
+        return self
+
+    def max_scan(self, max_scan):
+        self.cursor.max_scan(max_scan)
+        return self
+
+    def where(self, code):
+        self.cursor.where(code)
+        return self
+
+    def comment(self, comment):
+        self.cursor.comment(comment)
+        return self
+
+    def rewind(self):
+        self.cursor.rewind()
+        return self
+
+    def raw_batches(self, size=None):
+        '''Iterate over results as lists of raw documents (dicts), one list
+        per batch returned by the server (with a pymongo cursor, other
+        cursors give lists of the batch size).
+
+        If size is given, it is used as the cursor batch size, it must then
+        be called before starting to iterate.
+        '''
+        if size:
+            self.batch_size(size)
+
+        if self._monitor is None:
+            for batch in self._raw_batches():
+                yield batch
+            return
+
+        batches = self._raw_batches()
+        while True:
+            start = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self._monitor[0] += time.time() - start
+                self._publish()
+                return
+            except Exception:
+                exc_info = sys.exc_info()
+                self._monitor[0] += time.time() - start
+                self._publish(exc_info[1])
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._monitor[0] += time.time() - start
+            self._monitor[1] += len(batch)
+            yield batch
+
+    def _raw_batches(self):
+        if not self._prefetch:
+            for batch in _raw_batches(self.cursor,
+                                      self._batch_size or DEFAULT_BATCH_SIZE):
+                yield batch
+            return
+
+        if self._buffer:
+            yield list(self._buffer)
+            self._buffer.clear()
+        while True:
+            try:
+                batch = self._next_prefetched()
+            except StopIteration:
+                return
+            yield batch
+
+    def batches(self, size=None):
+        '''Iterate over results as lists of Documents, one list per batch
+        returned by the server, see raw_batches.
+        '''
+        load = self.document_class._load
+        for batch in self.raw_batches(size):
+            yield [load(data) for data in batch]
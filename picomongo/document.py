@@ -1,50 +1,256 @@
-from copy import copy, deepcopy
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import date, datetime
+from decimal import Decimal
+from functools import partial
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from uuid import UUID
+from weakref import WeakSet
 
 import pymongo
 
-from pymongo.errors import InvalidOperation, OperationFailure
-from pymongo.cursor import Cursor as PymongoCursor
+from bson import BSON
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from pymongo.common import MAX_BSON_SIZE
+from pymongo.errors import DuplicateKeyError, InvalidOperation, \
+    OperationFailure
 from pymongo.read_preferences import ReadPreference
 
-from exceptions import ValidationError
-from utils import CMProxy, CollectionDescriptor
+from connection_manager import parse_read_preference
+from cursor import DocumentCursor
+from session import current_session
+from exceptions import ConflictError, DocumentNotFound, ValidationError
+from fields import compile_schema
+from monitoring import instrumented
+from operators import apply_update, can_apply, depends_on_values
+from pagination import decode_token, encode_token, is_covered, seek_spec, \
+    sort_spec
+from utils import CMProxy, CacheDescriptor, CollectionDescriptor, \
+    SlowLogDescriptor, WriteBufferDescriptor, \
+    HybridMethod, batches
 
-class DocumentCursor(PymongoCursor):
+def _bson_size(document):
+    return len(BSON.encode(document))
 
-    def __init__(self, cursor, document_class, **kwargs):
-        self.__dict__ = cursor.__dict__
-        self._document = document_class
-        self._kwargs = kwargs
+def _found(owner, result):
+    return 1 if result else 0
 
-    def __getitem__(self, index):
-        return self._document(PymongoCursor.__getitem__(self, index),
-                              **self._kwargs)
+def _one(owner, result):
+    return 1
 
-    def __getattr__(self, attr_name):
-        return PymongoCursor.__getattribute__(self, attr_name)
+def _count(owner, result):
+    return result
+
+def _loaded(owner, result):
+    return sum(1 for document in result if document is not None)
+
+def _find_one_query(args, kwargs):
+    spec = args[0] if args else kwargs.get('spec_or_id')
+    if spec is not None and not isinstance(spec, dict):
+        spec = {'_id': spec}
+    return {'spec': spec, 'sort': kwargs.get('sort'),
+            'fields': args[1] if len(args) > 1 else kwargs.get('fields')}
+
+def _cache_key(spec_or_id):
+    '''Return the _id of a find_one by _id spec, None for other specs.
+    '''
+    if isinstance(spec_or_id, dict):
+        if len(spec_or_id) != 1:
+            return None
+        spec_or_id = spec_or_id.get('_id')
+    if spec_or_id is None or isinstance(spec_or_id, (dict, list)):
+        return None
+    return spec_or_id
+
+#Values which may be modified in place once read from a document
+_MUTABLE_TYPES = (dict, list)
+
+def _digest(value):
+    '''Return the digest of a dict or list value, None if it can not be
+    encoded.
+    '''
+    try:
+        return md5(BSON.encode({'v': value})).digest()
+    except InvalidDocument:
+        return None
+
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None), Decimal,
+                    date, datetime, ObjectId, UUID)
+
+def _is_immutable(value):
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+def _compile_defaults(default_values):
+    '''Compile default values as a dict of values shared by all documents
+    (immutable ones) and a list of (key, factory) for the others.
+    '''
+    shared = {}
+    factories = []
+    for key, value in default_values.iteritems():
+        if callable(value):
+            factories.append((key, value))
+        elif _is_immutable(value):
+            shared[key] = value
+        elif isinstance(value, list) and all(_is_immutable(item)
+                                             for item in value):
+            factories.append((key, partial(list, value)))
+        elif isinstance(value, dict) and all(_is_immutable(item)
+                                             for item in value.itervalues()):
+            factories.append((key, partial(dict, value)))
+        else:
+            factories.append((key, partial(deepcopy, value)))
+    return shared, factories
+
+def _update_method(operator):
+    '''Build a HybridMethod sending a single update operator, see
+    Document.modify.
+    '''
+    def method(cls, document, *args, **kwargs):
+        if document is None:
+            spec_or_id, values = args
+        else:
+            spec_or_id, (values,) = None, args
+        return cls._modify(document, spec_or_id, {operator: values}, **kwargs)
+
+    method.__doc__ = '''Update documents with %s, see modify.
+
+        Document.method(spec_or_id, values, **kwargs) or
+        document.method(values, **kwargs)
+        ''' % operator
+    return HybridMethod(method)
+
+#Document.__init__, see DocumentMeta._compile
+_base_init = None
+
+class _ValidationGuard(dict):
+    '''Changes tracker used while validate runs, forbids any change.
+    '''
+
+    def __setitem__(self, key, value):
+        err_msg = 'Changes and deletion are forbiden in validate method'
+        raise ValidationError(err_msg)
+
+class DocumentMeta(type):
+    '''Metaclass of documents, compile per class data when a document class
+    is created and when its attributes are changed.
+
+    default_values are compiled, so they must be replaced rather than
+    modified in place.
 
-    def next(self):
-        return self._document(PymongoCursor.next(self), **self._kwargs)
+    Every document class is added to DocumentMeta.registry.
+    '''
+
+    #All document classes (weak references)
+    registry = WeakSet()
+
+    def __init__(cls, name, bases, attrs):
+        super(DocumentMeta, cls).__init__(name, bases, attrs)
+        cls._compile()
+        DocumentMeta.registry.add(cls)
+
+    def __setattr__(cls, name, value):
+        super(DocumentMeta, cls).__setattr__(name, value)
+        cls._refresh()
+
+    def __delattr__(cls, name):
+        super(DocumentMeta, cls).__delattr__(name)
+        cls._refresh()
+
+    def _refresh(cls):
+        '''Compile this class and its subclasses again.
+        '''
+        cls._compile()
+        for subclass in cls.__subclasses__():
+            subclass._refresh()
+
+    def _compile(cls):
+        type.__setattr__(cls, '_defaults',
+                         _compile_defaults(cls.default_values))
+
+        validators, required = compile_schema(cls.schema, cls.required_fields)
+        type.__setattr__(cls, '_validators', validators)
+        type.__setattr__(cls, '_required', required)
+
+        #Attribute name -> True if it is set on the object (private names
+        #and data descriptors like properties), False if it is a field
+        routes = {}
+        for klass in cls.__mro__:
+            for name, value in vars(klass).iteritems():
+                if hasattr(value, '__set__'):
+                    routes.setdefault(name, True)
+        type.__setattr__(cls, '_attribute_routes', routes)
+
+        #Documents are loaded without __init__, unless it is overridden
+        type.__setattr__(cls, '_custom_init', _base_init is not None and
+                         cls.__init__.im_func is not _base_init)
+
+    def _route(cls, name):
+        is_attribute = (name.startswith('_') and name != '_id') or \
+            hasattr(getattr(cls, name, None), '__set__')
+        cls._attribute_routes[name] = is_attribute
+        return is_attribute
 
 class Document(dict):
     '''Base class for all documents.
+
+    Document classes may declare the schema of their fields as a dict of
+    fields.Field in schema, it is checked when saving with validate=True,
+    as well as required_fields.
+
+    Documents loaded from (or saved to) the database track which of their
+    fields are set or deleted, so that saving them only sends these fields.
+    As nested values can be modified in place, a digest of dict and list
+    fields is kept the first time they are read (by item, attribute, get,
+    items or values), these fields are changed if their digest differs when
+    the document is saved. Values read through dict methods, such as
+    dict(document), are not tracked.
+
+    Setting version_field to a field name enables optimistic concurrency:
+    the field holds the document version, saving only succeeds if the
+    version in the database is still the one loaded, otherwise a
+    ConflictError is raised.
     '''
+    __metaclass__ = DocumentMeta
+
     con = CMProxy('con')
     db = CMProxy('db')
     col = CollectionDescriptor()
+    _cache = CacheDescriptor()
+    _write_buffer = WriteBufferDescriptor()
+    _slow_log = SlowLogDescriptor()
 
     required_fields = []
     default_values = {}
+    schema = {}
+    indexes = []
 
     config_name = None
     collection_name = None
+    version_field = None
+    #Default read preference of find, find_one and get_many, overrides the
+    #configuration one
+    read_preference = None
+
+    #Changed fields since last load or save, True if the field was set and
+    #False if it was deleted. None when changes are not tracked (unsaved
+    #document).
+    _changes = None
+    #Digests of the dict and list fields handed out since last load or save,
+    #see _track. None when no such field was handed out.
+    _snapshot = None
 
     def __init__(self, initial_values=None, use_defaults=True):
-        init = {}
         if use_defaults:
-            for key, value in self.default_values.items():
-                init[key] = value() if hasattr(value, '__call__') else \
-                    deepcopy(value)
+            shared, factories = self._defaults
+            init = dict(shared)
+            for key, factory in factories:
+                init[key] = factory()
+        else:
+            init = {}
         if initial_values is None:
             initial_values = {}
 
@@ -55,43 +261,529 @@ class Document(dict):
 
         super(Document, self).__init__(init)
 
+    @classmethod
+    def _load(cls, data):
+        '''Build a document from data coming from the database.
+
+        Data is trusted: no default values, no private fields check, and it
+        is copied only once, straight into the new document. Classes
+        overriding __init__ still have it called, with use_defaults=False.
+        '''
+        if cls._custom_init:
+            document = cls(data, use_defaults=False)
+            object.__setattr__(document, '_changes', {})
+            return document
+
+        document = dict.__new__(cls)
+        dict.update(document, data)
+        object.__setattr__(document, '_changes', {})
+        return document
+
+    def _reset_changes(self):
+        '''Track changes from the current content, after a save.
+        '''
+        changes = self._changes
+        if changes is None:
+            #Values of a new document come from the caller
+            keys = dict.keys(self)
+        else:
+            keys = [key for key, is_set in changes.iteritems() if is_set]
+            keys.extend(self._snapshot or ())
+        object.__setattr__(self, '_changes', {})
+        self._refresh_snapshot(keys)
+
+    def _track(self, key, value):
+        '''Return value, the value of field key handed out by the document.
+        The first time a dict or list field is handed out, its digest is kept
+        to find whether it is modified in place later.
+        '''
+        if self._changes is not None and isinstance(value, _MUTABLE_TYPES):
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = {}
+                object.__setattr__(self, '_snapshot', snapshot)
+            if key not in snapshot:
+                snapshot[key] = _digest(value)
+        return value
+
+    def _track_all(self):
+        if self._changes is not None:
+            for key, value in dict.iteritems(self):
+                self._track(key, value)
+
+    def _refresh_snapshot(self, keys):
+        '''Digest again the dict and list fields of keys, the current values
+        are in sync with the database.
+        '''
+        snapshot = self._snapshot or {}
+        for key in keys:
+            value = dict.get(self, key)
+            if isinstance(value, _MUTABLE_TYPES):
+                snapshot[key] = _digest(value)
+            else:
+                snapshot.pop(key, None)
+        object.__setattr__(self, '_snapshot', snapshot or None)
+
+    def _collect_changes(self):
+        '''Add dict and list fields modified in place since last load or save
+        to the changes, return them.
+        '''
+        changes = self._changes
+        snapshot = self._snapshot
+        if changes is None or not snapshot:
+            return changes
+        for key, digest in snapshot.iteritems():
+            if key in changes or key not in self:
+                continue
+            if digest is None or \
+               _digest(dict.__getitem__(self, key)) != digest:
+                changes[key] = True
+        return changes
+
+    def _get_update(self):
+        '''Return the update operation saving changed fields.
+        '''
+        update = {}
+        for key, is_set in self._changes.iteritems():
+            if is_set:
+                update.setdefault('$set', {})[key] = dict.__getitem__(self, key)
+            else:
+                update.setdefault('$unset', {})[key] = 1
+        return update
+
+    def _validate(self):
+        '''Check required fields and the schema of new fields (all fields for
+        new documents, changed ones for loaded documents), then call validate
+        if it is overridden or if there is nothing else to check.
+        '''
+        cls = self.__class__
+        validators = cls._validators
+        required = cls._required
+
+        for name in required:
+            if name not in self:
+                raise ValidationError('%s is required' % name)
+
+        if validators:
+            changes = self._collect_changes()
+            for key in (self if changes is None else changes):
+                validator = validators.get(key)
+                if validator is not None and key in self:
+                    validator(dict.__getitem__(self, key))
+
+        validate = cls.validate
+        if getattr(validate, 'im_func', validate) is _base_validate and \
+                (validators or required):
+            return
+
+        changes = self._changes
+        object.__setattr__(self, '_changes', _ValidationGuard())
+        try:
+            self.validate()
+        finally:
+            object.__setattr__(self, '_changes', changes)
+
     def save(self, validate=False, reload=False, **kwargs):
         '''Save document in db. Does not save attribute starting with '_'.
+
+        New documents are inserted (or replaced if they have an _id), loaded
+        documents are updated with their changed fields only.
+
+        If the class has a version_field, the write is acknowledged and
+        conditioned on the document version, see _save_version.
+
+        If the configuration enables write-behind (and the class has no
+        version_field), the write is buffered and sent later in background,
+        see Document.flush. Other arguments are then ignored, unless reload
+        is True: pending writes are sent, then the document is saved and
+        reloaded immediately.
+
+        If a session.Session is active, the document is only saved when the
+        session is committed, other arguments are then ignored, unless reload
+        is True.
         '''
         if validate:
-            local_copy = copy(self)
-            self.__class__.validate(local_copy)
-            if local_copy != self:
-                err_msg = 'Changes and deletion are forbiden in validate method'
-                raise ValidationError(err_msg)
+            self._validate()
+
+        session = current_session()
+        if session is not None and not reload:
+            session.add(self)
+            return
+        self._save(kwargs, reload)
 
+    @instrumented('save', _one)
+    def _save(self, kwargs, reload=False):
+        '''Save the document now, see save.
+        '''
         # TODO: Should picomongo manage db error
-        self.col.save(self, **kwargs)
+        changes = self._collect_changes()
+        buffer = self._write_buffer
+        if buffer is not None and reload:
+            buffer.flush()
+        if buffer is not None and not reload and self.version_field is None:
+            self._save_behind(buffer, changes)
+        elif self.version_field is not None:
+            self._save_version(changes, kwargs)
+        elif changes is None or changes.get('_id') or '_id' not in self:
+            self.col.save(self, **kwargs)
+        elif changes:
+            self.col.update({'_id': self['_id']}, self._get_update(), **kwargs)
+        self._reset_changes()
+
+        cache = self._cache
+        if cache is not None:
+            cache.invalidate(self['_id'])
 
         if reload:
             self.reload()
 
+    def _save_behind(self, buffer, changes):
+        '''Buffer the write of the document, new documents get their _id
+        immediately.
+        '''
+        if '_id' not in self:
+            dict.__setitem__(self, '_id', ObjectId())
+            buffer.replace(self['_id'], deepcopy(dict(self)))
+        elif changes is None or changes.get('_id'):
+            buffer.replace(self['_id'], deepcopy(dict(self)))
+        elif changes:
+            buffer.update(self['_id'], deepcopy(self._get_update()))
+
+    def _save_version(self, changes, kwargs):
+        '''Save a versioned document.
+
+        New documents without version are inserted with version 1, others
+        are replaced or updated only if the database still has their version,
+        which is incremented. Loaded documents without version (saved before
+        the class had a version_field) get version 1, unless the database
+        document got one meanwhile. Raise a ConflictError if the document was
+        saved by someone else in the meantime (or already exists for an
+        insert).
+        '''
+        field = self.version_field
+        kwargs['safe'] = True
+        if kwargs.get('w') == 0:
+            del kwargs['w']
+
+        version = dict.get(self, field)
+        if version is None and changes is None:
+            dict.__setitem__(self, field, 1)
+            try:
+                self.col.insert(self, **kwargs)
+            except DuplicateKeyError:
+                dict.__delitem__(self, field)
+                raise ConflictError('%s %r already exists.'
+                                    % (self.__class__.__name__, self['_id']))
+            return
+
+        if version is None:
+            expected, new_version = {'$exists': False}, 1
+        else:
+            expected, new_version = version, version + 1
+
+        if changes is None or changes.get('_id'):
+            update = dict(self)
+            update[field] = new_version
+        elif changes or version is None:
+            update = {}
+            for operator, fields in self._get_update().iteritems():
+                fields.pop(field, None)
+                if fields:
+                    update[operator] = fields
+            if version is None:
+                update.setdefault('$set', {})[field] = new_version
+            else:
+                update['$inc'] = {field: 1}
+        else:
+            return
+
+        result = self.col.update({'_id': self['_id'], field: expected},
+                                 update, **kwargs)
+        if not result['n']:
+            raise ConflictError('%s %r is no more at version %s.'
+                                % (self.__class__.__name__, self['_id'],
+                                   version))
+        dict.__setitem__(self, field, new_version)
+
+    def mutate(self, mutation, retries=3, **kwargs):
+        '''Apply mutation to the document and save it, on conflict reload
+        the document and try again, at most retries times.
+
+        mutation is called with the document as only argument, after a
+        reload it is applied again to the fresh document. Other arguments
+        are passed to save. Raise the last ConflictError if all attempts
+        failed.
+
+        Example: user.mutate(lambda user: user.tags.append('new'))
+        '''
+        for attempt in xrange(retries + 1):
+            mutation(self)
+            try:
+                self.save(**kwargs)
+                return
+            except ConflictError:
+                if attempt == retries:
+                    raise
+                self.reload()
+
     @classmethod
+    @instrumented('save_many', _count)
+    def save_many(cls, documents, batch_size=1000,
+                  max_batch_bytes=MAX_BSON_SIZE, validate=False, ordered=False,
+                  write_concern=None):
+        '''Save documents using bulk operations, return the number of
+        operations sent.
+
+        Documents can be any iterable (a generator for example), they are
+        consumed and sent by batches of at most batch_size documents and
+        max_batch_bytes of BSON. New documents are inserted and get their _id,
+        documents having an _id are replaced or, for loaded documents, updated
+        with their changed fields.
+
+        If validate is True, each document is validated before its batch is
+        sent. Versions are not checked, use save for versioned documents.
+        '''
+        col = cls.col
+        cache = cls._cache
+        count = 0
+        for batch in batches(documents, batch_size, max_batch_bytes,
+                             _bson_size):
+            if ordered:
+                bulk = col.initialize_ordered_bulk_op()
+            else:
+                bulk = col.initialize_unordered_bulk_op()
+
+            operations = 0
+            for document in batch:
+                if validate:
+                    document._validate()
+
+                changes = document._collect_changes()
+                if '_id' not in document:
+                    bulk.insert(document)
+                elif changes is None or changes.get('_id'):
+                    bulk.find({'_id': document['_id']}).upsert() \
+                        .replace_one(document)
+                elif changes:
+                    bulk.find({'_id': document['_id']}) \
+                        .update_one(document._get_update())
+                else:
+                    continue
+                operations += 1
+
+            if operations:
+                bulk.execute(write_concern)
+                count += operations
+            for document in batch:
+                document._reset_changes()
+                if cache is not None:
+                    cache.invalidate(document['_id'])
+        return count
+
+    @classmethod
+    @instrumented('insert_many', _count)
+    def insert_many(cls, documents, batch_size=1000,
+                    max_batch_bytes=MAX_BSON_SIZE, validate=False, **kwargs):
+        '''Insert documents by batches, return the number of inserted
+        documents.
+
+        Documents are consumed and sent as save_many does, inserted documents
+        get their _id. Any additionnal arguments will be passed to
+        Collection.insert
+        '''
+        col = cls.col
+        count = 0
+        for batch in batches(documents, batch_size, max_batch_bytes,
+                             _bson_size):
+            if validate:
+                for document in batch:
+                    document._validate()
+
+            col.insert(batch, **kwargs)
+            for document in batch:
+                document._reset_changes()
+            count += len(batch)
+        return count
+
+    @classmethod
+    @instrumented('find_one', _found, query=_find_one_query)
     def find_one(cls, *args, **kwargs):
         '''Get a single document from the database and return it as a Document.
 
+        When the document configuration enables caching, documents got by
+        _id only (find_one(_id) or find_one({'_id': _id})) are cached.
+
+        Read preference is chosen as for find.
+
         Any additionnal arguments will be passed to Collection.find_one
         '''
+        cache = None
+        if len(args) == 1 and not kwargs:
+            _id = _cache_key(args[0])
+            cache = cls._cache if _id is not None else None
+            if cache is not None:
+                data = cache.get(_id)
+                if data is not None:
+                    return cls._load(data)
+
+        cls._read_options(kwargs)
         the_one = cls.col.find_one(*args, **kwargs)
         if the_one:
-            return cls(the_one, use_defaults=False)
+            if cache is not None:
+                cache.set(the_one)
+            return cls._load(the_one)
         return the_one
 
+    @classmethod
+    def _read_options(cls, kwargs):
+        '''Set the class read preference in the arguments of a read, unless
+        given.
+        '''
+        if 'read_preference' in kwargs:
+            kwargs['read_preference'] = \
+                parse_read_preference(kwargs['read_preference'])
+        elif cls.read_preference is not None:
+            kwargs['read_preference'] = \
+                parse_read_preference(cls.read_preference)
+
+    @classmethod
+    def flush(cls):
+        '''Send the writes buffered by write-behind now, return the number of
+        writes sent.
+        '''
+        buffer = cls._write_buffer
+        return buffer.flush() if buffer is not None else 0
+
+    @classmethod
+    def write_behind_stats(cls):
+        '''Return the counters of the write-behind buffer, None if
+        write-behind is not enabled.
+        '''
+        buffer = cls._write_buffer
+        return buffer.stats() if buffer is not None else None
+
+    @classmethod
+    def cache_stats(cls):
+        '''Return hits, misses, evictions, ... counters of the document
+        cache, None if caching is not enabled.
+        '''
+        cache = cls._cache
+        return cache.stats() if cache is not None else None
+
+    @classmethod
+    @instrumented('get_many', _loaded)
+    def get_many(cls, ids, chunk_size=500, workers=None, missing='skip',
+                 **kwargs):
+        '''Get documents by _id and return them as Documents, in ids order.
+
+        Documents are fetched with one $in query per chunk of chunk_size ids,
+        these queries run concurrently in a pool of workers threads if
+        workers is given. missing defines what to do with ids not found:
+        * 'skip': ignore them
+        * 'none': return None in place of the document
+        * 'raise': raise a DocumentNotFound exception
+
+        Any additionnal arguments will be passed to Collection.find
+        '''
+        if missing not in ('skip', 'none', 'raise'):
+            raise ValueError("missing should be 'skip', 'none' or 'raise'")
+
+        ids = list(ids)
+        chunks = list(batches(OrderedDict.fromkeys(ids), chunk_size))
+        col = cls.col
+        cls._read_options(kwargs)
+
+        def fetch(chunk):
+            return list(col.find({'_id': {'$in': chunk}}, **kwargs))
+
+        if workers and len(chunks) > 1:
+            pool = ThreadPool(min(workers, len(chunks)))
+            try:
+                results = pool.map(fetch, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [fetch(chunk) for chunk in chunks]
+
+        found = {}
+        for result in results:
+            for data in result:
+                found[data['_id']] = data
+
+        documents = []
+        not_found = []
+        for _id in ids:
+            data = found.get(_id)
+            if data is not None:
+                documents.append(cls._load(data))
+            elif missing == 'none':
+                documents.append(None)
+            elif missing == 'raise':
+                not_found.append(_id)
+        if not_found:
+            raise DocumentNotFound('Documents not found: %s' % not_found)
+        return documents
+
     @classmethod
     def find(cls, *args, **kwargs):
         '''Query the database and returns results as Documents.
 
+        If prefetch is given, results are read by a background thread, at
+        most prefetch batches ahead, see DocumentCursor.prefetch.
+
+        read_preference may be a pymongo ReadPreference or its name (as
+        'secondary_preferred'), it defaults to the class read_preference,
+        then to the configuration one. tag_sets and
+        secondary_acceptable_latency_ms can be given as well.
+
         Any additionnal arguments will be passed to Collection.find
         '''
-        return DocumentCursor(cls.col.find(*args, **kwargs), cls,
-                              use_defaults=False)
+        prefetch = kwargs.pop('prefetch', None)
+        cls._read_options(kwargs)
+        cursor = DocumentCursor(cls.col.find(*args, **kwargs), cls)
+        if prefetch:
+            cursor.prefetch(prefetch)
+        return cursor
 
     @classmethod
+    def paginate(cls, query=None, sort_keys=('_id',), page_size=20,
+                 after=None, check_index=True, **kwargs):
+        '''Return a page of documents matching query, and the continuation
+        token of the next page (None for the last page).
+
+        Pages are read by keyset: instead of skipping previous documents,
+        documents following the last one of the previous page are queried,
+        so every page costs about the same. sort_keys are given as index
+        fields ('date', '-date') or (field, direction), _id is added to them
+        to break ties. Pass the returned token as after to get the next page.
+
+        If check_index is True, a ValueError is raised unless one of the
+        class indexes covers the sort, _id included: sort_keys ['-date']
+        needs {'fields': ('-date', '-_id')} for example, fields queried by
+        equality can come first.
+
+        Any additionnal arguments will be passed to Document.find
+        '''
+        keys = sort_spec(sort_keys)
+        if check_index and not is_covered(keys, query, cls.indexes):
+            raise ValueError('%s.indexes does not cover the sort %s'
+                             % (cls.__name__, keys))
+
+        spec = query or {}
+        if after is not None:
+            seek = seek_spec(keys, decode_token(keys, after))
+            spec = {'$and': [spec, seek]} if spec else seek
+
+        documents = list(cls.find(spec, sort=keys, limit=page_size + 1,
+                                  **kwargs))
+        if len(documents) <= page_size:
+            return documents, None
+        del documents[page_size:]
+        return documents, encode_token(keys, documents[-1])
+
+    @classmethod
+    @instrumented('generate_index')
     def generate_index(cls):
         '''Generate index in DB using Document.indexes
 
@@ -106,6 +798,9 @@ class Document(dict):
             to ensure_index. For example:
 
         {'fields': ('something',), 'unique': True, 'ttl': 3600 * 24}
+
+        See indexes.IndexManager to only create missing indexes, for all
+        document classes at once.
         '''
 
         ascending = lambda field: (field, pymongo.ASCENDING)
@@ -131,23 +826,37 @@ class Document(dict):
             results.append(cls.col.ensure_index(fields, **index))
         return results
 
+    @instrumented('reload', _one)
     def reload(self):
         '''Reload current document from DB.
 
         Any additionnal arguments will be passed to Document.find_one
         Raise an InvalidOperation if current document is unsaved.
+
+        Writes pending in the write-behind buffer of the document class are
+        sent first.
         '''
         if not self.get('_id'):
             raise InvalidOperation('You cannot reload an unsaved document.')
 
+        buffer = self._write_buffer
+        if buffer is not None:
+            buffer.flush()
+
         doc = self.col.find_one({'_id': self._id}, read_preference=ReadPreference.PRIMARY)
 
         if not doc:
             raise OperationFailure('Document is no more present in DB.')
 
-        self.clear()
-        self.update(doc)
+        dict.clear(self)
+        dict.update(self, doc)
+        self._reset_changes()
+
+        cache = self._cache
+        if cache is not None:
+            cache.set(doc)
 
+    @instrumented('delete', _one)
     def delete(self, *args, **kwargs):
         '''Remove current Document from database.
 
@@ -156,7 +865,133 @@ class Document(dict):
         '''
         if not '_id' in self:
             raise InvalidOperation('You cannot remove an unsaved document.')
-        return self.col.remove({'_id': self._id}, *args, **kwargs)
+        session = current_session()
+        if session is not None:
+            session.delete(self)
+            return None
+        buffer = self._write_buffer
+        if buffer is not None:
+            buffer.discard(self['_id'])
+        result = self.col.remove({'_id': self._id}, *args, **kwargs)
+
+        cache = self._cache
+        if cache is not None:
+            cache.invalidate(self['_id'])
+        return result
+
+    @classmethod
+    @instrumented('modify')
+    def _modify(cls, document, spec_or_id, update, new=False, upsert=False,
+                multi=False, **kwargs):
+        if document is not None:
+            if not '_id' in document:
+                raise InvalidOperation('You cannot modify an unsaved document.')
+            spec = {'_id': document['_id']}
+        elif isinstance(spec_or_id, dict):
+            spec = spec_or_id
+        else:
+            spec = {'_id': spec_or_id}
+
+        field = cls.version_field
+        if field is not None and all(key.startswith('$') for key in update) \
+           and not any(field in fields for fields in update.itervalues()):
+            #Keep versions in sync with updates
+            update = dict(update)
+            update['$inc'] = dict(update.get('$inc', {}))
+            update['$inc'][field] = 1
+
+        buffer = cls._write_buffer
+        if buffer is not None:
+            #Pending writes must not overwrite this update
+            buffer.flush()
+
+        col = cls.col
+        cache = cls._cache
+
+        if new or (document is not None and (depends_on_values(update) or
+                                             not can_apply(update))):
+            #findAndModify is a command, always acknowledged
+            kwargs.pop('safe', None)
+            data = col.find_and_modify(spec, update, upsert=upsert, new=True,
+                                       **kwargs)
+            if data is None:
+                return None
+            if cache is not None:
+                cache.invalidate(data['_id'])
+            if document is None:
+                return cls._load(data)
+            document._sync(data)
+            return document if new else None
+
+        result = col.update(spec, update, upsert=upsert, multi=multi, **kwargs)
+        if cache is not None:
+            _id = _cache_key(spec)
+            if _id is not None:
+                cache.invalidate(_id)
+            else:
+                cache.clear()
+        if document is not None:
+            #Fields changed in place stay changed, the others are in sync
+            changes = document._collect_changes()
+            apply_update(document, update)
+            if changes is not None:
+                document._refresh_snapshot(list(document._snapshot or ()))
+        return result
+
+    def _sync(self, data):
+        '''Replace the document content with data from the database, keep
+        changes not saved yet.
+        '''
+        changes = self._collect_changes() or {}
+        pending = dict((key, dict.__getitem__(self, key))
+                       for key, is_set in changes.iteritems()
+                       if is_set and key in self)
+
+        dict.clear(self)
+        dict.update(self, data)
+        for key, is_set in changes.iteritems():
+            if not is_set:
+                dict.pop(self, key, None)
+        dict.update(self, pending)
+        #Other fields are new values, not handed out yet
+        object.__setattr__(self, '_snapshot', None)
+
+    def _modify_method(cls, document, *args, **kwargs):
+        if document is None:
+            spec_or_id, update = args
+        else:
+            spec_or_id, (update,) = None, args
+        return cls._modify(document, spec_or_id, update, **kwargs)
+
+    modify = HybridMethod(_modify_method)
+    modify.__doc__ = '''Atomically update documents without reading them.
+
+        On the class: Document.modify(spec_or_id, update, **kwargs) updates
+        documents matching spec_or_id (a query or an _id).
+        On a document: document.modify(update, **kwargs) updates this
+        document and keeps it in sync: an update only made of $set is sent
+        with Collection.update and applied to the document, other updates
+        depend on the stored values, they are sent with findAndModify and
+        the document takes the updated values from the database.
+
+        If new is True, findAndModify is used and the updated document is
+        returned (None if nothing matched). Otherwise the Collection.update
+        result is returned, or None when findAndModify was used on a
+        document. upsert and multi have their Collection.update meaning,
+        other arguments are passed to Collection.update or
+        Collection.find_and_modify.
+
+        Example: UserDocument.modify(user_id, {'$inc': {'views': 1}})
+        '''
+    del _modify_method
+
+    inc = _update_method('$inc')
+    set_fields = _update_method('$set')
+    push = _update_method('$push')
+    add_to_set = _update_method('$addToSet')
+    pull = _update_method('$pull')
+    set_min = _update_method('$min')
+    set_max = _update_method('$max')
 
     def validate(self):
         '''Override this method to add document validation.
@@ -174,21 +1009,128 @@ class Document(dict):
     def __repr__(self):
         return self.__str__()
 
-    __getattr__ = dict.__getitem__
+    def __copy__(self):
+        duplicate = dict.__new__(self.__class__)
+        dict.update(duplicate, self)
+        duplicate.__dict__.update(self.__dict__)
+        changes = self._collect_changes()
+        if changes is not None:
+            object.__setattr__(duplicate, '_changes', dict(changes))
+            #Values are shared, they may be modified through self
+            object.__setattr__(duplicate, '_snapshot', None)
+            duplicate._refresh_snapshot(dict.keys(duplicate))
+        return duplicate
+
+    def __deepcopy__(self, memo):
+        duplicate = dict.__new__(self.__class__)
+        memo[id(self)] = duplicate
+        for key, value in dict.iteritems(self):
+            dict.__setitem__(duplicate, key, deepcopy(value, memo))
+        duplicate.__dict__.update(deepcopy(self.__dict__, memo))
+        return duplicate
+
+    def __getitem__(self, key):
+        return self._track(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        self._track_all()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._track_all()
+        return dict.iteritems(self)
+
+    def viewitems(self):
+        self._track_all()
+        return dict.viewitems(self)
+
+    def values(self):
+        self._track_all()
+        return dict.values(self)
+
+    def itervalues(self):
+        self._track_all()
+        return dict.itervalues(self)
+
+    def viewvalues(self):
+        self._track_all()
+        return dict.viewvalues(self)
+
+    def __setitem__(self, key, value):
+        changes = self._changes
+        if changes is not None:
+            changes[key] = True
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        changes = self._changes
+        if changes is not None and key in self:
+            changes[key] = False
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        changes = self._changes
+        if changes is not None:
+            values = dict(*args, **kwargs)
+            for key in values:
+                changes[key] = True
+            dict.update(self, values)
+        else:
+            dict.update(self, *args, **kwargs)
+
+    def pop(self, key, *args):
+        changes = self._changes
+        if changes is not None and key in self:
+            changes[key] = False
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        changes = self._changes
+        if changes is not None and self:
+            key = next(iter(self))
+            changes[key] = False
+            return key, dict.pop(self, key)
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        changes = self._changes
+        if changes is not None:
+            for key in self:
+                changes[key] = False
+        dict.clear(self)
+
+    def __getattr__(self, attr_name):
+        try:
+            return self[attr_name]
+        except KeyError:
+            raise AttributeError(attr_name)
 
     def __setattr__(self, attr_name, value):
-        white_list = set(('_id',)) # Set
-        # Hack for properties setter
-        if hasattr(getattr(self.__class__, attr_name, None), '__set__'):
+        # Private names and data descriptors (properties setter) are set on
+        # the object, other names are fields
+        is_attribute = self._attribute_routes.get(attr_name)
+        if is_attribute is None:
+            is_attribute = self.__class__._route(attr_name)
+
+        if is_attribute:
             return object.__setattr__(self, attr_name, value)
-        else:
-            if attr_name.startswith('_') and attr_name not in white_list:
-                return object.__setattr__(self, attr_name, value)
-            else:
-                return self.__setitem__(attr_name, value)
+        return self.__setitem__(attr_name, value)
 
     def __delattr__(self, attr_name):
         if attr_name.startswith('_'):
             return object.__delattr__(self, attr_name)
         else:
             return self.__delitem__(attr_name)
+
+_base_validate = Document.validate.im_func
+_base_init = Document.__init__.im_func
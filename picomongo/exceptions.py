@@ -3,3 +3,9 @@ class NotConfiguredYet(Exception):
 
 class ValidationError(Exception):
     pass
+
+class DocumentNotFound(Exception):
+    pass
+
+class ConflictError(Exception):
+    pass
@@ -0,0 +1,146 @@
+'''Fields module, use fields.Field to declare the schema of a document class.
+
+The schema is compiled once per document class into validation functions.
+'''
+
+from exceptions import ValidationError
+
+class Field(object):
+    '''Declare a document field, all arguments are optional:
+
+    * type: a type, or a tuple of types, of the value
+    * required: the field must be present
+    * null: None is accepted whatever the other rules
+    * min, max: bounds of the value
+    * min_length, max_length: bounds of the value length
+    * choices: accepted values
+    * schema: a dict of Fields for the keys of a dict value
+    * items: a Field for each item of a list value
+    * validator: a callable taking the value, raising a ValidationError or
+      returning False if it is invalid
+
+    Example:
+
+    {'name': Field(basestring, required=True, max_length=64),
+     'age': Field(int, min=0),
+     'address': Field(dict, schema={'city': Field(basestring)}),
+     'tags': Field(list, items=Field(basestring))}
+    '''
+
+    def __init__(self, type=None, required=False, null=False, min=None,
+                 max=None, min_length=None, max_length=None, choices=None,
+                 schema=None, items=None, validator=None):
+        self.type = type
+        self.required = required
+        self.null = null
+        self.min = min
+        self.max = max
+        self.min_length = min_length
+        self.max_length = max_length
+        self.choices = choices
+        self.schema = schema
+        self.items = items
+        self.validator = validator
+
+    def compile(self, path):
+        '''Return a function validating a value of this field, path is the
+        field name used in error messages.
+        '''
+        checks = []
+
+        if self.type is not None:
+            field_type = self.type
+            def check_type(value):
+                if not isinstance(value, field_type):
+                    raise ValidationError('%s: %r is not of type %s'
+                                          % (path, value, field_type))
+            checks.append(check_type)
+
+        if self.min is not None or self.max is not None:
+            minimum, maximum = self.min, self.max
+            def check_bounds(value):
+                if minimum is not None and value < minimum:
+                    raise ValidationError('%s: %r is lower than %r'
+                                          % (path, value, minimum))
+                if maximum is not None and value > maximum:
+                    raise ValidationError('%s: %r is greater than %r'
+                                          % (path, value, maximum))
+            checks.append(check_bounds)
+
+        if self.min_length is not None or self.max_length is not None:
+            min_length, max_length = self.min_length, self.max_length
+            def check_length(value):
+                length = len(value)
+                if min_length is not None and length < min_length:
+                    raise ValidationError('%s: length %d is lower than %d'
+                                          % (path, length, min_length))
+                if max_length is not None and length > max_length:
+                    raise ValidationError('%s: length %d is greater than %d'
+                                          % (path, length, max_length))
+            checks.append(check_length)
+
+        if self.choices is not None:
+            choices = frozenset(self.choices)
+            def check_choices(value):
+                if value not in choices:
+                    raise ValidationError('%s: %r is not in %r'
+                                          % (path, value, sorted(choices)))
+            checks.append(check_choices)
+
+        if self.schema is not None:
+            validators, required = compile_schema(self.schema, path=path)
+            def check_schema(value):
+                if not isinstance(value, dict):
+                    raise ValidationError('%s: %r is not a dict'
+                                          % (path, value))
+                for key in required:
+                    if key not in value:
+                        raise ValidationError('%s.%s is required'
+                                              % (path, key))
+                for key, item in value.iteritems():
+                    validator = validators.get(key)
+                    if validator is not None:
+                        validator(item)
+            checks.append(check_schema)
+
+        if self.items is not None:
+            check_item = self.items.compile(path + '[]')
+            def check_items(value):
+                if not isinstance(value, list):
+                    raise ValidationError('%s: %r is not a list'
+                                          % (path, value))
+                for item in value:
+                    check_item(item)
+            checks.append(check_items)
+
+        if self.validator is not None:
+            custom_validator = self.validator
+            def check_validator(value):
+                if custom_validator(value) is False:
+                    raise ValidationError('%s: %r is not valid'
+                                          % (path, value))
+            checks.append(check_validator)
+
+        null = self.null
+        if len(checks) == 1 and not null:
+            return checks[0]
+
+        def validate(value):
+            if value is None and null:
+                return
+            for check in checks:
+                check(value)
+        return validate
+
+def compile_schema(schema, required_fields=(), path=None):
+    '''Compile a dict of Fields, return a dict of validation functions by
+    field name and the tuple of required field names.
+    '''
+    validators = {}
+    required = list(required_fields)
+    for name, field in schema.iteritems():
+        validators[name] = field.compile('%s.%s' % (path, name) if path
+                                         else name)
+        if field.required and name not in required:
+            required.append(name)
+    return validators, tuple(required)
@@ -0,0 +1,181 @@
+'''Index synchronisation, use indexes.IndexManager to create the indexes
+declared by document classes.
+'''
+
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from document import DocumentMeta
+from utils import index_keys
+
+#Index options which only matter when the index is built (or to pymongo)
+_BUILD_OPTIONS = frozenset(['background', 'name', 'ttl', 'cache_for',
+                            'drop_dups', 'dropDups'])
+#Keys added by mongodb to index_information
+_INFORMATION_KEYS = frozenset(['key', 'v', 'ns'])
+
+def _index_name(keys):
+    return '_'.join('%s_%s' % key for key in keys)
+
+def _normalize_keys(keys):
+    return tuple((field, int(direction)
+                  if isinstance(direction, (int, long, float)) else direction)
+                 for field, direction in keys)
+
+def _index_options(options, ignored):
+    '''Options defining the index, False values are the defaults.
+    '''
+    return dict((name, value) for name, value in options.iteritems()
+                if name not in ignored and value is not False)
+
+class IndexChange(namedtuple('IndexChange',
+                             'action collection name keys options')):
+    '''A change of an index plan.
+
+    action is one of:
+    * 'create': the index is missing
+    * 'drop': the index is not declared anymore and will be dropped
+    * 'stale': the index is not declared anymore, it is only reported
+    * 'conflict': the index exists with other options (or another index
+      has its name), options are the declared ones
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        return '%s %s %s %r %r' % (self.action, self.collection.full_name,
+                                   self.name, list(self.keys), self.options)
+
+class IndexManager(object):
+    '''Synchronise the indexes of document classes with their collections.
+
+    Indexes are declared by document classes in 'indexes', see
+    Document.generate_index. By default all document classes declaring
+    indexes are managed, see DocumentMeta.registry.
+
+    Existing indexes are read first, so only missing indexes are created.
+    Collections are processed concurrently, using up to workers threads.
+
+    If drop is True, indexes no more declared are dropped, as well as
+    indexes conflicting with a declared one, which is then created again.
+    Otherwise they are only reported.
+
+    Example:
+    >>> manager = IndexManager()
+    >>> for change in manager.sync(dry_run=True):
+    ...     print change
+    '''
+
+    def __init__(self, documents=None, drop=False, workers=8):
+        self.documents = documents
+        self.drop = drop
+        self.workers = workers
+
+    def _collections(self):
+        '''Return declared indexes by collection, as an ordered dict:
+        (connection id, collection full name) -> (collection, specs).
+        '''
+        documents = self.documents
+        if documents is None:
+            documents = sorted(DocumentMeta.registry,
+                               key=lambda cls: (cls.__module__, cls.__name__))
+
+        collections = OrderedDict()
+        for document in documents:
+            if not document.indexes:
+                continue
+            col = document.col
+            key = (id(col.database.connection), col.full_name)
+            specs = collections.setdefault(key, (col, OrderedDict()))[1]
+            for index in document.indexes:
+                index = index.copy()
+                keys = _normalize_keys(index_keys(index.pop('fields')))
+                specs.setdefault(keys, index)
+        return collections
+
+    def _map(self, func, items):
+        if len(items) <= 1 or self.workers == 1:
+            return map(func, items)
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _plan_collection(self, collection):
+        col, specs = collection
+        existing = {}
+        for name, information in col.index_information().iteritems():
+            existing[_normalize_keys(information['key'])] = \
+                (name, _index_options(information, _INFORMATION_KEYS |
+                                      _BUILD_OPTIONS))
+        names = dict((name, keys) for keys, (name, _)
+                     in existing.iteritems())
+
+        drops, creates = [], []
+        for keys, options in specs.iteritems():
+            name = options.get('name') or _index_name(keys)
+            if keys in existing:
+                current_name, current = existing.pop(keys)
+                if current == _index_options(options, _BUILD_OPTIONS):
+                    continue
+                conflict = current_name
+            elif name in names:
+                conflict = name
+                existing.pop(names[name], None)
+            else:
+                creates.append(IndexChange('create', col, name, keys, options))
+                continue
+
+            if self.drop:
+                drops.append(IndexChange('drop', col, conflict,
+                                         names[conflict], {}))
+                creates.append(IndexChange('create', col, name, keys, options))
+            else:
+                drops.append(IndexChange('conflict', col, name, keys, options))
+
+        for keys, (name, options) in existing.iteritems():
+            if name == '_id_':
+                continue
+            drops.append(IndexChange('drop' if self.drop else 'stale', col,
+                                     name, keys, options))
+        return drops + creates
+
+    def plan(self):
+        '''Compare declared and existing indexes, return the list of
+        IndexChange needed.
+        '''
+        plans = self._map(self._plan_collection,
+                          self._collections().values())
+        return [change for changes in plans for change in changes]
+
+    @staticmethod
+    def _apply_collection(changes):
+        for change in changes:
+            if change.action == 'drop':
+                change.collection.drop_index(change.name)
+            elif change.action == 'create':
+                options = change.options.copy()
+                options.setdefault('background', True)
+                options['name'] = change.name
+                change.collection.create_index(list(change.keys), **options)
+
+    def apply(self, plan):
+        '''Apply the drop and create changes of a plan, stale and conflicting
+        indexes are left untouched.
+        '''
+        by_collection = OrderedDict()
+        for change in plan:
+            key = (id(change.collection.database.connection),
+                   change.collection.full_name)
+            by_collection.setdefault(key, []).append(change)
+        self._map(self._apply_collection, by_collection.values())
+
+    def sync(self, dry_run=False):
+        '''Plan the changes and apply them unless dry_run is True, return the
+        plan.
+        '''
+        plan = self.plan()
+        if not dry_run:
+            self.apply(plan)
+        return plan
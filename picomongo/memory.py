@@ -0,0 +1,1256 @@
+'''In memory backend, configure a 'memory://' uri (or 'memory://name' for
+distinct servers) to store documents in the current process instead of a
+mongodb server, for tests and benchmarks.
+
+It implements the subset of pymongo used by picomongo: find (with common
+query operators, projections, sort, skip and limit), find_one, insert, save,
+update, remove, find_and_modify, count, indexes (unique ones are enforced)
+and bulk operations. Writes are always acknowledged.
+
+Data lives as long as the process, shared by connections to the same uri,
+see clear.
+'''
+
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+import pymongo
+
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    InvalidOperation, OperationFailure
+from pymongo.read_preferences import ReadPreference
+
+from operators import _OPERATORS, apply_update
+
+SCHEME = 'memory://'
+
+#Server name -> {database name -> {collection name -> _Store}}, stores are
+#cleared in place, never removed, as collections keep a reference to them
+_servers = {}
+_servers_lock = threading.RLock()
+
+def is_memory_uri(uri):
+    return uri.startswith(SCHEME)
+
+def _server_name(uri):
+    return uri[len(SCHEME):].split('?')[0].rstrip('/')
+
+def clear(uri=None):
+    '''Drop all data of the memory server of uri, of all servers if None.
+    '''
+    with _servers_lock:
+        if uri is None:
+            servers = _servers.values()
+        else:
+            servers = [_servers.get(_server_name(uri), {})]
+        for databases in servers:
+            for collections in databases.itervalues():
+                for store in collections.itervalues():
+                    store.clear()
+
+#Values
+
+_RE_TYPE = type(re.compile(''))
+
+def _copy(value):
+    '''Copy documents, faster than deepcopy: other BSON values are
+    immutable.
+    '''
+    if isinstance(value, dict):
+        copy = dict(value)
+        for key, item in copy.iteritems():
+            if isinstance(item, (dict, list)):
+                copy[key] = _copy(item)
+        return copy
+    if isinstance(value, list):
+        return [_copy(item) if isinstance(item, (dict, list)) else item
+                for item in value]
+    return value
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return ('$dict',) + tuple((key, _hashable(item)) for key, item
+                                  in sorted(value.iteritems()))
+    if isinstance(value, list):
+        return ('$list',) + tuple(_hashable(item) for item in value)
+    return value
+
+def _bracket(value):
+    '''Return the rank of the type of value in the BSON comparison order,
+    values of different types never match comparison operators.
+    '''
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+def _values(document, path):
+    '''Return the values of a dotted path in document, arrays of documents
+    being traversed. The list is empty if the field is missing.
+    '''
+    values = [document]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit():
+                    if int(key) < len(value):
+                        found.append(value[int(key)])
+                else:
+                    found.extend(item[key] for item in value
+                                 if isinstance(item, dict) and key in item)
+        values = found
+    return values
+
+def _candidates(values):
+    '''Return values and the elements of array values, which all match
+    equality conditions.
+    '''
+    for value in values:
+        if isinstance(value, list):
+            break
+    else:
+        return values
+    candidates = list(values)
+    for value in values:
+        if isinstance(value, list):
+            candidates.extend(value)
+    return candidates
+
+#Queries, compiled once to a predicate on stored documents
+
+def _regex(condition):
+    if isinstance(condition, Regex):
+        return condition.try_compile()
+    return condition
+
+_REGEX_FLAGS = {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}
+
+def _equality(condition):
+    '''Return the test of values equal to condition (or matching it if it
+    is a regular expression).
+    '''
+    condition = _regex(condition)
+    if isinstance(condition, _RE_TYPE):
+        search = condition.search
+        return lambda values: any(isinstance(value, basestring) and
+                                  search(value)
+                                  for value in _candidates(values))
+    if condition is None:
+        return lambda values: not values or \
+            any(value is None for value in _candidates(values))
+
+    is_bool = isinstance(condition, bool)
+    def test(values):
+        for value in _candidates(values):
+            if value == condition and isinstance(value, bool) == is_bool:
+                return True
+        return False
+    return test
+
+def _comparison(compare):
+    def operator(condition):
+        bracket = _bracket(condition)
+        def test(values):
+            for value in _candidates(values):
+                #Values of other types never match, nor are compared
+                if _bracket(value) == bracket and compare(value, condition):
+                    return True
+            return False
+        return test
+    return operator
+
+def _in(condition):
+    tests = [_equality(item) for item in condition]
+    return lambda values: any(test(values) for test in tests)
+
+def _nin(condition):
+    test = _in(condition)
+    return lambda values: not test(values)
+
+def _ne(condition):
+    test = _equality(condition)
+    return lambda values: not test(values)
+
+def _all(condition):
+    tests = [_equality(item) for item in condition]
+    return lambda values: bool(tests) and all(test(values) for test in tests)
+
+def _exists(condition):
+    return lambda values: bool(values) == bool(condition)
+
+def _size(condition):
+    return lambda values: any(isinstance(value, list) and
+                              len(value) == condition for value in values)
+
+def _elem_match(condition):
+    if _is_operator_dict(condition):
+        item_test = _compile_condition(condition)
+        matches = lambda item: item_test([item])
+    else:
+        query = compile_query(condition)
+        matches = lambda item: isinstance(item, dict) and query(item)
+    return lambda values: any(isinstance(value, list) and
+                              any(matches(item) for item in value)
+                              for value in values)
+
+def _not(condition):
+    test = _compile_condition(condition)
+    return lambda values: not test(values)
+
+def _mod(condition):
+    divisor, remainder = condition
+    return lambda values: any(isinstance(value, (int, long, float)) and
+                              not isinstance(value, bool) and
+                              value % divisor == remainder
+                              for value in _candidates(values))
+
+#BSON type numbers of $type, by comparison bracket
+_TYPE_BRACKETS = {1: 2, 16: 2, 18: 2, 2: 3, 3: 4, 4: 5, 7: 7, 8: 8, 9: 9,
+                  10: 1}
+
+def _type(condition):
+    bracket = _TYPE_BRACKETS.get(condition)
+    return lambda values: any(_bracket(value) == bracket
+                              for value in _candidates(values))
+
+#Operator -> function returning the test of values for its argument
+_QUERY_OPERATORS = {
+    '$eq': _equality,
+    '$ne': _ne,
+    '$gt': _comparison(lambda value, condition: value > condition),
+    '$gte': _comparison(lambda value, condition: value >= condition),
+    '$lt': _comparison(lambda value, condition: value < condition),
+    '$lte': _comparison(lambda value, condition: value <= condition),
+    '$in': _in,
+    '$nin': _nin,
+    '$all': _all,
+    '$exists': _exists,
+    '$size': _size,
+    '$elemMatch': _elem_match,
+    '$not': _not,
+    '$mod': _mod,
+    '$type': _type,
+}
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and \
+        all(key.startswith('$') for key in value)
+
+def _compile_condition(condition):
+    '''Return the test of the values of a field for a query condition.
+    '''
+    if not _is_operator_dict(condition):
+        return _equality(condition)
+
+    tests = []
+    for operator, argument in condition.iteritems():
+        if operator == '$options':
+            continue
+        if operator == '$regex':
+            if isinstance(argument, basestring):
+                flags = 0
+                for option in condition.get('$options', ''):
+                    flags |= _REGEX_FLAGS.get(option, 0)
+                argument = re.compile(argument, flags)
+            tests.append(_equality(argument))
+        elif operator in _QUERY_OPERATORS:
+            tests.append(_QUERY_OPERATORS[operator](argument))
+        else:
+            raise OperationFailure('Unsupported query operator %s'
+                                   % operator)
+    if len(tests) == 1:
+        return tests[0]
+    return lambda values: all(test(values) for test in tests)
+
+def _compile_field(path, condition):
+    test = _compile_condition(condition)
+    if '.' in path:
+        return lambda document: test(_values(document, path))
+    return lambda document: test([document[path]] if path in document
+                                 else [])
+
+def compile_query(spec):
+    '''Return a function testing if a document matches the query spec.
+    '''
+    tests = []
+    for field, condition in spec.iteritems():
+        if field in ('$and', '$or', '$nor'):
+            queries = [compile_query(query) for query in condition]
+            if field == '$and':
+                tests.append(lambda document, queries=queries:
+                             all(query(document) for query in queries))
+            elif field == '$or':
+                tests.append(lambda document, queries=queries:
+                             any(query(document) for query in queries))
+            else:
+                tests.append(lambda document, queries=queries:
+                             not any(query(document) for query in queries))
+        elif field == '$comment':
+            continue
+        elif field.startswith('$'):
+            raise OperationFailure('Unsupported query operator %s' % field)
+        else:
+            tests.append(_compile_field(field, condition))
+
+    if not tests:
+        return lambda document: True
+    if len(tests) == 1:
+        return tests[0]
+    def query(document):
+        for test in tests:
+            if not test(document):
+                return False
+        return True
+    return query
+
+def match(document, spec):
+    '''Return True if document matches the query spec.
+    '''
+    return compile_query(spec)(document)
+
+def _id_condition(spec):
+    '''Return the _id values a query is restricted to, None if it is not.
+    '''
+    if '_id' not in spec:
+        return None
+    condition = spec['_id']
+    if isinstance(condition, dict):
+        if len(condition) == 1 and '$in' in condition:
+            return condition['$in']
+        if any(key.startswith('$') for key in condition):
+            return None
+    elif isinstance(condition, (list, _RE_TYPE, Regex)):
+        return None
+    return [condition]
+
+#Sort and projection
+
+def _sort_list(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or pymongo.ASCENDING)]
+    return [tuple(key) for key in key_or_list]
+
+def _sort_key(document, field, direction):
+    values = _values(document, field)
+    if not values:
+        value = None
+    else:
+        value = values[0]
+        if isinstance(value, list) and value:
+            keys = [(_bracket(item), item) for item in value]
+            return min(keys) if direction == pymongo.ASCENDING else max(keys)
+    return (_bracket(value), value)
+
+def _sort(documents, keys):
+    for field, direction in reversed(keys):
+        documents.sort(key=lambda document: _sort_key(document, field,
+                                                      direction),
+                       reverse=direction == pymongo.DESCENDING)
+    return documents
+
+def _include(result, document, path):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if not isinstance(document, dict) or \
+                not isinstance(document.get(key), dict):
+            return
+        document = document[key]
+        result = result.setdefault(key, {})
+    if isinstance(document, dict) and keys[-1] in document:
+        result[keys[-1]] = _copy(document[keys[-1]])
+
+def _exclude(document, path):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(keys[-1], None)
+
+def _project(document, fields):
+    '''Return a copy of document with only the fields of a projection.
+    '''
+    if fields is None:
+        return _copy(document)
+    if not isinstance(fields, dict):
+        fields = dict((field, 1) for field in fields)
+
+    included = [field for field, value in fields.iteritems()
+                if value and field != '_id']
+    if included:
+        result = {}
+        if fields.get('_id', 1) and '_id' in document:
+            result['_id'] = _copy(document['_id'])
+        for field in included:
+            _include(result, document, field)
+        return result
+
+    result = _copy(document)
+    for field, value in fields.iteritems():
+        if not value:
+            _exclude(result, field)
+    return result
+
+#Updates
+
+def _unset(document, path):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if isinstance(document, list) and key.isdigit():
+            document = document[int(key)] if int(key) < len(document) \
+                else None
+        elif isinstance(document, dict):
+            document = document.get(key)
+        if document is None:
+            return
+    if isinstance(document, dict):
+        document.pop(keys[-1], None)
+    elif isinstance(document, list) and keys[-1].isdigit() and \
+            int(keys[-1]) < len(document):
+        document[int(keys[-1])] = None
+
+def _pull(document, path, condition):
+    if _is_operator_dict(condition):
+        test = _compile_condition(condition)
+        matches = lambda value: test([value])
+    elif isinstance(condition, dict):
+        query = compile_query(condition)
+        matches = lambda value: isinstance(value, dict) and query(value)
+    else:
+        matches = lambda value: value == condition
+    for values in _values(document, path):
+        if isinstance(values, list):
+            values[:] = [value for value in values if not matches(value)]
+
+def _update(document, update, insert=False):
+    '''Apply the operators of update to document.
+    '''
+    for operator, values in update.iteritems():
+        if any(path == '_id' or path.startswith('_id.') for path in values) \
+                and operator != '$setOnInsert':
+            raise OperationFailure("Mod on _id not allowed")
+        if operator == '$setOnInsert':
+            if insert:
+                apply_update(document, {'$set': values})
+        elif operator == '$unset':
+            for path in values:
+                _unset(document, path)
+        elif operator == '$pull':
+            for path, condition in values.iteritems():
+                _pull(document, path, condition)
+        elif operator in _OPERATORS:
+            apply_update(document, {operator: values})
+        else:
+            raise OperationFailure('Unsupported update operator %s'
+                                   % operator)
+
+def _upsert_document(spec):
+    '''Return the document inserted by an upsert of spec, before its update.
+    '''
+    document = {}
+    for field, value in spec.iteritems():
+        if field.startswith('$') or _is_operator_dict(value):
+            continue
+        apply_update(document, {'$set': {field: _copy(value)}})
+    return document
+
+#Indexes
+
+def _index_name(keys):
+    return '_'.join('%s_%s' % key for key in keys)
+
+class _Index(object):
+
+    def __init__(self, name, keys, options):
+        self.name = name
+        self.keys = keys
+        self.options = options
+        self.unique = bool(options.get('unique'))
+        self.sparse = bool(options.get('sparse'))
+        #Unique keys -> _id
+        self.entries = {}
+
+    def key(self, document):
+        '''Return the key of document, None if a sparse index skips it.
+        '''
+        values = [_values(document, field) for field, _ in self.keys]
+        if self.sparse and not any(values):
+            return None
+        return tuple(_hashable(value[0] if value else None)
+                     for value in values)
+
+    def information(self, namespace):
+        information = {'key': list(self.keys), 'v': 1, 'ns': namespace}
+        information.update(self.options)
+        return information
+
+class _Store(object):
+    '''Documents and indexes of a collection.
+    '''
+
+    def __init__(self):
+        #Hashable _id -> document, stored documents are never modified
+        self.documents = OrderedDict()
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __nonzero__(self):
+        return bool(self.documents or self.indexes)
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+            self.indexes.clear()
+
+#Pymongo API
+
+class MemoryConnection(object):
+    '''Connection to the memory server named by a 'memory://name' uri.
+    '''
+
+    def __init__(self, uri=SCHEME, max_pool_size=100, document_class=dict,
+                 **kwargs):
+        self.uri = uri
+        self.name = _server_name(uri)
+        self.max_pool_size = max_pool_size
+        self.document_class = document_class
+
+    def _databases(self):
+        with _servers_lock:
+            return _servers.setdefault(self.name, {})
+
+    def __getitem__(self, name):
+        return MemoryDatabase(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __repr__(self):
+        return 'MemoryConnection(%r)' % self.uri
+
+    def database_names(self):
+        with _servers_lock:
+            return [name for name, collections
+                    in self._databases().iteritems()
+                    if any(collections.values())]
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        with _servers_lock:
+            for store in self._databases().get(name, {}).itervalues():
+                store.clear()
+
+    def disconnect(self):
+        pass
+
+    close = disconnect
+
+class MemoryDatabase(object):
+
+    #Read options, set by the connection manager
+    read_preference = ReadPreference.PRIMARY
+    tag_sets = [{}]
+    secondary_acceptable_latency_ms = 15
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def _collections(self):
+        with _servers_lock:
+            return self.connection._databases().setdefault(self.name, {})
+
+    def _store(self, name):
+        collections = self._collections()
+        store = collections.get(name)
+        if store is None:
+            with _servers_lock:
+                store = collections.setdefault(name, _Store())
+        return store
+
+    def __getitem__(self, name):
+        return MemoryCollection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryDatabase) and \
+            (self.connection.name, self.name) == \
+            (other.connection.name, other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MemoryDatabase(%r, %r)' % (self.connection, self.name)
+
+    def collection_names(self, include_system_collections=True):
+        with _servers_lock:
+            return [name for name, store in self._collections().iteritems()
+                    if store]
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        self._store(name).clear()
+
+class MemoryCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._store = database._store(name)
+
+    def __getitem__(self, name):
+        return MemoryCollection(self.database, '%s.%s' % (self.name, name))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryCollection) and \
+            (self.database, self.name) == (other.database, other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MemoryCollection(%r, %r)' % (self.database, self.name)
+
+    #Reads
+
+    def _scan(self, spec):
+        '''Return the stored documents spec may match, the lock being held:
+        queries on _id only look their documents up.
+        '''
+        documents = self._store.documents
+        ids = _id_condition(spec)
+        if ids is None:
+            return documents.values()
+        found = []
+        for _id in ids:
+            document = documents.get(_hashable(_id))
+            if document is not None:
+                found.append(document)
+        return found
+
+    def _matching(self, spec, documents=None):
+        if documents is None:
+            documents = self._scan(spec)
+        if len(spec) == 1 and _id_condition(spec) is not None:
+            #Looked up by _id
+            return documents
+        query = compile_query(spec)
+        return [document for document in documents if query(document)]
+
+    def _find(self, spec):
+        '''Return the stored documents matching spec, and the number of
+        documents scanned.
+        '''
+        with self._store.lock:
+            documents = self._scan(spec)
+        return self._matching(spec, documents), len(documents)
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for document in self.find(spec_or_id, *args, **kwargs).limit(-1):
+            return document
+        return None
+
+    def count(self):
+        return len(self._store.documents)
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    #Writes
+
+    def _check_unique(self, document, previous=None):
+        '''Raise a DuplicateKeyError if document (replacing previous)
+        violates a unique index.
+        '''
+        store = self._store
+        key = _hashable(document['_id'])
+        if (previous is None or _hashable(previous['_id']) != key) and \
+                key in store.documents:
+            raise DuplicateKeyError('E11000 duplicate key error index: '
+                                    '%s.$_id_ dup key: { : %r }'
+                                    % (self.full_name, document['_id']),
+                                    11000)
+        for index in store.indexes.itervalues():
+            if not index.unique:
+                continue
+            index_key = index.key(document)
+            owner = index.entries.get(index_key)
+            if index_key is not None and owner is not None and \
+                    owner != key:
+                raise DuplicateKeyError('E11000 duplicate key error index: '
+                                        '%s.$%s dup key: %r'
+                                        % (self.full_name, index.name,
+                                           index_key), 11000)
+
+    def _write(self, document, previous=None):
+        '''Store document, in place of previous if given, the lock being
+        held.
+        '''
+        store = self._store
+        self._check_unique(document, previous)
+        key = _hashable(document['_id'])
+        if previous is not None:
+            self._unindex(previous)
+        #Replacing keeps the document position in natural order
+        store.documents[key] = document
+        for index in store.indexes.itervalues():
+            if index.unique:
+                index_key = index.key(document)
+                if index_key is not None:
+                    index.entries[index_key] = key
+
+    def _unindex(self, document):
+        '''Remove the unique index entries of a stored document.
+        '''
+        key = _hashable(document['_id'])
+        for index in self._store.indexes.itervalues():
+            if index.unique:
+                index_key = index.key(document)
+                if index.entries.get(index_key) == key:
+                    del index.entries[index_key]
+
+    def _delete(self, document):
+        self._unindex(document)
+        self._store.documents.pop(_hashable(document['_id']), None)
+
+    def insert(self, doc_or_docs, manipulate=True, safe=None,
+               check_keys=True, continue_on_error=False, **kwargs):
+        many = isinstance(doc_or_docs, list)
+        documents = doc_or_docs if many else [doc_or_docs]
+        ids = []
+        error = None
+        with self._store.lock:
+            for document in documents:
+                if '_id' not in document:
+                    document['_id'] = ObjectId()
+                try:
+                    self._write(_copy(document))
+                except DuplicateKeyError as duplicate:
+                    if not continue_on_error:
+                        raise
+                    error = duplicate
+                ids.append(document['_id'])
+        if error is not None:
+            raise error
+        return ids if many else ids[0]
+
+    def save(self, to_save, manipulate=True, safe=None, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save, manipulate)
+        self.update({'_id': to_save['_id']}, to_save, upsert=True)
+        return to_save['_id']
+
+    def _updated(self, previous, document, insert=False):
+        '''Return the new version of a stored document (None for an upsert)
+        updated by document (operators or a replacement).
+        '''
+        if document and all(key.startswith('$') for key in document):
+            new = _copy(previous) if previous is not None else {}
+            _update(new, document, insert)
+            return new
+        if any(key.startswith('$') for key in document):
+            raise OperationFailure('Cannot mix operators and fields in an '
+                                   'update')
+        new = _copy(document)
+        if previous is not None:
+            if '_id' in new and new['_id'] != previous['_id']:
+                raise OperationFailure("The _id field cannot be changed")
+            new['_id'] = previous['_id']
+        return new
+
+    def _upsert(self, spec, document):
+        '''Insert the document of an upsert, return its _id.
+        '''
+        operators = document and all(key.startswith('$') for key in document)
+        new = self._updated(_upsert_document(spec), document, True) \
+            if operators else self._updated(None, document)
+        if '_id' not in new:
+            _id = spec.get('_id')
+            new['_id'] = _id if _id is not None and \
+                not isinstance(_id, dict) else ObjectId()
+        self._write(new)
+        return new
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=None, multi=False, check_keys=True, **kwargs):
+        with self._store.lock:
+            documents = self._matching(spec)
+            if not multi:
+                documents = documents[:1]
+            for previous in documents:
+                self._write(self._updated(previous, document), previous)
+
+            result = {'ok': 1.0, 'err': None, 'n': len(documents),
+                      'updatedExisting': bool(documents)}
+            if upsert and not documents:
+                result['upserted'] = self._upsert(spec, document)['_id']
+                result['n'] = 1
+        return result
+
+    def remove(self, spec_or_id=None, safe=None, multi=True, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        elif not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self._store.lock:
+            documents = self._matching(spec_or_id)
+            if not multi:
+                documents = documents[:1]
+            for document in documents:
+                self._delete(document)
+        return {'ok': 1.0, 'err': None, 'n': len(documents)}
+
+    def find_and_modify(self, query={}, update=None, upsert=False, sort=None,
+                        full_response=False, manipulate=False, new=False,
+                        fields=None, remove=False, **kwargs):
+        if update is None and not remove:
+            raise ValueError('Must either update or remove')
+        with self._store.lock:
+            documents = self._matching(query or {})
+            if sort:
+                documents = _sort(documents, _sort_list(sort))
+
+            if not documents:
+                result = None
+                if upsert and not remove:
+                    inserted = self._upsert(query or {}, update)
+                    result = inserted if new else None
+            else:
+                previous = documents[0]
+                if remove:
+                    self._delete(previous)
+                    result = previous
+                else:
+                    updated = self._updated(previous, update)
+                    self._write(updated, previous)
+                    result = updated if new else previous
+        if result is not None:
+            result = _project(result, fields)
+        if full_response:
+            return {'ok': 1.0, 'value': result}
+        return result
+
+    #Indexes
+
+    def create_index(self, key_or_list, cache_for=300, **kwargs):
+        keys = _sort_list(key_or_list)
+        kwargs.pop('ttl', None)
+        if 'drop_dups' in kwargs:
+            kwargs['dropDups'] = kwargs.pop('drop_dups')
+        name = kwargs.pop('name', None) or _index_name(keys)
+
+        store = self._store
+        with store.lock:
+            existing = store.indexes.get(name)
+            if existing is not None:
+                if existing.keys != keys:
+                    raise OperationFailure('Index with name: %s already '
+                                           'exists with different options'
+                                           % name, 85)
+                return name
+
+            index = _Index(name, keys, kwargs)
+            if index.unique:
+                for document in store.documents.itervalues():
+                    index_key = index.key(document)
+                    if index_key is None:
+                        continue
+                    if index_key in index.entries:
+                        raise DuplicateKeyError(
+                            'E11000 duplicate key error index: %s.$%s dup '
+                            'key: %r' % (self.full_name, name, index_key),
+                            11000)
+                    index.entries[index_key] = _hashable(document['_id'])
+            store.indexes[name] = index
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        information = {'_id_': {'key': [('_id', 1)], 'v': 1,
+                                'ns': self.full_name}}
+        with self._store.lock:
+            for name, index in self._store.indexes.iteritems():
+                information[name] = index.information(self.full_name)
+        return information
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = _index_name(_sort_list(index_or_name))
+        with self._store.lock:
+            if self._store.indexes.pop(name, None) is None:
+                raise OperationFailure('index not found with name [%s]'
+                                       % name, 27)
+
+    def drop_indexes(self):
+        with self._store.lock:
+            self._store.indexes.clear()
+
+    def drop(self):
+        self._store.clear()
+
+    #Bulk operations
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulkOperation(self, ordered=True)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulkOperation(self, ordered=False)
+
+class MemoryCursor(object):
+    '''Cursor on query results, documents are matched and sorted on first
+    read and copied when they are returned.
+    '''
+
+    def __init__(self, collection, spec=None, fields=None, skip=0, limit=0,
+                 timeout=True, snapshot=False, tailable=False, sort=None,
+                 max_scan=None, **kwargs):
+        if spec is None:
+            spec = {}
+        if not isinstance(spec, dict):
+            raise TypeError('spec must be an instance of dict')
+        self.collection = collection
+        #Same attributes as pymongo cursors, see cursor._query
+        self._Cursor__spec = spec
+        self._Cursor__fields = fields
+        self._Cursor__ordering = OrderedDict(_sort_list(sort)) if sort \
+            else None
+
+        self._skip = skip
+        self._limit = limit
+        self._max_scan = max_scan
+        self._hint = None
+        self._where = None
+        self._batch_size = 0
+        self._comment = None
+
+        self._results = None
+        self._position = 0
+        self._scanned = 0
+        self._killed = False
+
+    def _check_okay_to_chain(self):
+        if self._results is not None:
+            raise InvalidOperation('cannot set options after executing query')
+
+    def _query(self):
+        '''Return the matching stored documents, sorted, skipped and
+        limited.
+        '''
+        if self._where is not None:
+            raise OperationFailure('$where is not supported by the memory '
+                                   'backend')
+        hint = self._hint
+        if isinstance(hint, basestring) and hint != '_id_' and \
+                hint not in self.collection._store.indexes:
+            raise OperationFailure('bad hint')
+
+        documents, self._scanned = self.collection._find(self._Cursor__spec)
+        if self._max_scan:
+            documents = documents[:self._max_scan]
+        ordering = self._Cursor__ordering
+        if ordering:
+            documents = _sort(documents, ordering.items())
+        documents = documents[self._skip:]
+        if self._limit:
+            documents = documents[:abs(self._limit)]
+        return documents
+
+    def _refresh(self):
+        if self._results is None:
+            self._results = self._query()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._killed:
+            raise StopIteration()
+        self._refresh()
+        if self._position >= len(self._results):
+            self._killed = True
+            raise StopIteration()
+        document = self._results[self._position]
+        self._position += 1
+        return _project(document, self._Cursor__fields)
+
+    __next__ = next
+
+    def __getitem__(self, index):
+        self._check_okay_to_chain()
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise IndexError('Cursor instances do not support slice '
+                                 'steps')
+            start = index.start or 0
+            self._skip += start
+            if index.stop is not None:
+                self._limit = max(index.stop - start, 0)
+                if not self._limit:
+                    self._killed = True
+            return self
+        if index < 0:
+            raise IndexError('Cursor instances do not support negative '
+                             'indices')
+        clone = self.clone()
+        clone.skip(index + self._skip)
+        clone.limit(-1)
+        for document in clone:
+            return document
+        raise IndexError('no such item for Cursor instance')
+
+    @property
+    def alive(self):
+        return not self._killed
+
+    def close(self):
+        self._killed = True
+        self._results = None
+
+    def rewind(self):
+        self._results = None
+        self._position = 0
+        self._killed = False
+        return self
+
+    def clone(self):
+        clone = MemoryCursor(self.collection, self._Cursor__spec,
+                             self._Cursor__fields, self._skip, self._limit,
+                             max_scan=self._max_scan)
+        clone._Cursor__ordering = self._Cursor__ordering
+        clone._hint = self._hint
+        clone._where = self._where
+        clone._batch_size = self._batch_size
+        clone._comment = self._comment
+        return clone
+
+    def limit(self, limit):
+        if not isinstance(limit, (int, long)):
+            raise TypeError('limit must be an integer')
+        self._check_okay_to_chain()
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        if not isinstance(skip, (int, long)):
+            raise TypeError('skip must be an integer')
+        if skip < 0:
+            raise ValueError('skip must be >= 0')
+        self._check_okay_to_chain()
+        self._skip = skip
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self._check_okay_to_chain()
+        self._Cursor__ordering = OrderedDict(_sort_list(key_or_list,
+                                                        direction))
+        return self
+
+    def hint(self, index):
+        self._check_okay_to_chain()
+        self._hint = index
+        return self
+
+    def batch_size(self, batch_size):
+        if not isinstance(batch_size, (int, long)):
+            raise TypeError('batch_size must be an integer')
+        if batch_size < 0:
+            raise ValueError('batch_size must be >= 0')
+        self._check_okay_to_chain()
+        self._batch_size = batch_size
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self._check_okay_to_chain()
+        return self
+
+    def max_scan(self, max_scan):
+        self._check_okay_to_chain()
+        self._max_scan = max_scan
+        return self
+
+    def where(self, code):
+        self._check_okay_to_chain()
+        self._where = code
+        return self
+
+    def comment(self, comment):
+        self._check_okay_to_chain()
+        self._comment = comment
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self.clone()._query())
+        documents, _ = self.collection._find(self._Cursor__spec)
+        return len(documents)
+
+    def distinct(self, key):
+        seen = set()
+        values = []
+        for document in self.clone()._query():
+            for value in _candidates(_values(document, key)):
+                hashable = _hashable(value)
+                if hashable not in seen:
+                    seen.add(hashable)
+                    values.append(value)
+        return values
+
+    def explain(self):
+        '''Return a (MongoDB 2.x like) explain of the query: _id lookups
+        and queries on the first field of an index report the index.
+        '''
+        start = time.time()
+        documents = self.clone()._query()
+        spec = self._Cursor__spec
+
+        index = '_id_' if _id_condition(spec) is not None else None
+        if index is None:
+            fields = set(field.split('.')[0] for field in spec)
+            index = next((name for name, value
+                          in self.collection._store.indexes.iteritems()
+                          if value.keys[0][0] in fields), None)
+        scanned = self.collection.count() if index is None \
+            else len(documents)
+        return {'cursor': 'BtreeCursor %s' % index if index
+                else 'BasicCursor',
+                'n': len(documents), 'nscanned': scanned,
+                'nscannedObjects': scanned,
+                'millis': int((time.time() - start) * 1000)}
+
+class _BulkFinder(object):
+
+    def __init__(self, bulk, selector):
+        self._bulk = bulk
+        self._selector = selector
+        self._upsert = False
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def _add(self, operation, document, multi=False):
+        self._bulk._add((operation, self._selector, document, self._upsert,
+                         multi))
+
+    def update(self, update):
+        self._add('update', update, multi=True)
+
+    def update_one(self, update):
+        self._add('update', update)
+
+    def replace_one(self, document):
+        self._add('update', document)
+
+    def remove(self):
+        self._add('remove', None, multi=True)
+
+    def remove_one(self):
+        self._add('remove', None)
+
+class MemoryBulkOperation(object):
+
+    def __init__(self, collection, ordered=True):
+        self.collection = collection
+        self.ordered = ordered
+        self._operations = []
+        self._executed = False
+
+    def _add(self, operation):
+        if self._executed:
+            raise InvalidOperation('Bulk operations can only be executed '
+                                   'once.')
+        self._operations.append(operation)
+
+    def insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self._add(('insert', None, document, False, False))
+
+    def find(self, selector):
+        if not isinstance(selector, dict):
+            raise TypeError('selector must be an instance of dict')
+        return _BulkFinder(self, selector)
+
+    def execute(self, write_concern=None):
+        if not self._operations:
+            raise InvalidOperation('No operations to execute')
+        if self._executed:
+            raise InvalidOperation('Bulk operations can only be executed '
+                                   'once.')
+        self._executed = True
+
+        collection = self.collection
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': [],
+                  'writeErrors': [], 'writeConcernErrors': []}
+        for position, (operation, selector, document, upsert, multi) \
+                in enumerate(self._operations):
+            try:
+                if operation == 'insert':
+                    collection.insert(document)
+                    result['nInserted'] += 1
+                elif operation == 'remove':
+                    result['nRemoved'] += collection.remove(selector,
+                                                            multi=multi)['n']
+                else:
+                    written = collection.update(selector, document, upsert,
+                                                multi=multi)
+                    if 'upserted' in written:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': position, '_id': written['upserted']})
+                    else:
+                        result['nMatched'] += written['n']
+                        result['nModified'] += written['n']
+            except OperationFailure as error:
+                result['writeErrors'].append(
+                    {'index': position, 'code': error.code or 2,
+                     'errmsg': str(error), 'op': document or selector})
+                if self.ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
@@ -0,0 +1,236 @@
+'''Monitoring module, register listeners to get an OperationEvent for each
+database operation of documents.
+'''
+
+import logging
+import socket
+import sys
+import threading
+import time
+
+from collections import deque, namedtuple
+from functools import wraps
+
+from connection_manager import ConnectionManager
+from utils import _class_name
+
+logger = logging.getLogger('picomongo')
+
+#Registered listeners, replaced (never modified) when listeners change
+_listeners = ()
+_listeners_lock = threading.Lock()
+
+class OperationEvent(namedtuple('OperationEvent',
+                                'document_class config_name collection '
+                                'operation duration documents bytes error '
+                                'query')):
+    '''A database operation of a document class.
+
+    duration is in seconds, documents is the number of documents returned
+    or written and bytes their BSON size, when known (None otherwise).
+    error is the exception raised by the operation, None if it succeeded.
+    query is a dict of the 'spec', 'sort' and 'fields' of find and find_one,
+    None for other operations.
+    '''
+    __slots__ = ()
+
+def register(listener):
+    '''Call listener with the OperationEvent of each operation, in the thread
+    running the operation. Errors raised by listeners are logged and
+    ignored.
+    '''
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+def unregister(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(registered for registered in _listeners
+                           if registered != listener)
+
+def enabled():
+    '''Return True if a listener is registered.
+    '''
+    return bool(_listeners)
+
+def _collection(document_class):
+    try:
+        return document_class.col.full_name
+    except Exception:
+        return None
+
+def publish(document_class, operation, duration, documents=None, bytes=None,
+            error=None, query=None, slow_log=None):
+    '''Send an OperationEvent to the listeners, and to slow_log (the
+    slowlog.SlowLog of the document class) if given.
+    '''
+    listeners = _listeners
+    if slow_log is not None:
+        listeners += (slow_log,)
+    if not listeners:
+        return
+    event = OperationEvent(document_class,
+                           document_class.config_name or
+                           _class_name(document_class),
+                           _collection(document_class), operation, duration,
+                           documents, bytes, error, query)
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            logger.exception('Monitoring listener %r failed', listener)
+
+def instrumented(operation, documents=None, bytes=None, query=None):
+    '''Decorator of document methods (and classmethods) publishing an event
+    for each call, when listeners are registered.
+
+    documents and bytes are functions computing the corresponding event
+    fields from the document class or instance and the method result.
+    query computes the event query from the method arguments (args and
+    kwargs), it makes the method a query whose events are also sent to the
+    slow log of the document class.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(owner, *args, **kwargs):
+            slow_log = owner._slow_log if query is not None and \
+                ConnectionManager.slow_log_configured else None
+            if not _listeners and slow_log is None:
+                return func(owner, *args, **kwargs)
+
+            document_class = owner if isinstance(owner, type) \
+                else owner.__class__
+            start = time.time()
+            try:
+                result = func(owner, *args, **kwargs)
+            except Exception:
+                exc_info = sys.exc_info()
+                publish(document_class, operation, time.time() - start,
+                        error=exc_info[1], slow_log=slow_log)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            duration = time.time() - start
+
+            publish(document_class, operation, duration,
+                    documents(owner, result) if documents else None,
+                    bytes(owner, result) if bytes else None,
+                    query=query(args, kwargs) if query else None,
+                    slow_log=slow_log)
+            return result
+        return wrapper
+    return decorator
+
+def _quantile(ordered, quantile):
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+class _Series(object):
+
+    def __init__(self, samples):
+        self.durations = deque(maxlen=samples)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.documents = 0
+
+class HistogramCollector(object):
+    '''Listener keeping the durations of operations, by document class and
+    operation, to compute their percentiles.
+
+    Percentiles are computed over the last samples operations, counters
+    cover all operations.
+
+    Example:
+    >>> collector = HistogramCollector()
+    >>> monitoring.register(collector)
+    >>> collector.stats()[('UserDocument', 'find_one')]['p99']
+    0.0021
+    '''
+
+    QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+    def __init__(self, samples=1024):
+        self.samples = samples
+        #(class name, operation) -> _Series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.document_class.__name__, event.operation)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.samples)
+            series.durations.append(event.duration)
+            series.count += 1
+            series.total += event.duration
+            if event.documents:
+                series.documents += event.documents
+            if event.error is not None:
+                series.errors += 1
+
+    def stats(self):
+        '''Return, by (class name, operation), the count, errors, documents,
+        total duration and duration percentiles (p50, p95, p99) of
+        operations, in seconds.
+        '''
+        with self._lock:
+            series = [(key, list(value.durations), value.count, value.errors,
+                       value.documents, value.total)
+                      for key, value in self._series.iteritems()]
+
+        stats = {}
+        for key, durations, count, errors, documents, total in series:
+            durations.sort()
+            stats[key] = dict((name, _quantile(durations, quantile))
+                              for name, quantile in self.QUANTILES)
+            stats[key].update({'count': count, 'errors': errors,
+                               'documents': documents, 'total': total})
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def prometheus(self, name='picomongo_operation_seconds'):
+        '''Return the collected statistics in the Prometheus text format, as
+        a summary.
+        '''
+        lines = ['# HELP %s Duration of picomongo operations.' % name,
+                 '# TYPE %s summary' % name]
+        errors = []
+        for (document, operation), stats in sorted(self.stats().iteritems()):
+            labels = 'document="%s",operation="%s"' % (document, operation)
+            for quantile_name, quantile in self.QUANTILES:
+                lines.append('%s{%s,quantile="%s"} %r'
+                             % (name, labels, quantile, stats[quantile_name]))
+            lines.append('%s_sum{%s} %r' % (name, labels, stats['total']))
+            lines.append('%s_count{%s} %d' % (name, labels, stats['count']))
+            errors.append('%s_errors_total{%s} %d'
+                          % (name, labels, stats['errors']))
+        if errors:
+            lines.append('# TYPE %s_errors_total counter' % name)
+            lines.extend(errors)
+        return '\n'.join(lines) + '\n'
+
+class StatsdListener(object):
+    '''Listener sending operation timings (and error counts) to statsd, over
+    UDP, as prefix.<class>.<operation>.
+
+    Example: monitoring.register(StatsdListener('localhost', 8125))
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='picomongo'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, event):
+        name = '%s.%s.%s' % (self.prefix, event.document_class.__name__,
+                             event.operation)
+        packet = '%s:%.3f|ms' % (name, event.duration * 1000)
+        if event.error is not None:
+            packet += '\n%s.errors:1|c' % name
+        try:
+            self._socket.sendto(packet, self.address)
+        except socket.error:
+            pass
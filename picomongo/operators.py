@@ -0,0 +1,117 @@
+'''Update operators module, apply mongodb update operators to documents in
+memory, to keep documents in sync with atomic updates sent to the database.
+'''
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and \
+        any(key.startswith('$') for key in value)
+
+def _apply_inc(container, key, value):
+    _set(container, key, _get(container, key, 0) + value)
+
+def _apply_set(container, key, value):
+    _set(container, key, value)
+
+def _apply_push(container, key, value):
+    values = _get(container, key, None)
+    if values is None:
+        values = []
+        _set(container, key, values)
+    if isinstance(value, dict) and '$each' in value:
+        values.extend(value['$each'])
+    else:
+        values.append(value)
+
+def _apply_add_to_set(container, key, value):
+    values = _get(container, key, None)
+    if values is None:
+        values = []
+        _set(container, key, values)
+    items = value['$each'] if isinstance(value, dict) and '$each' in value \
+        else [value]
+    for item in items:
+        if item not in values:
+            values.append(item)
+
+def _apply_pull(container, key, value):
+    values = _get(container, key, None)
+    if values is not None:
+        values[:] = [item for item in values if item != value]
+
+def _apply_min(container, key, value):
+    current = _get(container, key, None)
+    if current is None or value < current:
+        _set(container, key, value)
+
+def _apply_max(container, key, value):
+    current = _get(container, key, None)
+    if current is None or value > current:
+        _set(container, key, value)
+
+_OPERATORS = {
+    '$inc': _apply_inc,
+    '$set': _apply_set,
+    '$push': _apply_push,
+    '$addToSet': _apply_add_to_set,
+    '$pull': _apply_pull,
+    '$min': _apply_min,
+    '$max': _apply_max,
+}
+
+def _get(container, key, default):
+    if isinstance(container, list):
+        key = int(key)
+        return container[key] if key < len(container) else default
+    return dict.get(container, key, default)
+
+def _set(container, key, value):
+    # dict methods are used directly so documents do not record these
+    # changes: they are already in the database
+    if isinstance(container, list):
+        container[int(key)] = value
+    else:
+        dict.__setitem__(container, key, value)
+
+def _walk(document, path):
+    '''Return the container of a dotted path and the last key, create
+    missing intermediate dicts.
+    '''
+    keys = path.split('.')
+    container = document
+    for key in keys[:-1]:
+        child = _get(container, key, None)
+        if child is None:
+            child = {}
+            _set(container, key, child)
+        container = child
+    return container, keys[-1]
+
+def can_apply(update):
+    '''Return True if apply_update supports all operators of update.
+    '''
+    for operator, values in update.iteritems():
+        if operator not in _OPERATORS:
+            return False
+        for value in values.itervalues():
+            if operator == '$pull' and isinstance(value, dict):
+                return False
+            if operator in ('$push', '$addToSet') and \
+                    _is_operator_dict(value) and set(value) != set(['$each']):
+                return False
+    return True
+
+def depends_on_values(update):
+    '''Return True if the result of update depends on the values stored in
+    the database (any operator but $set): applied to a stale document, it
+    does not give the stored result.
+    '''
+    return any(operator != '$set' for operator in update)
+
+def apply_update(document, update):
+    '''Apply update operators to document, see can_apply.
+    '''
+    for operator, values in update.iteritems():
+        apply_operator = _OPERATORS[operator]
+        for path, value in values.iteritems():
+            container, key = _walk(document, path)
+            apply_operator(container, key, value)
@@ -0,0 +1,105 @@
+'''Keyset pagination helpers, see Document.paginate.
+'''
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+import pymongo
+
+from bson import BSON
+from bson.errors import InvalidBSON
+
+from utils import index_keys
+
+def sort_spec(keys):
+    '''Return the full sort of a pagination, as a list of (field, direction):
+    keys may be given as index fields ('field' or '-field') or as
+    (field, direction), _id is added as last key if missing.
+    '''
+    keys = [key if isinstance(key, tuple) else index_keys([key])[0]
+            for key in keys]
+    if not any(field == '_id' for field, _ in keys):
+        direction = keys[-1][1] if keys else pymongo.ASCENDING
+        keys.append(('_id', direction))
+    return keys
+
+def field_value(document, field):
+    '''Return the value of a (dotted) field of a document, None if missing.
+    '''
+    value = document
+    for name in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+def encode_token(keys, document):
+    '''Return the continuation token of a page ending with document.
+    '''
+    data = BSON.encode({'k': [list(key) for key in keys],
+                        'v': [field_value(document, field)
+                              for field, _ in keys]})
+    return urlsafe_b64encode(data)
+
+def decode_token(keys, token):
+    '''Return the sort values of a continuation token, raise a ValueError
+    if it is invalid or was made for another sort.
+    '''
+    try:
+        data = BSON(urlsafe_b64decode(str(token))).decode()
+    except (TypeError, InvalidBSON):
+        raise ValueError('Invalid continuation token.')
+    if [tuple(key) for key in data.get('k', [])] != list(keys):
+        raise ValueError('Continuation token of another sort.')
+    return data['v']
+
+def _after(field, direction, value):
+    '''Return the conditions on field matching values after value in the
+    sort, None standing for a null (or missing) field. Nulls sort first, and
+    $gt or $lt never match them, so they are handled explicitly.
+    '''
+    if direction == pymongo.ASCENDING:
+        return [{'$ne': None} if value is None else {'$gt': value}]
+    if value is None:
+        #Nothing sorts after nulls, only ties on the next keys follow
+        return []
+    if field == '_id':
+        return [{'$lt': value}]
+    return [{'$lt': value}, None]
+
+def seek_spec(keys, values):
+    '''Return the query matching documents after values in the sort.
+    '''
+    clauses = []
+    for index, (field, direction) in enumerate(keys):
+        equal = dict((previous, values[position]) for position, (previous, _)
+                     in enumerate(keys[:index]))
+        for condition in _after(field, direction, values[index]):
+            clause = dict(equal)
+            clause[field] = condition
+            clauses.append(clause)
+    return {'$or': clauses} if len(clauses) > 1 else clauses[0]
+
+def _equality_fields(query):
+    return set(field for field, value in (query or {}).iteritems()
+               if not field.startswith('$') and not (isinstance(value, dict)
+                   and any(name.startswith('$') for name in value)))
+
+def is_covered(keys, query, indexes):
+    '''Return True if one of indexes (as declared by Document.indexes) can
+    walk the sort keys, once fields matched by equality in query are
+    skipped. The _id index covers a sort on _id only.
+    '''
+    if [field for field, _ in keys] == ['_id']:
+        return True
+    reverse = [(field, -direction) for field, direction in keys]
+
+    equals = _equality_fields(query)
+    for index in indexes:
+        index_key = index_keys(index['fields'])
+        while index_key and index_key[0][0] in equals and \
+                index_key[0][0] != keys[0][0]:
+            index_key = index_key[1:]
+        prefix = index_key[:len(keys)]
+        if prefix == keys or prefix == reverse:
+            return True
+    return False
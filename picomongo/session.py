@@ -0,0 +1,144 @@
+'''Unit of work module, use session.Session to group the writes of many
+documents.
+'''
+
+import threading
+
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+
+#Active sessions of each thread, innermost last
+_local = threading.local()
+
+def current_session():
+    '''Return the innermost active session of the current thread, None if
+    there is none.
+    '''
+    sessions = getattr(_local, 'sessions', None)
+    return sessions[-1] if sessions else None
+
+class Session(object):
+    '''Unit of work: writes of documents are delayed until the session is
+    committed, then sent as one bulk operation per collection.
+
+    Used as a context manager, the session is active in the current thread
+    until it exits: save() and delete() of documents only record the
+    document in the session (as add and delete do). When the session exits,
+    saved documents are written and deleted documents are removed, unless
+    an exception was raised: pending writes are then discarded (documents
+    are not restored). Documents which are not saved, created or loaded,
+    are not tracked, nor written.
+
+    A document saved several times is written once, with all its changes.
+    Versioned documents (see Document.version_field) and documents using
+    write-behind are saved one by one.
+
+    Example:
+    >>> with Session():
+    ...     user = UserDocument.find_one({'name': 'Mike'})
+    ...     user.views += 1
+    ...     user.save()
+    ...     EventDocument({'user': user._id, 'type': 'view'}).save()
+    '''
+
+    def __init__(self, write_concern=None):
+        self.write_concern = write_concern
+        #id(document) -> document, to save, to remove
+        self._documents = OrderedDict()
+        self._deleted = OrderedDict()
+
+    def __enter__(self):
+        sessions = getattr(_local, 'sessions', None)
+        if sessions is None:
+            sessions = _local.sessions = []
+        sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.sessions.remove(self)
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def add(self, document):
+        '''Save a document on commit, with all its changes.
+        '''
+        key = id(document)
+        if key not in self._deleted:
+            self._documents.setdefault(key, document)
+
+    def delete(self, document):
+        '''Remove a document on commit.
+        '''
+        key = id(document)
+        self._documents.pop(key, None)
+        self._deleted[key] = document
+
+    def discard(self):
+        '''Forget pending writes.
+        '''
+        self._documents.clear()
+        self._deleted.clear()
+
+    @staticmethod
+    def _group(groups, document):
+        col = document.col
+        key = (id(col.database.connection), col.full_name)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (col, [], [])
+        return group
+
+    def commit(self):
+        '''Send pending writes, return the number of documents written.
+        '''
+        documents = self._documents.values()
+        deleted = self._deleted.values()
+        self.discard()
+
+        count = 0
+        written = []
+        groups = OrderedDict()
+        for document in documents:
+            #Loaded documents are only written if they changed
+            if document._changes is not None and \
+                    not document._collect_changes():
+                continue
+            if document.version_field is not None or \
+                    document._write_buffer is not None:
+                document._save({})
+                count += 1
+            else:
+                self._group(groups, document)[1].append(document)
+        for document in deleted:
+            self._group(groups, document)[2].append(document['_id'])
+
+        for col, saved, removed in groups.itervalues():
+            bulk = col.initialize_unordered_bulk_op()
+            for document in saved:
+                changes = document._changes
+                if '_id' not in document:
+                    dict.__setitem__(document, '_id', ObjectId())
+                    bulk.insert(document)
+                elif changes is None or changes.get('_id'):
+                    bulk.find({'_id': document['_id']}).upsert() \
+                        .replace_one(document)
+                else:
+                    bulk.find({'_id': document['_id']}) \
+                        .update_one(document._get_update())
+            if removed:
+                bulk.find({'_id': {'$in': removed}}).remove()
+            bulk.execute(self.write_concern)
+
+            for document in saved:
+                document._reset_changes()
+            count += len(saved) + len(removed)
+            written.extend(saved)
+
+        for document in written + deleted:
+            cache = document._cache
+            if cache is not None:
+                cache.invalidate(document['_id'])
+        return count
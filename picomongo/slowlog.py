@@ -0,0 +1,179 @@
+'''Slow operation log, enabled per document configuration with 'slow_log'
+(see ConnectionManager.configure).
+'''
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger('picomongo')
+
+#Operators whose value is a list of queries
+_LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+def query_shape(value):
+    '''Return the shape of a query: its fields and operators, values being
+    replaced by 1. Shapes are hashable.
+    '''
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (name, tuple(query_shape(query) for query in item)
+             if name in _LOGICAL_OPERATORS and isinstance(item, list)
+             else query_shape(item))
+            for name, item in value.iteritems()))
+    return 1
+
+def query_fields(spec):
+    '''Return the fields queried by spec, logical operators included.
+    '''
+    fields = []
+    for name, value in (spec or {}).iteritems():
+        if name in _LOGICAL_OPERATORS and isinstance(value, list):
+            for query in value:
+                fields.extend(field for field in query_fields(query)
+                              if field not in fields)
+        elif not name.startswith('$') and name not in fields:
+            fields.append(name)
+    return fields
+
+def _stages(plan):
+    '''Yield the stages of a (3.0+) explain plan.
+    '''
+    yield plan
+    if 'inputStage' in plan:
+        for stage in _stages(plan['inputStage']):
+            yield stage
+    for input_stage in plan.get('inputStages', ()):
+        for stage in _stages(input_stage):
+            yield stage
+
+def explain_summary(explain):
+    '''Return whether a query scanned the collection, the index it used,
+    the numbers of keys and documents examined and of documents returned,
+    from the result of Cursor.explain (MongoDB 2.x and 3.x formats).
+    '''
+    if 'queryPlanner' in explain:
+        stages = list(_stages(explain['queryPlanner']['winningPlan']))
+        statistics = explain.get('executionStats', {})
+        return {'collscan': any(stage.get('stage') == 'COLLSCAN'
+                                for stage in stages),
+                'index': next((stage['indexName'] for stage in stages
+                               if 'indexName' in stage), None),
+                'keys_examined': statistics.get('totalKeysExamined'),
+                'docs_examined': statistics.get('totalDocsExamined'),
+                'returned': statistics.get('nReturned')}
+
+    cursor = explain.get('cursor', '')
+    return {'collscan': cursor.startswith('BasicCursor'),
+            'index': cursor.split(' ', 1)[1] if ' ' in cursor else None,
+            'keys_examined': explain.get('nscanned'),
+            'docs_examined': explain.get('nscannedObjects'),
+            'returned': explain.get('n')}
+
+def declared_index(indexes, spec, sort):
+    '''Return the fields of the first of indexes (as declared by
+    Document.indexes) starting with a queried or sorted field, None if there
+    is none.
+    '''
+    fields = query_fields(spec)
+    if sort:
+        fields.append(sort[0][0])
+    for index in indexes:
+        if index['fields'][0].lstrip('-') in fields:
+            return tuple(index['fields'])
+    return None
+
+class SlowLog(object):
+    '''Log find and find_one calls of a document class taking more than
+    slow_ms milliseconds, with the 'picomongo' logger.
+
+    If explain is True, the first slow query of each shape (see
+    query_shape) is explained, to log whether it scanned the collection and
+    how many documents it examined, along with the declared index which
+    should have served it. At most one query is explained every
+    explain_interval seconds and max_shapes shapes are remembered.
+    Explaining runs the query again, in the thread of the slow call.
+    '''
+
+    def __init__(self, slow_ms=100, explain=False, explain_interval=1.0,
+                 max_shapes=1000):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_shapes = max_shapes
+
+        #(collection, shape, sort) -> explain summary, None until explained
+        self._shapes = OrderedDict()
+        self._last_explain = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        '''Record an OperationEvent, ignored unless it is a slow query.
+        '''
+        if event.query is None or event.error is not None or \
+                event.duration * 1000 < self.slow_ms:
+            return
+
+        query = event.query
+        logger.warning('Slow %s of %s on %s (%.1f ms): query %r, sort %r, '
+                       'fields %r', event.operation,
+                       event.document_class.__name__, event.collection,
+                       event.duration * 1000, query['spec'], query['sort'],
+                       query['fields'])
+        if self.explain:
+            self._explain(event)
+
+    def _explain(self, event):
+        query = event.query
+        key = (event.collection, query_shape(query['spec']),
+               tuple(query['sort'] or ()))
+        with self._lock:
+            if key in self._shapes:
+                return
+            now = time.time()
+            if now - self._last_explain < self.explain_interval:
+                return
+            self._last_explain = now
+            self._shapes[key] = None
+            while len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+
+        document_class = event.document_class
+        try:
+            cursor = document_class.col.find(query['spec'], query['fields'])
+            if query['sort']:
+                cursor.sort(query['sort'])
+            summary = explain_summary(cursor.explain())
+        except Exception:
+            logger.exception('Explain of a slow query on %s failed',
+                             event.collection)
+            return
+        summary['declared_index'] = declared_index(
+            document_class.indexes, query['spec'], query['sort'])
+        with self._lock:
+            if key in self._shapes:
+                self._shapes[key] = summary
+
+        if summary['collscan'] and summary['declared_index'] is None:
+            advice = ', no index of %s.indexes serves it' \
+                % document_class.__name__
+        elif summary['collscan']:
+            advice = ', index %r of %s.indexes is not used (is it built?)' \
+                % (summary['declared_index'], document_class.__name__)
+        else:
+            advice = ''
+        logger.warning('Explain of slow %s on %s: %s, %s documents examined, '
+                       '%s returned%s', event.operation, event.collection,
+                       'COLLSCAN' if summary['collscan']
+                       else 'index %s' % summary['index'],
+                       summary['docs_examined'], summary['returned'], advice)
+
+    def shapes(self):
+        '''Return the explained query shapes, as a list of
+        ((collection, shape, sort), summary).
+        '''
+        with self._lock:
+            return [(key, summary) for key, summary in self._shapes.iteritems()
+                    if summary is not None]
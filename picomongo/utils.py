@@ -1,33 +1,168 @@
+from functools import partial
+
+import pymongo
+
+from cache import DocumentCache
 from connection_manager import ConnectionManager
+from slowlog import SlowLog
+from writebehind import WriteBehindBuffer
+
+def batches(iterable, max_count, max_size=None, size=None):
+    '''Split an iterable in lists of at most max_count items and, if given,
+    max_size total size (as computed by size callable for each item).
+
+    An item bigger than max_size is yielded alone.
+    '''
+    batch = []
+    batch_size = 0
+    for item in iterable:
+        if max_size is not None:
+            item_size = size(item)
+            if batch and batch_size + item_size > max_size:
+                yield batch
+                batch = []
+                batch_size = 0
+            batch_size += item_size
+
+        batch.append(item)
+        if len(batch) >= max_count:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+def index_keys(fields):
+    '''Return the key list of an index from its 'fields', see
+    Document.generate_index.
+    '''
+    # field[1:] remove '-' from field name
+    return [(field[1:], pymongo.DESCENDING) if field.startswith('-')
+            else (field, pymongo.ASCENDING) for field in fields]
+
+class HybridMethod(object):
+    '''Method usable both on a class and on its instances, the function gets
+    the class and the instance (None when called on the class).
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        return partial(self.func, owner, instance)
 
 #Proxy
 
 def _class_name(cls):
     return cls.__name__.lower()
 
+#Resolved configurations and collections by document class, with the
+#ConnectionManager generation and class attributes they were resolved with
+_configs = {}
+_collections = {}
+_caches = {}
+_write_buffers = {}
+_slow_logs = {}
+
+def _get_config(owner):
+    config_name = owner.config_name
+    generation = ConnectionManager.generation
+
+    cached = _configs.get(owner)
+    if cached is not None and cached[0] == generation and \
+            cached[1] == config_name:
+        return cached[2]
+
+    config = ConnectionManager.get_config(config_name if config_name
+                                          else _class_name(owner))
+    _configs[owner] = (generation, config_name, config)
+    return config
+
 class CMProxy(object):
 
     def __init__(self, attr_name):
         self.attr_name = attr_name
 
     def __get__(self, instance, owner):
-        config_name = owner.config_name
-
-        config_name = config_name if config_name else _class_name(owner)
-        return getattr(ConnectionManager.get_config(config_name),
-                       self.attr_name)
+        return getattr(_get_config(owner), self.attr_name)
 
 class CollectionDescriptor(object):
 
     def __get__(self, instance, owner):
-        class_name = _class_name(owner)
         config_name = owner.config_name
-        config_name = config_name if config_name else class_name
+        collection_name = owner.collection_name
+        generation = ConnectionManager.generation
+
+        cached = _collections.get(owner)
+        if cached is not None and cached[0] == generation and \
+                cached[1] == config_name and cached[2] == collection_name:
+            return cached[3]
+
+        config = _get_config(owner)
+        col = config.col
+        if not col:
+            document_name = collection_name if collection_name \
+                else _class_name(owner)
+            col = config.db[document_name]
+
+        _collections[owner] = (generation, config_name, collection_name, col)
+        return col
+
+class CacheDescriptor(object):
+    '''Return the DocumentCache of a document class, None if its
+    configuration does not enable caching.
+    '''
+
+    def __get__(self, instance, owner):
+        config = _get_config(owner)
+
+        cached = _caches.get(owner)
+        if cached is not None and cached[0] is config:
+            return cached[1]
+
+        cache = DocumentCache(**config.cache) if config.cache is not None \
+            else None
+        _caches[owner] = (config, cache)
+        return cache
+
+class SlowLogDescriptor(object):
+    '''Return the SlowLog of a document class, None if its configuration
+    does not enable it.
+    '''
+
+    def __get__(self, instance, owner):
+        config = _get_config(owner)
+
+        cached = _slow_logs.get(owner)
+        if cached is not None and cached[0] is config:
+            return cached[1]
+
+        slow_log = SlowLog(**config.slow_log) if config.slow_log is not None \
+            else None
+        _slow_logs[owner] = (config, slow_log)
+        return slow_log
+
+class WriteBufferDescriptor(object):
+    '''Return the WriteBehindBuffer of a document class, None if its
+    configuration does not enable write-behind.
+
+    The buffer of a previous configuration is closed, so its pending writes
+    are sent.
+    '''
+
+    def __get__(self, instance, owner):
+        config = _get_config(owner)
 
-        config_col = ConnectionManager.get_config(config_name).col
-        if not config_col:
-            collection_name = owner.collection_name
-            document_name = collection_name if collection_name else class_name
-            return ConnectionManager.get_config(config_name).db[document_name]
+        cached = _write_buffers.get(owner)
+        if cached is not None and cached[0] is config:
+            return cached[1]
+        if cached is not None and cached[1] is not None:
+            cached[1].close()
 
-        return config_col
+        buffer = None
+        if config.write_behind is not None:
+            buffer = WriteBehindBuffer(owner.col, cache=owner._cache,
+                                       **config.write_behind)
+        _write_buffers[owner] = (config, buffer)
+        return buffer
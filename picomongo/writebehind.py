@@ -0,0 +1,248 @@
+'''Write-behind module, use writebehind.WriteBehindBuffer to send writes of
+documents in background.
+'''
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from weakref import WeakSet
+
+from pymongo.errors import InvalidOperation
+
+logger = logging.getLogger('picomongo')
+logger.addHandler(logging.NullHandler())
+
+_REPLACE = 'replace'
+_UPDATE = 'update'
+
+#Opened buffers, closed (thus flushed) at exit
+_buffers = WeakSet()
+
+def _merge(pending, kind, data):
+    '''Merge a write into the pending write of the same document.
+    '''
+    if kind == _REPLACE:
+        return kind, data
+
+    pending_kind, pending_data = pending
+    if pending_kind == _REPLACE:
+        pending_data.update(data.get('$set', {}))
+        for key in data.get('$unset', {}):
+            pending_data.pop(key, None)
+        return pending
+
+    sets = pending_data.setdefault('$set', {})
+    unsets = pending_data.setdefault('$unset', {})
+    for key, value in data.get('$set', {}).iteritems():
+        sets[key] = value
+        unsets.pop(key, None)
+    for key, value in data.get('$unset', {}).iteritems():
+        unsets[key] = value
+        sets.pop(key, None)
+    for operator in ('$set', '$unset'):
+        if not pending_data[operator]:
+            del pending_data[operator]
+    return pending
+
+class WriteBehindBuffer(object):
+    '''Bounded buffer of document writes, sent by a background thread.
+
+    Writes of the same document (by _id) are merged until they are sent,
+    only the result is written. Pending writes are sent with unordered bulk
+    operations of at most batch_size writes, as soon as batch_size documents
+    are pending or max_delay seconds after the first pending write, and when
+    the process exits.
+
+    When max_pending documents are pending, writing another document blocks
+    until pending writes are sent.
+
+    Errors can not be reported to writers: they are logged and counted,
+    the failed batch is lost.
+
+    If cache (a cache.DocumentCache) is given, the entries of documents are
+    invalidated once their writes are sent, as they may have been cached
+    from the database before.
+    '''
+
+    def __init__(self, collection, batch_size=500, max_delay=1.0,
+                 max_pending=10000, write_concern=None, cache=None):
+        self.collection = collection
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, batch_size)
+        self.write_concern = write_concern
+
+        #_id -> (kind, data) of the write to send
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        #Held while sending, so writes are sent in order
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        #Process running the background thread
+        self._pid = None
+        self._closed = False
+
+        self.saves = 0
+        self.coalesced = 0
+        self.waits = 0
+        self.flushes = 0
+        self.writes = 0
+        self.errors = 0
+        self.flush_time = 0.0
+
+    def replace(self, _id, document):
+        '''Buffer the replacement (or insertion) of a document.
+        '''
+        self._add(_id, _REPLACE, document)
+
+    def update(self, _id, update):
+        '''Buffer an update ($set and $unset only) of a document.
+        '''
+        self._add(_id, _UPDATE, update)
+
+    def discard(self, _id):
+        '''Forget the pending write of a document, once writes being sent
+        are done.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if self._pending.pop(_id, None) is not None:
+                    self._not_full.notify_all()
+
+    def _add(self, _id, kind, data):
+        with self._lock:
+            if self._closed:
+                raise InvalidOperation('The write-behind buffer is closed.')
+            if self._thread is None:
+                self._start()
+
+            pending = self._pending
+            while _id not in pending and len(pending) >= self.max_pending:
+                self.waits += 1
+                self._wakeup.notify()
+                self._not_full.wait()
+                if self._closed:
+                    raise InvalidOperation('The write-behind buffer is '
+                                           'closed.')
+                pending = self._pending
+
+            self.saves += 1
+            if _id in pending:
+                pending[_id] = _merge(pending[_id], kind, data)
+                self.coalesced += 1
+            else:
+                pending[_id] = (kind, data)
+                if len(pending) == 1 or len(pending) >= self.batch_size:
+                    self._wakeup.notify()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='picomongo-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+        _buffers.add(self)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._wakeup.wait()
+                deadline = time.time() + self.max_delay
+                while not self._closed and \
+                        len(self._pending) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        '''Send all pending writes now, return the number of writes sent.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = OrderedDict()
+                self._not_full.notify_all()
+            if not pending:
+                return 0
+
+            start = time.time()
+            count = errors = 0
+            writes = pending.items()
+            for index in xrange(0, len(writes), self.batch_size):
+                batch = writes[index:index + self.batch_size]
+                bulk = self.collection.initialize_unordered_bulk_op()
+                for _id, (kind, data) in batch:
+                    if kind == _REPLACE:
+                        bulk.find({'_id': _id}).upsert().replace_one(data)
+                    else:
+                        bulk.find({'_id': _id}).update_one(data)
+                try:
+                    bulk.execute(self.write_concern)
+                except Exception:
+                    logger.exception('Write-behind of %s documents in %s '
+                                     'failed', len(batch),
+                                     self.collection.full_name)
+                    errors += len(batch)
+                else:
+                    count += len(batch)
+                if self.cache is not None:
+                    for _id, _ in batch:
+                        self.cache.invalidate(_id)
+
+            with self._lock:
+                self.flushes += 1
+                self.writes += count
+                self.errors += errors
+                self.flush_time += time.time() - start
+            return count
+
+    def close(self):
+        '''Stop the background thread and send pending writes.
+
+        In a forked process, pending writes belong to the parent process,
+        they are dropped.
+        '''
+        if self._pid is not None and self._pid != os.getpid():
+            self._closed = True
+            self._pending = OrderedDict()
+            return
+
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        '''Return buffer counters: pending documents, saves, coalesced saves,
+        waits (saves blocked by a full buffer), flushes, writes sent, writes
+        lost because of errors and time spent flushing (seconds).
+        '''
+        with self._lock:
+            return {'pending': len(self._pending),
+                    'saves': self.saves,
+                    'coalesced': self.coalesced,
+                    'waits': self.waits,
+                    'flushes': self.flushes,
+                    'writes': self.writes,
+                    'errors': self.errors,
+                    'flush_time': self.flush_time}
+
+@atexit.register
+def _close_buffers():
+    for buffer in list(_buffers):
+        buffer.close()
@@ -7,4 +7,5 @@ setup(name='picomongo',
       author_email='contact@dmcloud.net',
       packages=['picomongo'],
       install_requires=['pymongo'],
+      extras_require={'async': ['futures']},
 )
@@ -0,0 +1,94 @@
+import unittest
+
+from picomongo import ConnectionManager
+from picomongo.asynchronous import AsyncDocument, ThreadPoolExecutor, \
+    get_executor
+
+class UserDocument(AsyncDocument):
+    pass
+
+@unittest.skipIf(ThreadPoolExecutor is None, 'futures is not installed')
+class AsyncDocumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        for number in xrange(5):
+            UserDocument({'name': 'FELD', 'number': number}).save()
+
+    def tearDown(self):
+        UserDocument.col.remove()
+
+    def test_find_one(self):
+        user = UserDocument.find_one_async({'number': 1}).result(5)
+
+        self.assertTrue(isinstance(user, UserDocument))
+        self.assertEqual(user.number, 1)
+
+    def test_save_reload_delete(self):
+        user = UserDocument({'name': 'SMITH'})
+        user.save_async().result(5)
+        self.assertEqual(UserDocument.col.find_one({'name': 'SMITH'}), user)
+
+        UserDocument.col.update({'_id': user._id}, {'$set': {'views': 1}})
+        user.reload_async().result(5)
+        self.assertEqual(user.views, 1)
+
+        user.delete_async().result(5)
+        self.assertEqual(UserDocument.col.find_one({'name': 'SMITH'}), None)
+
+    def test_get_many(self):
+        ids = [user['_id'] for user in UserDocument.col.find()]
+
+        users = UserDocument.get_many_async(ids[::-1]).result(5)
+
+        self.assertEqual([user._id for user in users], ids[::-1])
+
+    def test_cursor(self):
+        cursor = UserDocument.find_async().sort('number', -1).batch_size(2)
+
+        numbers = []
+        while cursor.fetch_next.result(5):
+            numbers.append(cursor.next_object().number)
+
+        self.assertEqual(numbers, [4, 3, 2, 1, 0])
+        self.assertFalse(cursor.fetch_next.result(5))
+        self.assertEqual(cursor.next_object(), None)
+
+    def test_to_list(self):
+        cursor = UserDocument.find_async().sort('number', 1)
+
+        first = cursor.to_list(2).result(5)
+        rest = cursor.to_list().result(5)
+
+        self.assertEqual([user.number for user in first], [0, 1])
+        self.assertEqual([user.number for user in rest], [2, 3, 4])
+        self.assertTrue(isinstance(rest[0], UserDocument))
+
+    def test_outstanding_reads(self):
+        cursor = UserDocument.find_async().sort('number', 1).batch_size(1)
+
+        first = cursor.to_list(2)
+        second = cursor.to_list(2)
+        fetched = cursor.fetch_next
+        closed = cursor.close()
+
+        self.assertEqual([user.number for user in first.result(5)], [0, 1])
+        self.assertEqual([user.number for user in second.result(5)], [2, 3])
+        self.assertTrue(fetched.result(5))
+        self.assertEqual(cursor.next_object().number, 4)
+        closed.result(5)
+
+    def test_errors(self):
+        future = UserDocument.find_one_async({'$invalid': 1})
+
+        self.assertRaises(Exception, future.result, 5)
+
+    def test_executor_workers(self):
+        executor = get_executor()
+        self.assertTrue(get_executor() is executor)
+
+        ConnectionManager.configure({'_default_': {'async_workers': 2}})
+        try:
+            self.assertFalse(get_executor() is executor)
+        finally:
+            ConnectionManager.configure({'_default_': {'async_workers': 10}})
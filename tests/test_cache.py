@@ -0,0 +1,70 @@
+import unittest
+
+from mock import patch
+
+from picomongo.cache import DocumentCache
+
+class DocumentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DocumentCache(max_entries=2)
+
+    def test_get_set(self):
+        document = {'_id': 1, 'values': [1, 2]}
+        self.cache.set(document)
+
+        cached = self.cache.get(1)
+        self.assertEqual(cached, document)
+
+        cached['values'].append(3)
+        self.assertEqual(self.cache.get(1), document)
+
+        self.assertEqual(self.cache.get(2), None)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.set({'_id': 1})
+        self.cache.set({'_id': 2})
+        self.cache.get(1)
+        self.cache.set({'_id': 3})
+
+        self.assertEqual(self.cache.get(2), None)
+        self.assertEqual(self.cache.get(1), {'_id': 1})
+        self.assertEqual(self.cache.get(3), {'_id': 3})
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+    def test_bytes_eviction(self):
+        cache = DocumentCache(max_bytes=100)
+        cache.set({'_id': 1, 'value': 'a' * 50})
+        cache.set({'_id': 2, 'value': 'b' * 50})
+
+        self.assertEqual(cache.get(1), None)
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertTrue(cache.stats()['bytes'] <= 100)
+
+    def test_ttl(self):
+        cache = DocumentCache(ttl=10)
+
+        with patch('time.time') as mock_time:
+            mock_time.return_value = 100
+            cache.set({'_id': 1})
+            mock_time.return_value = 105
+            self.assertEqual(cache.get(1), {'_id': 1})
+            mock_time.return_value = 111
+            self.assertEqual(cache.get(1), None)
+
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_invalidate(self):
+        self.cache.set({'_id': 1})
+        self.cache.set({'_id': 2})
+
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get(1), None)
+
+        self.cache.clear()
+        self.assertEqual(self.cache.get(2), None)
+        self.assertEqual(self.cache.stats()['bytes'], 0)
@@ -1,13 +1,19 @@
 import copy
+import os
+import threading
 import unittest
 
+from mock import patch, Mock
+
 from pymongo import Connection
 from pymongo.database import Database
 from pymongo.collection import Collection
+from pymongo.read_preferences import ReadPreference
 
 from picomongo import ConnectionManager
 from picomongo.connection_manager import _ConnectionManager
 from picomongo.exceptions import NotConfiguredYet
+from utils import Call
 
 class ConnectionManagerTestCase(unittest.TestCase):
 
@@ -135,3 +141,196 @@ class ConnectionManagerTestCase(unittest.TestCase):
 
         document_config = self.connection_manager.get_config('document')
         self.assertEqual(document_config.db.name, 'test2')
+
+    def test_shared_connection(self):
+        config = {
+            'document': {'db': 'test2'},
+            'document2': {'uri': 'mongodb://localhost/?w=1', 'col': 'col'},
+            'document3': {'uri': 'mongodb://localhost:27017/?w=1'}}
+
+        self.connection_manager.configure(config)
+
+        default_con = self.connection_manager.get_config('_default_').con
+        self.assertTrue(self.connection_manager.get_config('document').con
+                        is default_con)
+        self.assertTrue(self.connection_manager.get_config('other').con
+                        is default_con)
+        self.assertTrue(self.connection_manager.get_config('document2').con
+                        is self.connection_manager.get_config('document3').con)
+        self.assertEqual(len(self.connection_manager.get_connections()), 2)
+
+    def test_max_pool_size(self):
+        config = {
+            '_default_': {'max_pool_size': 5},
+            'document': {},
+            'document2': {'max_pool_size': 10}}
+
+        config['document3'] = {'uri': 'mongodb://127.0.0.1:27017'}
+
+        self.connection_manager.configure(config)
+
+        con = self.connection_manager.get_config('_default_').con
+        self.assertTrue(self.connection_manager.get_config('document').con
+                        is con)
+        self.assertTrue(self.connection_manager.get_config('document2').con
+                        is con)
+        self.assertEqual(con.max_pool_size, 10)
+        self.assertEqual(self.connection_manager.get_config('document3').con.max_pool_size, 5)
+        self.assertEqual(len(self.connection_manager.get_connections()), 2)
+
+    def test_reconfigure_keep_released_connection(self):
+        with patch('picomongo.connection_manager._open_connection') as mock_open:
+            mock_open.side_effect = lambda *args: Mock()
+            self.connection_manager.configure()
+            con = self.connection_manager.get_config('document').con
+
+            self.connection_manager.configure(
+                {'_default_': {'uri': 'mongodb://127.0.0.1:27017'}})
+
+        self.assertFalse(con.disconnect.called)
+        self.assertEqual(mock_open.call_count, 2)
+
+    def test_reconfigure_reuse_connection(self):
+        self.connection_manager.configure()
+        con = self.connection_manager.get_config('_default_').con
+
+        self.connection_manager.configure({'_default_': {'db': 'test2'}})
+
+        self.assertTrue(self.connection_manager.get_config('_default_').con is con)
+        self.assertEqual(len(self.connection_manager.get_connections()), 1)
+
+    def test_lazy(self):
+        config = {'document': {'uri': 'mongodb://127.0.0.1:27017'}}
+
+        with patch('picomongo.connection_manager._open_connection') as mock_open:
+            self.connection_manager.configure(config, lazy=True)
+            document_config = self.connection_manager.get_config('document')
+            self.assertEqual(mock_open.call_count, 0)
+            self.assertEqual(self.connection_manager.get_connections(), [])
+
+            document_config.db
+            self.assertEqual(mock_open.call_args_list,
+                             [Call('mongodb://127.0.0.1:27017', {})])
+
+            document_config.col
+            document_config.con
+            self.assertEqual(mock_open.call_count, 1)
+
+    def test_lazy_default(self):
+        self.connection_manager.configure(lazy=True)
+
+        document_config = self.connection_manager.get_config('document')
+
+        self.assertEqual(self.connection_manager.get_connections(), [])
+        self.assertTrue(isinstance(document_config.con, Connection))
+        self.assertEqual(len(self.connection_manager.get_connections()), 1)
+
+    def test_warmup(self):
+        config = {'document': {'uri': 'mongodb://127.0.0.1:27017'}}
+
+        self.connection_manager.configure(config, lazy=True)
+        timings = self.connection_manager.warmup()
+
+        self.assertEqual(sorted(timings),
+                         ['mongodb://127.0.0.1:27017', 'mongodb://localhost'])
+        self.assertTrue(all(timing >= 0 for timing in timings.values()))
+        self.assertEqual(len(self.connection_manager.get_connections()), 2)
+
+    def test_read_options(self):
+        config = {'_default_': {'read_preference': 'secondary_preferred'},
+                  'document': {'read_preference': ReadPreference.SECONDARY,
+                               'tag_sets': [{'dc': 'paris'}, {}],
+                               'secondary_acceptable_latency_ms': 30}}
+
+        with patch('picomongo.connection_manager._open_connection') as mock_open:
+            mock_open.return_value = Connection(_connect=False)
+            self.connection_manager.configure(config, lazy=True)
+
+            document_col = self.connection_manager.get_config('document').db.col
+            other_col = self.connection_manager.get_config('other').db.col
+
+        self.assertEqual(document_col.read_preference, ReadPreference.SECONDARY)
+        self.assertEqual(document_col.tag_sets, [{'dc': 'paris'}, {}])
+        self.assertEqual(document_col.secondary_acceptable_latency_ms, 30)
+        self.assertEqual(other_col.read_preference,
+                         ReadPreference.SECONDARY_PREFERRED)
+
+    def test_unknown_read_preference(self):
+        config = {'document': {'read_preference': 'secondary_only_please'}}
+
+        self.assertRaises(ValueError, self.connection_manager.configure,
+                          config, lazy=True)
+
+    def test_concurrent_get_config(self):
+        names = ['document%s' % number for number in xrange(50)]
+        configs = {}
+
+        def get_configs(thread):
+            for name in names:
+                configs.setdefault(name, set()).add(
+                    self.connection_manager.get_config(name))
+
+        with patch('picomongo.connection_manager._open_connection'):
+            self.connection_manager.configure(lazy=True)
+            threads = [threading.Thread(target=get_configs, args=(thread,))
+                       for thread in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertTrue(all(len(config) == 1 for config in configs.values()))
+        self.assertEqual(len(self.connection_manager._configurations), 51)
+
+    def test_reset_after_fork(self):
+        with patch('picomongo.connection_manager._open_connection') as mock_open:
+            mock_open.side_effect = lambda *args: Mock()
+            self.connection_manager.configure({'document': {'db': 'other'}})
+            parent_con = self.connection_manager.get_config('document').con
+            generation = self.connection_manager.generation
+
+            #A forked child gets a new pid and threading lock
+            with patch('os.getpid', return_value=os.getpid() + 1), \
+                 patch('threading._active_limbo_lock', threading.Lock()):
+                self.assertEqual(self.connection_manager.generation,
+                                 generation + 1)
+                self.assertEqual(self.connection_manager.get_connections(), [])
+
+                document_config = self.connection_manager.get_config('document')
+                self.assertEqual(document_config.db_name, 'other')
+                self.assertFalse(document_config.con is parent_con)
+
+        self.assertFalse(parent_con.disconnect.called)
+        self.assertEqual(mock_open.call_count, 2)
+
+    def test_reset_after_fork_held_lock(self):
+        self.connection_manager.configure({'document': {'db': 'other'}},
+                                          lazy=True)
+        #Held by a thread of the parent process when it forked
+        holder = threading.Thread(target=self.connection_manager._lock.acquire)
+        holder.start()
+        holder.join()
+
+        with patch('os.getpid', return_value=os.getpid() + 1), \
+             patch('threading._active_limbo_lock', threading.Lock()):
+            self.connection_manager.configure({'document': {'db': 'new'}},
+                                              lazy=True)
+            document_config = self.connection_manager.get_config('document')
+
+        self.assertEqual(document_config.db_name, 'new')
+
+    def test_fork(self):
+        with patch('picomongo.connection_manager._open_connection') as mock_open:
+            mock_open.side_effect = lambda *args: Mock()
+            self.connection_manager.configure()
+            parent_con = self.connection_manager.get_config('document').con
+
+            pid = os.fork()
+            if not pid:
+                con = self.connection_manager.get_config('document').con
+                os._exit(0 if con is not parent_con else 1)
+            _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(status, 0)
+        self.assertTrue(self.connection_manager.get_config('document').con
+                        is parent_con)
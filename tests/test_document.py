@@ -1,5 +1,9 @@
+import pickle
+import timeit
 import unittest
 
+from copy import copy, deepcopy
+
 import pymongo
 from mock import patch, Mock, sentinel
 
@@ -9,9 +13,14 @@ from pymongo import Connection
 from pymongo.database import Database
 from pymongo.collection import Collection
 from pymongo.errors import InvalidOperation, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import ReadPreference
 
 from picomongo import Document, ConnectionManager
-from picomongo.exceptions import ValidationError
+from picomongo.cursor import DocumentCursor
+from picomongo.exceptions import ConflictError, DocumentNotFound, \
+    ValidationError
+from picomongo.fields import Field
+from picomongo.utils import batches
 from utils import Call
 
 #Examples document class
@@ -25,6 +34,9 @@ class SimpleIndex(Document):
 class DefaultDocument(Document):
     default_values = {'a': 1, 'b': 2}
 
+class VersionedDocument(Document):
+    version_field = 'version'
+
 class ValidationDocument(Document):
     pass
 
@@ -40,6 +52,30 @@ class DocumentBaseTestCase(unittest.TestCase):
         data = {'_private': 42}
         self.assertRaises(ValueError, Document, data)
 
+    def test_load(self):
+        #__init__ would refuse the private field
+        data = {'_id': 1, '_private': 42, 'attr1': 1}
+
+        document = DefaultDocument._load(data)
+
+        self.assertTrue(isinstance(document, DefaultDocument))
+        self.assertEqual(document, data)
+        self.assertFalse(document is data)
+        self.assertEqual(document._changes, {})
+
+    def test_load_custom_init(self):
+        class InitDocument(DefaultDocument):
+            def __init__(self, *args, **kwargs):
+                super(InitDocument, self).__init__(*args, **kwargs)
+                self._loaded_at = 42
+
+        document = InitDocument._load({'_id': 1, 'attr1': 1})
+
+        self.assertEqual(document, {'_id': 1, 'attr1': 1})
+        self.assertEqual(document._loaded_at, 42)
+        self.assertEqual(document._changes, {})
+        self.assertFalse(DefaultDocument._custom_init)
+
     def test_access_config(self):
         ConnectionManager.configure()
 
@@ -143,6 +179,25 @@ class DocumentDBMethodsTestCase(unittest.TestCase):
     def test_find_no_document(self):
         self.assertEqual(list(UserDocument.find()), [])
 
+    def test_find_read_preference(self):
+        class SecondaryDocument(UserDocument):
+            collection_name = 'userdocument'
+            read_preference = 'secondary_preferred'
+
+        with patch.object(SecondaryDocument, 'col') as mock_col:
+            mock_col.find_one.return_value = None
+            SecondaryDocument.find({'name': 'FELD'})
+            SecondaryDocument.find_one({'name': 'FELD'}, read_preference='primary')
+            SecondaryDocument.get_many([1])
+
+        self.assertEqual(mock_col.find.call_args_list,
+            [Call({'name': 'FELD'},
+                  read_preference=ReadPreference.SECONDARY_PREFERRED),
+             Call({'_id': {'$in': [1]}},
+                  read_preference=ReadPreference.SECONDARY_PREFERRED)])
+        self.assertEqual(mock_col.find_one.call_args_list,
+            [Call({'name': 'FELD'}, read_preference=ReadPreference.PRIMARY)])
+
     def test_delete(self):
         user = UserDocument()
         user.save()
@@ -251,6 +306,633 @@ class DocumentDBMethodsTestCase(unittest.TestCase):
         self.assertEqual(values, expected_values)
 
 
+class DocumentChangesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        self.document = UserDocument({'first_name': 'Boris', 'name': 'FELD',
+                                      'age': 21, 'tags': []})
+        self.document.save()
+
+    def tearDown(self):
+        UserDocument.col.remove()
+
+    def test_new_document_not_tracked(self):
+        document = UserDocument({'name': 'FELD'})
+        document.age = 21
+
+        self.assertEqual(document._changes, None)
+
+    def test_save_changes(self):
+        self.document.name = 'SMITH'
+        self.document['age'] = 22
+        del self.document.first_name
+
+        with patch.object(UserDocument, 'col') as mock_col:
+            self.document.save()
+
+        self.assertEqual(mock_col.save.call_count, 0)
+        self.assertEqual(mock_col.update.call_args_list,
+            [Call({'_id': self.document._id},
+                  {'$set': {'name': 'SMITH', 'age': 22},
+                   '$unset': {'first_name': 1}})])
+        self.assertEqual(self.document._changes, {})
+
+    def test_save_no_changes(self):
+        with patch.object(UserDocument, 'col') as mock_col:
+            self.document.save()
+
+        self.assertEqual(mock_col.save.call_count, 0)
+        self.assertEqual(mock_col.update.call_count, 0)
+
+    def test_dict_methods_changes(self):
+        self.document.update({'a': 1}, b=2)
+        self.document.pop('age')
+        self.document.setdefault('c', 3)
+
+        self.assertEqual(self.document._changes,
+                         {'a': True, 'b': True, 'age': False, 'c': True})
+
+    def test_in_place_changes(self):
+        self.document.tags.append('tag')
+        self.document.name
+
+        self.assertEqual(self.document._collect_changes(), {'tags': True})
+
+    def test_items_in_place_changes(self):
+        document = UserDocument.find_one()
+        for key, value in document.items():
+            if key == 'tags':
+                value.append('tag')
+
+        with patch.object(UserDocument, 'col') as mock_col:
+            document.save()
+
+        self.assertEqual(mock_col.update.call_args_list,
+            [Call({'_id': document._id}, {'$set': {'tags': ['tag']}})])
+
+    def test_read_no_changes(self):
+        document = UserDocument.find_one()
+        document.tags
+        document['tags']
+        document.get('tags')
+
+        self.assertEqual(document._collect_changes(), {})
+
+    def test_load_not_digested(self):
+        data = {'_id': 1, 'name': 'FELD', 'tags': ['a'], 'meta': {'a': 1}}
+        with patch('picomongo.document._digest') as mock_digest:
+            document = UserDocument._load(data)
+            document.name
+            document.save()
+
+        self.assertEqual(mock_digest.call_count, 0)
+
+    def test_load_benchmark(self):
+        data = {'_id': ObjectId(), 'tags': ['tag%d' % i for i in range(20)],
+                'meta': dict(('key%d' % i, i) for i in range(30)),
+                'items': [{'name': 'item', 'values': [1, 2, 3]}
+                          for i in range(50)]}
+
+        load_time = min(timeit.repeat(lambda: UserDocument._load(data),
+                                      number=2000, repeat=7))
+        copy_time = min(timeit.repeat(lambda: dict(data),
+                                      number=2000, repeat=7))
+
+        #Loading is a copy, nested values are only digested once read (a
+        #digest on load is hundreds of times slower than a copy)
+        self.assertTrue(load_time < copy_time * 20)
+
+    def test_copy_in_place_changes(self):
+        document = UserDocument.find_one()
+        duplicate = copy(document)
+        document.tags.append('tag')
+
+        self.assertEqual(duplicate._collect_changes(), {'tags': True})
+
+    def test_read_keep_concurrent_update(self):
+        document = UserDocument.find_one()
+        document.tags
+        UserDocument.col.update({'_id': document._id},
+                                {'$push': {'tags': 'other'}})
+        document.age = 22
+        document.save(safe=True)
+
+        self.assertEqual(UserDocument.col.find_one()['tags'], ['other'])
+
+    def test_loaded_document_changes(self):
+        document = UserDocument.find_one()
+        document.age += 1
+        document.tags.append('tag')
+        document.save(safe=True)
+
+        self.assertEqual(UserDocument.col.find_one(),
+            {'_id': document._id, 'first_name': 'Boris', 'name': 'FELD',
+             'age': 22, 'tags': ['tag']})
+
+    def test_changed_id_replace(self):
+        document = UserDocument.find_one()
+        document._id = ObjectId()
+
+        with patch.object(UserDocument, 'col') as mock_col:
+            document.save()
+
+        self.assertEqual(mock_col.save.call_args_list, [Call(document)])
+
+class DocumentBulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+
+    def tearDown(self):
+        UserDocument.col.remove()
+
+    def test_batches(self):
+        self.assertEqual(list(batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batches([1, 2, 3, 4, 1], 10, 4, lambda x: x)),
+                         [[1, 2], [3], [4], [1]])
+
+    def test_save_many(self):
+        documents = (UserDocument({'i': i}) for i in range(5))
+
+        with patch.object(UserDocument, 'col') as mock_col:
+            count = UserDocument.save_many(documents, batch_size=2)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(mock_col.initialize_unordered_bulk_op.call_count, 3)
+
+    def test_save_many_functionnal(self):
+        loaded = UserDocument({'name': 'FELD'})
+        loaded.save(safe=True)
+        loaded.name = 'SMITH'
+        replaced = UserDocument({'_id': 42, 'name': 'JOHNSON'})
+        new = UserDocument({'name': 'DOE'})
+
+        count = UserDocument.save_many([loaded, replaced, new],
+                                       write_concern={'w': 1})
+
+        self.assertEqual(count, 3)
+        self.assertTrue(isinstance(new._id, ObjectId))
+        self.assertEqual(sorted(doc['name'] for doc in UserDocument.find()),
+                         ['DOE', 'JOHNSON', 'SMITH'])
+
+    def test_save_many_validate(self):
+        def validate(self):
+            raise ValidationError()
+
+        documents = [ValidationDocument(), ValidationDocument()]
+
+        with patch.object(ValidationDocument, 'validate', validate):
+            with patch.object(ValidationDocument, 'col') as mock_col:
+                self.assertRaises(ValidationError,
+                    ValidationDocument.save_many, documents, validate=True)
+
+        self.assertEqual(mock_col.initialize_unordered_bulk_op.return_value
+                         .execute.call_count, 0)
+
+    def test_insert_many(self):
+        count = UserDocument.insert_many(
+            (UserDocument({'i': i}) for i in range(10)), batch_size=3,
+            safe=True)
+
+        self.assertEqual(count, 10)
+        self.assertEqual(UserDocument.col.count(), 10)
+
+class DocumentGetManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        self.ids = [UserDocument.col.insert({'i': i}, safe=True)
+                    for i in range(10)]
+
+    def tearDown(self):
+        UserDocument.col.remove()
+
+    def test_get_many(self):
+        ids = list(reversed(self.ids))
+
+        documents = UserDocument.get_many(ids, chunk_size=3)
+
+        self.assertEqual([document._id for document in documents], ids)
+        self.assertTrue(all(isinstance(document, UserDocument)
+                            for document in documents))
+
+    def test_get_many_chunks(self):
+        with patch.object(UserDocument, 'col') as mock_col:
+            mock_col.find.return_value = []
+            UserDocument.get_many(self.ids + self.ids[:2], chunk_size=4)
+
+        self.assertEqual(mock_col.find.call_args_list,
+            [Call({'_id': {'$in': self.ids[:4]}}),
+             Call({'_id': {'$in': self.ids[4:8]}}),
+             Call({'_id': {'$in': self.ids[8:]}})])
+
+    def test_get_many_workers(self):
+        documents = UserDocument.get_many(self.ids, chunk_size=2, workers=3)
+
+        self.assertEqual([document._id for document in documents], self.ids)
+
+    def test_get_many_missing(self):
+        unknown = ObjectId()
+        ids = [self.ids[0], unknown, self.ids[1]]
+
+        self.assertEqual(
+            [document._id for document in UserDocument.get_many(ids)],
+            [self.ids[0], self.ids[1]])
+        self.assertEqual(UserDocument.get_many(ids, missing='none')[1], None)
+        self.assertRaises(DocumentNotFound, UserDocument.get_many, ids,
+                          missing='raise')
+        self.assertRaises(ValueError, UserDocument.get_many, ids,
+                          missing='unknown')
+
+class DocumentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure({'userdocument': {'cache': {'ttl': 60}}})
+        self.document = UserDocument({'name': 'FELD'})
+        self.document.save(safe=True)
+
+    def tearDown(self):
+        UserDocument.col.remove()
+        ConnectionManager.configure()
+
+    def test_no_cache(self):
+        self.assertEqual(DefaultDocument.cache_stats(), None)
+
+    def test_find_one_cached(self):
+        document = UserDocument.find_one(self.document._id)
+
+        with patch.object(UserDocument, 'col') as mock_col:
+            cached = UserDocument.find_one({'_id': self.document._id})
+
+        self.assertEqual(mock_col.find_one.call_count, 0)
+        self.assertEqual(cached, document)
+        self.assertTrue(isinstance(cached, UserDocument))
+        self.assertFalse(cached is document)
+        self.assertEqual(UserDocument.cache_stats()['hits'], 1)
+        self.assertEqual(UserDocument.cache_stats()['misses'], 1)
+
+    def test_find_one_miss_read_preference(self):
+        with patch.object(UserDocument, 'read_preference', 'secondary'), \
+                patch.object(UserDocument, 'col') as mock_col:
+            mock_col.find_one.return_value = dict(self.document)
+            UserDocument.find_one(self.document._id)
+
+        self.assertEqual(mock_col.find_one.call_args_list,
+                         [Call(self.document._id,
+                               read_preference=ReadPreference.SECONDARY)])
+        self.assertEqual(UserDocument.cache_stats()['entries'], 1)
+
+    def test_find_one_not_by_id(self):
+        UserDocument.find_one({'name': 'FELD'})
+        UserDocument.find_one(self.document._id, fields=['name'])
+
+        self.assertEqual(UserDocument.cache_stats()['entries'], 0)
+
+    def test_save_invalidate(self):
+        document = UserDocument.find_one(self.document._id)
+        document.name = 'SMITH'
+        document.save(safe=True)
+
+        self.assertEqual(UserDocument.find_one(self.document._id).name,
+                         'SMITH')
+
+    def test_delete_invalidate(self):
+        UserDocument.find_one(self.document._id)
+        self.document.delete(safe=True)
+
+        self.assertEqual(UserDocument.find_one(self.document._id), None)
+
+    def test_reconfigure(self):
+        UserDocument.find_one(self.document._id)
+
+        ConnectionManager.configure()
+
+        self.assertEqual(UserDocument.cache_stats(), None)
+
+class DocumentModifyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        self.document = UserDocument({'name': 'FELD', 'views': 1, 'tags': []})
+        self.document.save(safe=True)
+
+    def tearDown(self):
+        UserDocument.col.remove()
+
+    def test_instance_set_fields(self):
+        with patch.object(UserDocument, 'col') as mock_col:
+            self.document.set_fields({'name': 'SMITH'}, safe=True)
+
+        self.assertEqual(mock_col.update.call_args_list,
+            [Call({'_id': self.document._id}, {'$set': {'name': 'SMITH'}},
+                  upsert=False, multi=False, safe=True)])
+        self.assertEqual(self.document.name, 'SMITH')
+        self.assertEqual(self.document._changes, {})
+
+    def test_instance_inc_stale(self):
+        UserDocument.col.update({'_id': self.document._id},
+                                {'$inc': {'views': 5}}, safe=True)
+
+        result = self.document.inc({'views': 2}, safe=True)
+
+        self.assertEqual(result, None)
+        self.assertEqual(self.document.views, 8)
+        self.assertEqual(self.document._changes, {})
+
+    def test_class_inc(self):
+        with patch.object(UserDocument, 'col') as mock_col:
+            UserDocument.inc({'name': 'FELD'}, {'views': 1}, multi=True)
+
+        self.assertEqual(mock_col.update.call_args_list,
+            [Call({'name': 'FELD'}, {'$inc': {'views': 1}}, upsert=False,
+                  multi=True)])
+
+    def test_instance_sync(self):
+        self.document.inc({'views': 1}, safe=True)
+        self.document.push({'tags': 'a'}, safe=True)
+        self.document.add_to_set({'tags': 'a'}, safe=True)
+        self.document.set_fields({'name': 'SMITH'}, safe=True)
+        self.document.set_max({'views': 10}, safe=True)
+
+        self.assertEqual(self.document, UserDocument.col.find_one())
+        self.assertEqual(self.document,
+            {'_id': self.document._id, 'name': 'SMITH', 'views': 10,
+             'tags': ['a']})
+
+    def test_new(self):
+        document = UserDocument.inc(self.document._id, {'views': 1}, new=True)
+
+        self.assertTrue(isinstance(document, UserDocument))
+        self.assertEqual(document.views, 2)
+        self.assertEqual(UserDocument.inc(ObjectId(), {'views': 1}, new=True),
+                         None)
+
+    def test_instance_new_keep_changes(self):
+        UserDocument.col.update({'_id': self.document._id},
+                                {'$set': {'other': 1}}, safe=True)
+        self.document.name = 'SMITH'
+
+        result = self.document.pull({'tags': 'a'}, new=True)
+
+        self.assertTrue(result is self.document)
+        self.assertEqual(self.document.other, 1)
+        self.assertEqual(self.document.name, 'SMITH')
+        self.assertEqual(self.document._changes, {'name': True})
+
+    def test_modify_unsaved(self):
+        self.assertRaises(InvalidOperation, UserDocument().inc, {'views': 1})
+
+class DocumentVersionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+
+    def tearDown(self):
+        VersionedDocument.col.remove()
+
+    def test_insert(self):
+        document = VersionedDocument({'name': 'FELD'})
+        document.save()
+
+        self.assertEqual(document.version, 1)
+        self.assertEqual(VersionedDocument.col.find_one(), document)
+
+        copy = VersionedDocument({'_id': document._id})
+        self.assertRaises(ConflictError, copy.save)
+        self.assertFalse('version' in copy)
+
+    def test_update(self):
+        VersionedDocument({'name': 'FELD'}).save()
+        document = VersionedDocument.find_one()
+        document.name = 'SMITH'
+
+        with patch.object(VersionedDocument, 'col') as mock_col:
+            mock_col.update.return_value = {'n': 1}
+            document.save(w=0)
+
+        self.assertEqual(mock_col.update.call_args_list,
+            [Call({'_id': document._id, 'version': 1},
+                  {'$set': {'name': 'SMITH'}, '$inc': {'version': 1}},
+                  safe=True)])
+        self.assertEqual(document.version, 2)
+
+    def test_update_unversioned(self):
+        VersionedDocument.col.insert({'name': 'FELD'})
+        document = VersionedDocument.find_one()
+        other = VersionedDocument.find_one()
+        document.name = 'SMITH'
+
+        document.save()
+
+        self.assertEqual(document.version, 1)
+        self.assertEqual(VersionedDocument.col.find_one(), document)
+        other.name = 'DOE'
+        self.assertRaises(ConflictError, other.save)
+
+    def test_conflict(self):
+        VersionedDocument({'name': 'FELD'}).save()
+        document = VersionedDocument.find_one()
+        other = VersionedDocument.find_one()
+
+        other.name = 'SMITH'
+        other.save()
+        document.name = 'DOE'
+
+        self.assertRaises(ConflictError, document.save)
+        self.assertEqual(document.version, 1)
+        self.assertEqual(VersionedDocument.col.find_one(),
+            {'_id': document._id, 'name': 'SMITH', 'version': 2})
+
+    def test_replace(self):
+        document = VersionedDocument({'name': 'FELD'})
+        document.save()
+        stale = VersionedDocument(dict(document))
+
+        VersionedDocument(dict(document, name='SMITH')).save()
+
+        self.assertEqual(VersionedDocument.col.find_one()['version'], 2)
+        self.assertRaises(ConflictError, stale.save)
+
+    def test_modify(self):
+        document = VersionedDocument({'views': 1})
+        document.save()
+
+        document.inc({'views': 1})
+
+        self.assertEqual(document.version, 2)
+        self.assertEqual(VersionedDocument.col.find_one(), document)
+
+    def test_mutate(self):
+        VersionedDocument({'tags': []}).save()
+        document = VersionedDocument.find_one()
+        other = VersionedDocument.find_one()
+        other.tags.append('other')
+        other.save()
+
+        document.mutate(lambda document: document.tags.append('new'))
+
+        self.assertEqual(document.tags, ['other', 'new'])
+        self.assertEqual(document.version, 3)
+        self.assertEqual(VersionedDocument.col.find_one(), document)
+
+    def test_mutate_retries(self):
+        document = VersionedDocument({'views': 1})
+        document.save()
+        mutation = Mock()
+
+        with patch.object(VersionedDocument, 'save') as mock_save:
+            mock_save.side_effect = ConflictError()
+            self.assertRaises(ConflictError, document.mutate, mutation,
+                              retries=2)
+
+        self.assertEqual(mutation.call_count, 3)
+
+class DocumentWriteBehindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure({'userdocument': {
+            'write_behind': {'batch_size': 100, 'max_delay': 60}}})
+
+    def tearDown(self):
+        UserDocument.flush()
+        UserDocument.col.remove()
+        ConnectionManager.configure()
+
+    def test_save(self):
+        user = UserDocument({'name': 'FELD', 'views': 1})
+        user.save()
+
+        self.assertTrue('_id' in user)
+        self.assertEqual(UserDocument.col.find_one(), None)
+
+        user.views += 1
+        user.save()
+        user.last_seen = 1
+        user.save()
+
+        self.assertEqual(UserDocument.flush(), 1)
+        self.assertEqual(UserDocument.col.find_one(), user)
+        stats = UserDocument.write_behind_stats()
+        self.assertEqual((stats['saves'], stats['coalesced'], stats['writes']),
+                         (3, 2, 1))
+
+    def test_update(self):
+        UserDocument.col.insert({'name': 'FELD', 'views': 1})
+        user = UserDocument.find_one()
+
+        user.views = 2
+        user.save()
+        del user.name
+        user.save()
+        UserDocument.flush()
+
+        self.assertEqual(UserDocument.col.find_one(),
+                         {'_id': user._id, 'views': 2})
+
+    def test_delete(self):
+        user = UserDocument({'name': 'FELD'})
+        user.save()
+        user.delete()
+        UserDocument.flush()
+
+        self.assertEqual(UserDocument.col.find_one(), None)
+
+    def test_modify_flush(self):
+        user = UserDocument({'name': 'FELD', 'views': 1})
+        user.save()
+        user.inc({'views': 1})
+
+        self.assertEqual(UserDocument.col.find_one()['views'], 2)
+
+    def test_reload_flush(self):
+        user = UserDocument({'name': 'FELD', 'views': 1})
+        user.save()
+        user.views = 2
+        user.save()
+
+        user.reload()
+
+        self.assertEqual(user.views, 2)
+
+    def test_cache_invalidated_on_flush(self):
+        ConnectionManager.configure({'userdocument': {
+            'write_behind': {'batch_size': 100, 'max_delay': 60},
+            'cache': {}}})
+        UserDocument.col.insert({'name': 'FELD', 'views': 0})
+        user = UserDocument.find_one()
+        user.views = 5
+        user.save()
+
+        self.assertEqual(UserDocument.find_one(user._id).views, 0)
+        UserDocument.flush()
+        self.assertEqual(UserDocument.find_one(user._id).views, 5)
+
+    def test_disabled(self):
+        self.assertEqual(DefaultDocument.write_behind_stats(), None)
+        self.assertEqual(DefaultDocument.flush(), 0)
+
+class PageDocument(Document):
+    indexes = [{'fields': ('kind', '-date', '-_id')}]
+
+class DocumentPaginateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        for number in xrange(25):
+            PageDocument({'kind': 'odd' if number % 2 else 'even',
+                          'date': number // 3, 'number': number}).save()
+
+    def tearDown(self):
+        PageDocument.col.remove()
+
+    def test_paginate(self):
+        pages = []
+        token = None
+        while True:
+            page, token = PageDocument.paginate({'kind': 'odd'}, ['-date'],
+                                                page_size=4, after=token)
+            pages.append([document.number for document in page])
+            if token is None:
+                break
+
+        self.assertEqual(pages, [[23, 21, 19, 17], [15, 13, 11, 9],
+                                 [7, 5, 3, 1]])
+        self.assertTrue(isinstance(page[0], PageDocument))
+
+    def test_paginate_by_id(self):
+        page, token = PageDocument.paginate(page_size=20)
+        last_page, last_token = PageDocument.paginate(after=token)
+
+        self.assertEqual([document.number for document in page + last_page],
+                         range(25))
+        self.assertEqual(last_token, None)
+
+    def test_paginate_nulls(self):
+        for number in xrange(25, 30):
+            PageDocument({'kind': 'null', 'date': None, 'number': number}).save()
+        PageDocument({'kind': 'null', 'number': 30}).save()
+        PageDocument({'kind': 'null', 'date': 1, 'number': 31}).save()
+
+        for sort_keys, expected in ((['-date'], [31, 30, 29, 28, 27, 26, 25]),
+                                    (['date'], [25, 26, 27, 28, 29, 30, 31])):
+            numbers = []
+            token = None
+            while True:
+                page, token = PageDocument.paginate({'kind': 'null'},
+                    sort_keys, page_size=2, after=token)
+                numbers.extend(document.number for document in page)
+                if token is None:
+                    break
+
+            self.assertEqual(numbers, expected)
+
+    def test_uncovered_sort(self):
+        self.assertRaises(ValueError, PageDocument.paginate, None, ['-date'])
+
+        page, _ = PageDocument.paginate(None, ['-date'], check_index=False)
+        self.assertEqual(page[0].date, 8)
+
 class DocumentConfigurationTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -293,6 +975,24 @@ class DocumentConfigurationTestCase(unittest.TestCase):
 
         self.assertEqual(UserDocument.col.name, col_name)
 
+    def test_configuration_cached(self):
+        col = UserDocument.col
+
+        with patch.object(ConnectionManager, 'get_config') as mock_get_config:
+            self.assertTrue(UserDocument.col is col)
+            self.assertTrue(UserDocument.db is col.database)
+
+        self.assertEqual(mock_get_config.call_count, 0)
+
+    def test_configuration_cache_invalidation(self):
+        col = UserDocument.col
+
+        ConnectionManager.configure()
+        self.assertFalse(UserDocument.col is col)
+
+        UserDocument.collection_name = 'my_collection'
+        self.assertEqual(UserDocument.col.name, 'my_collection')
+
 class DocumentIndexesTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -449,6 +1149,67 @@ class DocumentPropertiesTestCase(unittest.TestCase):
             t.test = 'something'
         self.assertRaises(CustomException, setter)
 
+    def test_property_added_later(self):
+        class LaterProperty(Document):
+            pass
+
+        document = LaterProperty()
+        document.test = 'field'
+        self.assertEqual(document, {'test': 'field'})
+
+        values = []
+        LaterProperty.test = property(lambda self: None,
+                                      lambda self, value: values.append(value))
+        document.test = 'property'
+        self.assertEqual(values, ['property'])
+
+    def test_private_attributes(self):
+        document = Document()
+        document._private = 42
+        document._id = 1
+
+        self.assertEqual(document, {'_id': 1})
+        self.assertEqual(document._private, 42)
+
+class DocumentAttributesTestCase(unittest.TestCase):
+
+    def test_missing_attribute(self):
+        document = Document({'a': 1})
+
+        self.assertRaises(AttributeError, getattr, document, 'b')
+        self.assertEqual(getattr(document, 'b', None), None)
+        self.assertFalse(hasattr(document, 'b'))
+
+    def test_pickle(self):
+        document = UserDocument._load({'_id': 1, 'first_name': 'Boris'})
+        document.name = 'FELD'
+
+        unpickled = pickle.loads(pickle.dumps(document, 2))
+
+        self.assertTrue(isinstance(unpickled, UserDocument))
+        self.assertEqual(unpickled, document)
+        self.assertEqual(unpickled._changes, {'name': True})
+
+    def test_deepcopy(self):
+        document = UserDocument({'nested': {'a': 1}})
+
+        duplicate = deepcopy(document)
+
+        self.assertEqual(duplicate, document)
+        self.assertFalse(duplicate.nested is document.nested)
+
+    def test_deepcopy_changes(self):
+        document = UserDocument._load({'_id': 1, 'nested': {'a': 1}})
+        document.name = 'FELD'
+
+        duplicate = deepcopy(document)
+        duplicate.nested['a'] = 2
+
+        self.assertEqual(duplicate._collect_changes(),
+                         {'name': True, 'nested': True})
+        self.assertEqual(document._collect_changes(), {'name': True})
+        self.assertFalse(duplicate._changes is document._changes)
+
 class DocumentDefaultsTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -527,6 +1288,68 @@ class DocumentDefaultsTestCase(unittest.TestCase):
         self.assertEqual(doc2.a, [])
 
 
+class DocumentDefaultsCompilationTestCase(unittest.TestCase):
+
+    def test_compiled_defaults(self):
+        template = {'nested': {'list': [1]}}
+
+        class CompiledDocument(Document):
+            default_values = {'a': 1, 'b': (1, 'b'), 'c': [1, 2],
+                              'd': {'e': 1}, 'f': list, 'g': template}
+
+        doc1 = CompiledDocument()
+        doc2 = CompiledDocument()
+
+        self.assertEqual(doc1, {'a': 1, 'b': (1, 'b'), 'c': [1, 2],
+            'd': {'e': 1}, 'f': [], 'g': {'nested': {'list': [1]}}})
+        self.assertTrue(doc1.b is doc2.b)
+        for key in ('c', 'd', 'f', 'g'):
+            self.assertFalse(doc1[key] is doc2[key])
+        self.assertFalse(doc1.g['nested'] is template['nested'])
+
+    def test_subclass_refresh(self):
+        class ParentDocument(Document):
+            default_values = {'a': 1}
+
+        class ChildDocument(ParentDocument):
+            pass
+
+        class OtherChildDocument(ParentDocument):
+            default_values = {'b': 2}
+
+        ParentDocument.default_values = {'a': 2}
+
+        self.assertEqual(ParentDocument(), {'a': 2})
+        self.assertEqual(ChildDocument(), {'a': 2})
+        self.assertEqual(OtherChildDocument(), {'b': 2})
+
+        del OtherChildDocument.default_values
+        self.assertEqual(OtherChildDocument(), {'a': 2})
+
+    def test_benchmark(self):
+        default_values = {'a': 1, 'b': 'b', 'c': None, 'd': 1.5, 'e': True,
+                          'f': [], 'g': {'h': 0}}
+
+        class BenchmarkDocument(Document):
+            pass
+        BenchmarkDocument.default_values = default_values
+
+        def reference():
+            init = {}
+            for key, value in default_values.items():
+                init[key] = value() if hasattr(value, '__call__') else \
+                    deepcopy(value)
+            return dict(init)
+
+        #Best of several runs, so that a busy host does not skew the ratio
+        reference_time = min(timeit.repeat(reference, number=2000, repeat=7))
+        compiled_time = min(timeit.repeat(BenchmarkDocument, number=2000,
+                                          repeat=7))
+
+        self.assertEqual(BenchmarkDocument(), reference())
+        #Compiled defaults are about 7 times faster
+        self.assertTrue(compiled_time * 3 < reference_time)
+
 class NestedDocumentTestCase(unittest.TestCase):
 
     def tearDown(self):
@@ -608,6 +1431,56 @@ class DocumentValidationTestCase(unittest.TestCase):
 
         self.assertRaises(ValidationError, doc.save, validate=True)
 
+class SchemaDocument(Document):
+    required_fields = ['name']
+    schema = {'name': Field(basestring), 'age': Field(int, min=0)}
+
+class DocumentSchemaTestCase(unittest.TestCase):
+
+    def test_valid(self):
+        SchemaDocument({'name': 'FELD', 'age': 21})._validate()
+
+    def test_required_fields(self):
+        document = SchemaDocument({'age': 21})
+
+        self.assertRaises(ValidationError, document._validate)
+
+    def test_invalid(self):
+        document = SchemaDocument({'name': 'FELD', 'age': -1})
+
+        self.assertRaises(ValidationError, document._validate)
+
+    def test_validate_changed_fields_only(self):
+        document = SchemaDocument._load({'name': 'FELD', 'age': -1})
+        document._validate()
+
+        document.name = 42
+        self.assertRaises(ValidationError, document._validate)
+
+    def test_no_copy(self):
+        document = SchemaDocument({'name': 'FELD'})
+
+        with patch.object(SchemaDocument, '__copy__') as mock_copy:
+            document._validate()
+
+        self.assertEqual(mock_copy.call_count, 0)
+
+    def test_custom_validate(self):
+        def validate(self):
+            if self.name == 'SMITH':
+                raise ValidationError()
+
+        with patch.object(SchemaDocument, 'validate', validate):
+            SchemaDocument({'name': 'FELD'})._validate()
+            self.assertRaises(ValidationError,
+                              SchemaDocument({'name': 'SMITH'})._validate)
+
+    def test_save(self):
+        document = SchemaDocument({'age': 21})
+
+        self.assertRaises(ValidationError, document.save, validate=True)
+        self.assertFalse('_id' in document)
+
 class DocumentPrivateProtected(unittest.TestCase):
 
     def setUp(self):
@@ -654,3 +1527,98 @@ class DocumentCursorTestCase(unittest.TestCase):
         objects = Document.find().skip(2).limit(5)
 
         self.assertEqual(range(2, 7), [o['i'] for o in objects])
+
+    def test_chained_methods(self):
+        for i in range(10):
+            Document.col.insert({'i': i})
+
+        cursor = Document.find().sort('i', pymongo.DESCENDING).skip(1) \
+            .limit(3).hint([('_id', pymongo.ASCENDING)]).batch_size(2)
+
+        self.assertTrue(isinstance(cursor, DocumentCursor))
+        documents = list(cursor)
+        self.assertEqual([8, 7, 6], [o.i for o in documents])
+        self.assertTrue(all(isinstance(o, Document) for o in documents))
+
+    def test_batches(self):
+        for i in range(5):
+            Document.col.insert({'i': i})
+
+        batches = list(Document.find().sort('i').batches(2))
+
+        self.assertEqual([[o.i for o in batch] for batch in batches],
+                         [[0, 1], [2, 3], [4]])
+        self.assertTrue(isinstance(batches[0][0], Document))
+
+    def test_raw_batches(self):
+        mock_cursor = Mock()
+        mock_cursor.__iter__ = Mock(
+            return_value=iter([{'i': 0}, {'i': 1}, {'i': 2}]))
+        cursor = DocumentCursor(mock_cursor, Document)
+
+        batches = list(cursor.raw_batches(2))
+
+        self.assertEqual(batches, [[{'i': 0}, {'i': 1}], [{'i': 2}]])
+        self.assertEqual(type(batches[0][0]), dict)
+        self.assertEqual(mock_cursor.batch_size.call_args_list, [Call(2)])
+
+    def test_raw_batches_server(self):
+        server_batches = [[{'i': 0}, {'i': 1}, {'i': 2}], [{'i': 3}], []]
+        collection = Connection(_connect=False).test.col
+        pymongo_cursor = pymongo.cursor.Cursor(collection)
+
+        def refresh():
+            pymongo_cursor._Cursor__data.extend(server_batches.pop(0))
+            return len(pymongo_cursor._Cursor__data)
+
+        with patch.object(pymongo_cursor, '_refresh', side_effect=refresh), \
+                patch.object(pymongo_cursor, 'next') as mock_next:
+            batches = list(DocumentCursor(pymongo_cursor, Document)
+                           .raw_batches(2))
+
+        self.assertEqual(batches, [[{'i': 0}, {'i': 1}, {'i': 2}], [{'i': 3}]])
+        self.assertEqual(mock_next.call_count, 0)
+
+    def test_prefetch(self):
+        for i in range(10):
+            Document.col.insert({'i': i})
+
+        cursor = Document.find(sort=[('i', pymongo.ASCENDING)], prefetch=2)
+
+        self.assertEqual([o.i for o in cursor.batch_size(3)], range(10))
+
+    def test_prefetch_batches(self):
+        mock_cursor = Mock()
+        mock_cursor.__iter__ = Mock(return_value=iter(range(5)))
+        cursor = DocumentCursor(mock_cursor, Mock()).prefetch(1)
+
+        self.assertEqual(list(cursor.raw_batches(2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(mock_cursor.close.call_count, 1)
+
+    def test_prefetch_error(self):
+        def results():
+            yield {'i': 0}
+            raise OperationFailure('Error while reading')
+
+        mock_cursor = Mock()
+        mock_cursor.__iter__ = Mock(return_value=results())
+        cursor = DocumentCursor(mock_cursor, Document).prefetch().batch_size(1)
+
+        self.assertEqual(cursor.next(), {'i': 0})
+        self.assertRaises(OperationFailure, cursor.next)
+        self.assertRaises(OperationFailure, cursor.next)
+
+    def test_prefetch_close(self):
+        def results():
+            i = 0
+            while True:
+                yield {'i': i}
+                i += 1
+
+        mock_cursor = Mock()
+        mock_cursor.__iter__ = Mock(return_value=results())
+        cursor = DocumentCursor(mock_cursor, Document).prefetch()
+
+        self.assertEqual(cursor.next(), {'i': 0})
+        cursor.close()
+        self.assertEqual(mock_cursor.close.call_count, 1)
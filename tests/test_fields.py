@@ -0,0 +1,87 @@
+import unittest
+
+from picomongo.exceptions import ValidationError
+from picomongo.fields import Field, compile_schema
+
+class FieldTestCase(unittest.TestCase):
+
+    def assertValid(self, field, value):
+        field.compile('field')(value)
+
+    def assertInvalid(self, field, value):
+        self.assertRaises(ValidationError, field.compile('field'), value)
+
+    def test_type(self):
+        field = Field(int)
+
+        self.assertValid(field, 1)
+        self.assertInvalid(field, '1')
+        self.assertInvalid(field, None)
+        self.assertValid(Field((int, float)), 1.5)
+
+    def test_null(self):
+        field = Field(int, null=True)
+
+        self.assertValid(field, None)
+        self.assertInvalid(field, '1')
+
+    def test_bounds(self):
+        field = Field(min=0, max=10)
+
+        self.assertValid(field, 0)
+        self.assertValid(field, 10)
+        self.assertInvalid(field, -1)
+        self.assertInvalid(field, 11)
+
+    def test_length(self):
+        field = Field(basestring, min_length=1, max_length=3)
+
+        self.assertValid(field, 'abc')
+        self.assertInvalid(field, '')
+        self.assertInvalid(field, 'abcd')
+
+    def test_choices(self):
+        field = Field(choices=('a', 'b'))
+
+        self.assertValid(field, 'a')
+        self.assertInvalid(field, 'c')
+
+    def test_nested_schema(self):
+        field = Field(dict, schema={'city': Field(basestring, required=True),
+                                    'zip': Field(int)})
+
+        self.assertValid(field, {'city': 'Paris'})
+        self.assertValid(field, {'city': 'Paris', 'other': None})
+        self.assertInvalid(field, {'zip': 75000})
+        self.assertInvalid(field, {'city': 'Paris', 'zip': '75000'})
+        self.assertInvalid(field, 'Paris')
+
+    def test_items(self):
+        field = Field(list, items=Field(int))
+
+        self.assertValid(field, [1, 2])
+        self.assertInvalid(field, [1, '2'])
+
+    def test_validator(self):
+        field = Field(validator=lambda value: value % 2 == 0)
+
+        self.assertValid(field, 2)
+        self.assertInvalid(field, 3)
+
+    def test_error_path(self):
+        validators, _ = compile_schema(
+            {'address': Field(schema={'city': Field(basestring)})})
+
+        try:
+            validators['address']({'city': 1})
+        except ValidationError as e:
+            self.assertTrue(str(e).startswith('address.city:'))
+        else:
+            self.fail('ValidationError not raised')
+
+    def test_required(self):
+        validators, required = compile_schema(
+            {'a': Field(required=True), 'b': Field()}, ['c'])
+
+        self.assertEqual(sorted(validators), ['a', 'b'])
+        self.assertEqual(sorted(required), ['a', 'c'])
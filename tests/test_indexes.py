@@ -0,0 +1,116 @@
+import unittest
+
+import pymongo
+
+from mock import Mock
+
+from picomongo import Document
+from picomongo.document import DocumentMeta
+from picomongo.indexes import IndexManager, index_keys
+from utils import Call
+
+class IndexedDocument(Document):
+    indexes = [{'fields': ('name',)},
+               {'fields': ('email', '-date'), 'unique': True}]
+
+OTHER_INDEXES = [{'fields': ('name',), 'sparse': True}]
+
+def mock_collection(full_name, indexes):
+    col = Mock()
+    col.full_name = full_name
+    information = {'_id_': {'key': [('_id', 1)], 'v': 1}}
+    information.update(indexes)
+    col.index_information.return_value = information
+    return col
+
+def document(col):
+    '''Stand-in for IndexedDocument using col.
+    '''
+    return Mock(indexes=IndexedDocument.indexes, col=col)
+
+class IndexManagerTestCase(unittest.TestCase):
+
+    def test_registry(self):
+        class RegisteredDocument(Document):
+            pass
+
+        self.assertTrue(RegisteredDocument in DocumentMeta.registry)
+        self.assertTrue(IndexedDocument in DocumentMeta.registry)
+
+    def test_index_keys(self):
+        self.assertEqual(index_keys(('a', '-b')),
+                         [('a', pymongo.ASCENDING), ('b', pymongo.DESCENDING)])
+
+    def test_plan_create(self):
+        col = mock_collection('test.indexed',
+                              {'name_1': {'key': [('name', 1.0)], 'v': 1}})
+
+        manager = IndexManager([document(col)])
+        plan = manager.sync(dry_run=True)
+
+        self.assertEqual([(change.action, change.name) for change in plan],
+                         [('create', 'email_1_date_-1')])
+        self.assertEqual(plan[0].keys, (('email', 1), ('date', -1)))
+        self.assertFalse(col.create_index.called)
+
+    def test_plan_up_to_date(self):
+        col = mock_collection('test.indexed',
+            {'name_1': {'key': [('name', 1)], 'v': 1, 'background': True},
+             'email_1_date_-1': {'key': [('email', 1), ('date', -1)],
+                                 'unique': True}})
+
+        self.assertEqual(IndexManager([document(col)]).plan(), [])
+
+    def test_plan_stale_and_conflict(self):
+        col = mock_collection('test.indexed',
+            {'name_1': {'key': [('name', 1)], 'unique': True},
+             'old_1': {'key': [('old', 1)]},
+             'email_1_date_-1': {'key': [('email', 1), ('date', -1)],
+                                 'unique': True}})
+
+        plan = IndexManager([document(col)]).sync()
+
+        self.assertEqual([(change.action, change.name) for change in plan],
+                         [('conflict', 'name_1'), ('stale', 'old_1')])
+        self.assertFalse(col.create_index.called)
+        self.assertFalse(col.drop_index.called)
+
+    def test_drop(self):
+        col = mock_collection('test.indexed',
+            {'name_1': {'key': [('name', 1)], 'unique': True},
+             'old_1': {'key': [('old', 1)]}})
+
+        plan = IndexManager([document(col)], drop=True).sync()
+
+        self.assertEqual([(change.action, change.name) for change in plan],
+                         [('drop', 'name_1'), ('drop', 'old_1'),
+                          ('create', 'name_1'), ('create', 'email_1_date_-1')])
+        self.assertEqual(col.drop_index.call_args_list,
+                         [Call('name_1'), Call('old_1')])
+        self.assertEqual(col.create_index.call_args_list,
+            [Call([('name', 1)], background=True, name='name_1'),
+             Call([('email', 1), ('date', -1)], unique=True, background=True,
+                  name='email_1_date_-1')])
+
+    def test_concurrent_collections(self):
+        col = mock_collection('test.indexed', {})
+        other_col = mock_collection('test.other', {})
+
+        manager = IndexManager([Mock(indexes=IndexedDocument.indexes, col=col),
+                                Mock(indexes=OTHER_INDEXES, col=other_col)])
+        plan = manager.sync()
+
+        self.assertEqual(len(plan), 3)
+        self.assertEqual(col.create_index.call_count, 2)
+        self.assertEqual(other_col.create_index.call_args_list,
+            [Call([('name', 1)], sparse=True, background=True, name='name_1')])
+
+    def test_shared_collection(self):
+        col = mock_collection('test.indexed', {})
+
+        manager = IndexManager([Mock(indexes=IndexedDocument.indexes, col=col),
+                                Mock(indexes=OTHER_INDEXES, col=col)])
+        plan = manager.plan()
+
+        self.assertEqual([change.name for change in plan],
+                         ['name_1', 'email_1_date_-1'])
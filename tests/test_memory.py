@@ -0,0 +1,370 @@
+import re
+import unittest
+
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    InvalidOperation, OperationFailure
+
+from picomongo import Document, ConnectionManager, memory
+from picomongo.memory import MemoryConnection, match
+
+URI = 'memory://test_memory'
+
+class UniqueDocument(Document):
+    indexes = [{'fields': ('email',), 'unique': True}]
+
+class MatchTestCase(unittest.TestCase):
+
+    document = {'name': 'FELD', 'age': 32, 'tags': ['a', 'b'],
+                'address': {'city': 'Paris'},
+                'children': [{'name': 'A', 'age': 4}, {'name': 'B', 'age': 9}],
+                'empty': None, 'date': datetime(2014, 1, 1)}
+
+    def assertMatches(self, spec, matches=True):
+        self.assertEqual(match(self.document, spec), matches, spec)
+
+    def test_equality(self):
+        self.assertMatches({})
+        self.assertMatches({'name': 'FELD', 'age': 32})
+        self.assertMatches({'name': 'DOE'}, False)
+        self.assertMatches({'address.city': 'Paris'})
+        self.assertMatches({'address': {'city': 'Paris'}})
+        self.assertMatches({'tags': 'a'})
+        self.assertMatches({'tags': ['a', 'b']})
+        self.assertMatches({'tags.1': 'b'})
+        self.assertMatches({'children.name': 'B'})
+        self.assertMatches({'missing': None})
+        self.assertMatches({'empty': None})
+        self.assertMatches({'age': True}, False)
+
+    def test_comparison(self):
+        self.assertMatches({'age': {'$gt': 30, '$lte': 32}})
+        self.assertMatches({'age': {'$lt': 32}}, False)
+        self.assertMatches({'age': {'$gt': '30'}}, False)
+        self.assertMatches({'children.age': {'$gte': 9}})
+        self.assertMatches({'missing': {'$lt': 1}}, False)
+        self.assertMatches({'date': {'$gt': 5}}, False)
+        self.assertMatches({'date': {'$lt': datetime(2015, 1, 1)}})
+
+    def test_sets(self):
+        self.assertMatches({'name': {'$in': ['DOE', 'FELD']}})
+        self.assertMatches({'tags': {'$in': ['c', 'b']}})
+        self.assertMatches({'name': {'$nin': ['DOE', 'FELD']}}, False)
+        self.assertMatches({'missing': {'$nin': [1]}})
+        self.assertMatches({'name': {'$ne': 'FELD'}}, False)
+        self.assertMatches({'missing': {'$ne': 1}})
+        self.assertMatches({'tags': {'$all': ['b', 'a']}})
+        self.assertMatches({'tags': {'$all': ['a', 'c']}}, False)
+        self.assertMatches({'tags': {'$size': 2}})
+
+    def test_element(self):
+        self.assertMatches({'empty': {'$exists': True}})
+        self.assertMatches({'missing': {'$exists': True}}, False)
+        self.assertMatches({'age': {'$type': 16}})
+        self.assertMatches({'age': {'$mod': [10, 2]}})
+        self.assertMatches({'children': {'$elemMatch': {'name': 'A',
+                                                        'age': 4}}})
+        self.assertMatches({'children': {'$elemMatch': {'name': 'A',
+                                                        'age': 9}}}, False)
+        self.assertMatches({'tags': {'$elemMatch': {'$gte': 'b'}}})
+
+    def test_regex(self):
+        self.assertMatches({'name': re.compile('^F')})
+        self.assertMatches({'name': {'$regex': '^f', '$options': 'i'}})
+        self.assertMatches({'tags': {'$regex': 'c'}}, False)
+        self.assertMatches({'name': {'$not': re.compile('^F')}}, False)
+        self.assertMatches({'age': {'$not': {'$gt': 40}}})
+
+    def test_logical(self):
+        self.assertMatches({'$or': [{'name': 'DOE'}, {'age': 32}]})
+        self.assertMatches({'$and': [{'name': 'FELD'}, {'age': 30}]}, False)
+        self.assertMatches({'$nor': [{'name': 'DOE'}, {'age': 30}]})
+
+    def test_unsupported(self):
+        self.assertRaises(OperationFailure, match, self.document,
+                          {'$where': 'true'})
+        self.assertRaises(OperationFailure, match, self.document,
+                          {'name': {'$near': [0, 0]}})
+
+class MemoryCollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MemoryConnection(URI)
+        self.col = self.connection.test.users
+
+    def tearDown(self):
+        memory.clear(URI)
+
+    def insert_users(self):
+        self.col.insert([{'_id': 1, 'name': 'A', 'age': 30},
+                         {'_id': 2, 'name': 'B', 'age': 20},
+                         {'_id': 3, 'name': 'C', 'age': 30},
+                         {'_id': 4, 'name': 'D'}])
+
+    def test_insert(self):
+        document = {'name': 'A', 'tags': ['a']}
+        _id = self.col.insert(document)
+
+        self.assertTrue(isinstance(_id, ObjectId))
+        self.assertEqual(document['_id'], _id)
+        self.assertEqual(self.col.count(), 1)
+
+        document['tags'].append('b')
+        found = self.col.find_one(_id)
+        self.assertEqual(found, {'_id': _id, 'name': 'A', 'tags': ['a']})
+        found['tags'].append('c')
+        self.assertEqual(self.col.find_one({'_id': _id})['tags'], ['a'])
+
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'_id': _id})
+
+    def test_shared_data(self):
+        self.col.insert({'_id': 1})
+
+        self.assertEqual(MemoryConnection(URI).test.users.count(), 1)
+        self.assertEqual(MemoryConnection('memory://other').test.users.count(),
+                         0)
+        self.assertEqual(self.connection.database_names(), ['test'])
+        self.assertEqual(self.connection.test.collection_names(), ['users'])
+
+        memory.clear(URI)
+        self.assertEqual(self.col.count(), 0)
+
+    def test_find(self):
+        self.insert_users()
+
+        self.assertEqual([user['_id'] for user in self.col.find()],
+                         [1, 2, 3, 4])
+        self.assertEqual([user['_id'] for user in
+                          self.col.find({'age': 30})], [1, 3])
+        self.assertEqual([user['_id'] for user in
+                          self.col.find({'_id': {'$in': [3, 1, 5]}})], [3, 1])
+        self.assertEqual(self.col.find_one({'name': 'E'}), None)
+        self.assertEqual(self.col.find({'age': 30}).count(), 2)
+
+    def test_sort_skip_limit(self):
+        self.insert_users()
+
+        cursor = self.col.find(sort=[('age', -1), ('name', 1)])
+        self.assertEqual([user['_id'] for user in cursor], [1, 3, 2, 4])
+
+        cursor = self.col.find().sort('age').skip(1).limit(2)
+        self.assertEqual([user['_id'] for user in cursor], [2, 1])
+        self.assertEqual(cursor.count(), 4)
+        self.assertEqual(cursor.count(with_limit_and_skip=True), 2)
+
+        self.assertEqual(self.col.find().sort('_id', -1)[1]['_id'], 3)
+        self.assertEqual([user['_id'] for user in self.col.find()[1:3]],
+                         [2, 3])
+
+    def test_cursor(self):
+        self.insert_users()
+        cursor = self.col.find()
+
+        self.assertEqual(next(cursor)['_id'], 1)
+        self.assertRaises(InvalidOperation, cursor.limit, 1)
+        self.assertEqual(len(list(cursor)), 3)
+        self.assertFalse(cursor.alive)
+        self.assertEqual(len(list(cursor.rewind())), 4)
+        self.assertEqual(len(list(cursor.clone())), 4)
+        self.assertEqual(sorted(self.col.find().distinct('age')), [20, 30])
+
+    def test_projection(self):
+        self.col.insert({'_id': 1, 'name': 'A', 'address': {'city': 'Paris',
+                                                            'zip': '75001'}})
+
+        self.assertEqual(self.col.find_one(1, ['name']),
+                         {'_id': 1, 'name': 'A'})
+        self.assertEqual(self.col.find_one(1, {'address.city': 1, '_id': 0}),
+                         {'address': {'city': 'Paris'}})
+        self.assertEqual(self.col.find_one(1, {'address': 0}),
+                         {'_id': 1, 'name': 'A'})
+
+    def test_update(self):
+        self.insert_users()
+
+        result = self.col.update({'age': 30}, {'$inc': {'age': 1},
+                                               '$set': {'tags': ['a', 'b']}},
+                                 multi=True)
+        self.assertEqual(result['n'], 2)
+        self.assertEqual(self.col.find({'age': 31}).count(), 2)
+
+        self.col.update({'_id': 1}, {'$unset': {'age': 1},
+                                     '$pull': {'tags': 'a'},
+                                     '$push': {'tags': 'c'}})
+        self.assertEqual(self.col.find_one(1),
+                         {'_id': 1, 'name': 'A', 'tags': ['b', 'c']})
+
+        self.col.update({'_id': 2}, {'name': 'E'})
+        self.assertEqual(self.col.find_one(2), {'_id': 2, 'name': 'E'})
+
+        self.assertEqual(self.col.update({'_id': 5}, {'$set': {'a': 1}})['n'],
+                         0)
+        self.assertRaises(OperationFailure, self.col.update, {'_id': 1},
+                          {'$set': {'_id': 6}})
+        self.assertRaises(OperationFailure, self.col.update, {'_id': 1},
+                          {'$rename': {'name': 'first_name'}})
+
+    def test_upsert(self):
+        result = self.col.update({'name': 'A', 'age': {'$gt': 18}},
+                                 {'$set': {'views': 1},
+                                  '$setOnInsert': {'new': True}}, upsert=True)
+
+        self.assertFalse(result['updatedExisting'])
+        self.assertEqual(self.col.find_one(result['upserted']),
+                         {'_id': result['upserted'], 'name': 'A',
+                          'views': 1, 'new': True})
+
+        self.col.update({'name': 'A'}, {'$set': {'views': 2},
+                                        '$setOnInsert': {'new': False}},
+                        upsert=True)
+        self.assertEqual(self.col.find_one({'name': 'A'})['new'], True)
+
+        self.col.save({'_id': 2, 'name': 'B'})
+        self.col.save({'_id': 2, 'name': 'C'})
+        self.assertEqual(self.col.find_one(2), {'_id': 2, 'name': 'C'})
+
+    def test_remove(self):
+        self.insert_users()
+
+        self.assertEqual(self.col.remove({'age': 30})['n'], 2)
+        self.assertEqual(self.col.remove(2)['n'], 1)
+        self.assertEqual(self.col.remove()['n'], 1)
+        self.assertEqual(self.col.count(), 0)
+
+    def test_find_and_modify(self):
+        self.insert_users()
+
+        old = self.col.find_and_modify({'age': 30}, {'$inc': {'age': 1}},
+                                       sort=[('name', -1)])
+        self.assertEqual(old, {'_id': 3, 'name': 'C', 'age': 30})
+        new = self.col.find_and_modify({'_id': 3}, {'$inc': {'age': 1}},
+                                       new=True)
+        self.assertEqual(new['age'], 32)
+
+        created = self.col.find_and_modify({'_id': 5}, {'$set': {'age': 1}},
+                                           upsert=True, new=True)
+        self.assertEqual(created, {'_id': 5, 'age': 1})
+
+        removed = self.col.find_and_modify({'_id': 5}, remove=True)
+        self.assertEqual(removed['_id'], 5)
+        self.assertEqual(self.col.find_one(5), None)
+
+    def test_unique_index(self):
+        self.insert_users()
+
+        self.assertRaises(DuplicateKeyError, self.col.ensure_index, 'age',
+                          unique=True)
+        name = self.col.ensure_index([('name', 1)], unique=True)
+        self.assertEqual(name, 'name_1')
+
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'name': 'A'})
+        self.assertRaises(DuplicateKeyError, self.col.update, {'_id': 2},
+                          {'$set': {'name': 'A'}})
+        self.assertEqual(self.col.find_one(2)['name'], 'B')
+
+        self.col.remove(1)
+        self.col.update({'_id': 2}, {'$set': {'name': 'A'}})
+        self.col.insert({'name': 'B'})
+
+        information = self.col.index_information()
+        self.assertEqual(sorted(information), ['_id_', 'name_1'])
+        self.assertEqual(information['name_1']['key'], [('name', 1)])
+        self.assertTrue(information['name_1']['unique'])
+
+        self.col.drop_index('name_1')
+        self.col.insert({'name': 'B'})
+        self.assertRaises(OperationFailure, self.col.drop_index, 'name_1')
+
+    def test_sparse_unique_index(self):
+        self.col.create_index('email', unique=True, sparse=True)
+        self.col.insert([{'name': 'A'}, {'name': 'B'}])
+        self.col.insert({'email': 'a@b.c'})
+
+        self.assertRaises(DuplicateKeyError, self.col.insert,
+                          {'email': 'a@b.c'})
+
+    def test_bulk(self):
+        self.insert_users()
+
+        bulk = self.col.initialize_unordered_bulk_op()
+        bulk.insert({'_id': 5, 'name': 'E'})
+        bulk.find({'_id': 1}).update_one({'$set': {'age': 40}})
+        bulk.find({'_id': 6}).upsert().replace_one({'name': 'F'})
+        bulk.find({'age': 30}).remove()
+        result = bulk.execute()
+
+        self.assertEqual((result['nInserted'], result['nMatched'],
+                          result['nUpserted'], result['nRemoved']),
+                         (1, 1, 1, 1))
+        self.assertEqual([user['_id'] for user in self.col.find()],
+                         [1, 2, 4, 5, 6])
+        self.assertRaises(InvalidOperation, bulk.execute)
+
+    def test_bulk_errors(self):
+        self.insert_users()
+
+        for ordered, count in ((True, 4), (False, 5)):
+            if ordered:
+                bulk = self.col.initialize_ordered_bulk_op()
+            else:
+                bulk = self.col.initialize_unordered_bulk_op()
+            bulk.insert({'_id': 1})
+            bulk.insert({'name': 'E'})
+            try:
+                bulk.execute()
+            except BulkWriteError as error:
+                self.assertEqual(error.details['writeErrors'][0]['code'],
+                                 11000)
+            else:
+                self.fail('BulkWriteError not raised')
+            self.assertEqual(self.col.count(), count)
+
+    def test_explain(self):
+        self.insert_users()
+        self.col.ensure_index('name')
+
+        self.assertEqual(self.col.find({'age': 30}).explain()['cursor'],
+                         'BasicCursor')
+        explain = self.col.find({'name': 'A'}).explain()
+        self.assertEqual((explain['cursor'], explain['n']),
+                         ('BtreeCursor name_1', 1))
+
+class MemoryDocumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure({'_default_': {'uri': URI}})
+
+    def tearDown(self):
+        memory.clear(URI)
+        ConnectionManager.configure({'_default_': {'uri':
+                                                   'mongodb://localhost'}},
+                                    lazy=True)
+
+    def test_configuration(self):
+        self.assertTrue(isinstance(UniqueDocument.con, MemoryConnection))
+        self.assertEqual(UniqueDocument.col.full_name, 'test.uniquedocument')
+
+    def test_document(self):
+        UniqueDocument.generate_index()
+        document = UniqueDocument({'email': 'a@b.c', 'views': 0})
+        document.save()
+
+        loaded = UniqueDocument.find_one({'email': 'a@b.c'})
+        loaded.views += 1
+        loaded.save()
+        loaded.inc({'views': 1})
+        document.reload()
+
+        self.assertEqual(document.views, 2)
+        self.assertEqual(loaded.views, 2)
+        self.assertRaises(DuplicateKeyError,
+                          UniqueDocument({'email': 'a@b.c'}).save)
+
+        self.assertEqual(UniqueDocument.save_many(
+            UniqueDocument({'email': '%d@b.c' % i}) for i in range(10)), 10)
+        page, token = UniqueDocument.paginate(page_size=5)
+        self.assertEqual(len(page), 5)
+        self.assertEqual(len(UniqueDocument.paginate(page_size=5,
+                                                     after=token)[0]), 5)
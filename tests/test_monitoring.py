@@ -0,0 +1,197 @@
+import unittest
+
+from mock import Mock, patch
+
+from picomongo import Document, ConnectionManager, monitoring
+from picomongo.monitoring import HistogramCollector, OperationEvent, \
+    StatsdListener, instrumented
+
+class UserDocument(Document):
+    pass
+
+def event(operation='find_one', duration=0.01, error=None):
+    return OperationEvent(UserDocument, 'UserDocument', 'test.user_document',
+                          operation, duration, 1, None, error, None)
+
+class ListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        monitoring.register(self.events.append)
+
+    def tearDown(self):
+        monitoring.unregister(self.events.append)
+
+    def test_instrumented(self):
+        class Owner(object):
+            config_name = 'owner'
+            col = Mock(full_name='test.owner')
+
+            @instrumented('load', lambda owner, result: len(result))
+            def load(self, count):
+                return range(count)
+
+        Owner().load(3)
+
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertTrue(event.document_class is Owner)
+        self.assertEqual((event.config_name, event.collection, event.operation,
+                          event.documents, event.bytes, event.error),
+                         ('owner', 'test.owner', 'load', 3, None, None))
+        self.assertTrue(event.duration >= 0)
+
+    def test_instrumented_error(self):
+        error = ValueError()
+
+        class Owner(object):
+            config_name = None
+
+            @instrumented('fail')
+            def fail(self):
+                raise error
+
+        self.assertRaises(ValueError, Owner().fail)
+        self.assertTrue(self.events[0].error is error)
+        self.assertEqual(self.events[0].config_name, 'owner')
+        self.assertEqual(self.events[0].collection, None)
+
+    def test_listener_error(self):
+        failing = Mock(side_effect=ValueError())
+        monitoring.register(failing)
+        try:
+            monitoring.publish(UserDocument, 'find_one', 0.01)
+        finally:
+            monitoring.unregister(failing)
+
+        self.assertEqual(failing.call_count, 1)
+        self.assertEqual(len(self.events), 1)
+
+    def test_unregister(self):
+        monitoring.unregister(self.events.append)
+        self.assertFalse(monitoring.enabled())
+        monitoring.publish(UserDocument, 'find_one', 0.01)
+        self.assertEqual(self.events, [])
+
+class DocumentMonitoringTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        self.events = []
+        monitoring.register(self.events.append)
+
+    def tearDown(self):
+        monitoring.unregister(self.events.append)
+        UserDocument.col.remove()
+
+    def operations(self):
+        return [(event.operation, event.documents) for event in self.events]
+
+    def test_operations(self):
+        user = UserDocument({'name': 'FELD'})
+        user.save()
+        user = UserDocument.find_one({'name': 'FELD'})
+        self.assertEqual(UserDocument.find_one({'name': 'DOE'}), None)
+        user.reload()
+        user.delete()
+
+        self.assertEqual(self.operations(),
+                         [('save', 1), ('find_one', 1), ('find_one', 0),
+                          ('reload', 1), ('delete', 1)])
+        self.assertEqual(self.events[0].collection,
+                         UserDocument.col.full_name)
+        #Documents are not encoded again to know their size
+        self.assertEqual([event.bytes for event in self.events],
+                         [None] * 5)
+
+    def test_find(self):
+        UserDocument.col.insert([{'name': 'A'}, {'name': 'B'}])
+
+        cursor = UserDocument.find()
+        self.assertEqual(len(list(cursor)), 2)
+        cursor.close()
+
+        self.assertEqual(self.operations(), [('find', 2)])
+
+    def test_find_batches(self):
+        UserDocument.col.insert([{'name': 'A'}, {'name': 'B'}])
+
+        batches = list(UserDocument.find().batches(1))
+
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(self.operations(), [('find', 2)])
+
+    def test_find_closed(self):
+        UserDocument.col.insert([{'name': 'A'}, {'name': 'B'}])
+
+        with UserDocument.find() as cursor:
+            next(cursor)
+
+        self.assertEqual(self.operations(), [('find', 1)])
+
+    def test_not_monitored(self):
+        monitoring.unregister(self.events.append)
+
+        UserDocument({'name': 'FELD'}).save()
+        self.assertEqual(len(list(UserDocument.find())), 1)
+
+        self.assertEqual(self.events, [])
+
+class HistogramCollectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = HistogramCollector()
+        for duration in range(1, 101):
+            self.collector(event(duration=duration / 1000.))
+        self.collector(event('save', 0.5, ValueError()))
+
+    def test_stats(self):
+        stats = self.collector.stats()
+
+        find_one = stats[('UserDocument', 'find_one')]
+        self.assertEqual((find_one['p50'], find_one['p95'], find_one['p99']),
+                         (0.051, 0.096, 0.1))
+        self.assertEqual((find_one['count'], find_one['errors'],
+                          find_one['documents']), (100, 0, 100))
+        self.assertAlmostEqual(find_one['total'], 5.05)
+        self.assertEqual(stats[('UserDocument', 'save')]['errors'], 1)
+
+    def test_samples(self):
+        collector = HistogramCollector(samples=10)
+        for duration in range(100):
+            collector(event(duration=duration))
+
+        stats = collector.stats()[('UserDocument', 'find_one')]
+        self.assertEqual((stats['p50'], stats['count']), (95, 100))
+
+    def test_prometheus(self):
+        text = self.collector.prometheus()
+
+        self.assertTrue(text.startswith(
+            '# HELP picomongo_operation_seconds'))
+        self.assertTrue('picomongo_operation_seconds{document="UserDocument",'
+                        'operation="find_one",quantile="0.99"} 0.1\n' in text)
+        self.assertTrue('picomongo_operation_seconds_count{document='
+                        '"UserDocument",operation="find_one"} 100\n' in text)
+        self.assertTrue('picomongo_operation_seconds_errors_total{document='
+                        '"UserDocument",operation="save"} 1\n' in text)
+
+    def test_reset(self):
+        self.collector.reset()
+        self.assertEqual(self.collector.stats(), {})
+
+class StatsdListenerTestCase(unittest.TestCase):
+
+    @patch('picomongo.monitoring.socket.socket')
+    def test_send(self, mock_socket):
+        listener = StatsdListener('statsd', 8125)
+        listener(event(duration=0.0125))
+        listener(event('save', 0.5, ValueError()))
+
+        sendto = mock_socket.return_value.sendto
+        self.assertEqual(sendto.call_args_list[0][0],
+                         ('picomongo.UserDocument.find_one:12.500|ms',
+                          ('statsd', 8125)))
+        self.assertEqual(sendto.call_args_list[1][0][0],
+                         'picomongo.UserDocument.save:500.000|ms\n'
+                         'picomongo.UserDocument.save.errors:1|c')
@@ -0,0 +1,61 @@
+import unittest
+
+from picomongo import Document
+from picomongo.operators import apply_update, can_apply, depends_on_values
+
+class OperatorsTestCase(unittest.TestCase):
+
+    def test_inc(self):
+        document = {'a': 1, 'nested': {}}
+
+        apply_update(document, {'$inc': {'a': 2, 'b': 1, 'nested.c': 3}})
+
+        self.assertEqual(document, {'a': 3, 'b': 1, 'nested': {'c': 3}})
+
+    def test_set(self):
+        document = {'list': [{'a': 1}]}
+
+        apply_update(document, {'$set': {'list.0.a': 2, 'new.b': 1}})
+
+        self.assertEqual(document, {'list': [{'a': 2}], 'new': {'b': 1}})
+
+    def test_arrays(self):
+        document = {'a': [1, 2]}
+
+        apply_update(document, {'$push': {'a': 3, 'b': 1}})
+        apply_update(document, {'$addToSet': {'a': {'$each': [1, 4]}}})
+        apply_update(document, {'$pull': {'a': 2}})
+
+        self.assertEqual(document, {'a': [1, 3, 4], 'b': [1]})
+
+    def test_min_max(self):
+        document = {'a': 5, 'b': 5, 'd': 5}
+
+        apply_update(document, {'$min': {'a': 3, 'b': 7, 'c': 1},
+                                '$max': {'d': 4, 'e': 1}})
+        self.assertEqual(document, {'a': 3, 'b': 5, 'c': 1, 'd': 5, 'e': 1})
+
+        apply_update(document, {'$max': {'d': 6}})
+        self.assertEqual(document['d'], 6)
+
+    def test_document_changes(self):
+        document = Document._load({'a': 1})
+
+        apply_update(document, {'$inc': {'a': 1}})
+
+        self.assertEqual(document, {'a': 2})
+        self.assertEqual(document._changes, {})
+
+    def test_can_apply(self):
+        self.assertTrue(can_apply({'$inc': {'a': 1}, '$set': {'b': 1}}))
+        self.assertTrue(can_apply({'$push': {'a': {'$each': [1]}}}))
+        self.assertFalse(can_apply({'$rename': {'a': 'b'}}))
+        self.assertFalse(can_apply({'$pull': {'a': {'$gt': 1}}}))
+        self.assertFalse(can_apply({'$push': {'a': {'$each': [1],
+                                                    '$slice': -5}}}))
+
+    def test_depends_on_values(self):
+        self.assertFalse(depends_on_values({'$set': {'a': 1}}))
+        self.assertTrue(depends_on_values({'$set': {'a': 1},
+                                           '$inc': {'b': 1}}))
+        self.assertTrue(depends_on_values({'$push': {'a': 1}}))
@@ -0,0 +1,58 @@
+import unittest
+
+import pymongo
+
+from picomongo.pagination import decode_token, encode_token, is_covered, \
+    seek_spec, sort_spec
+
+ASC, DESC = pymongo.ASCENDING, pymongo.DESCENDING
+
+class PaginationTestCase(unittest.TestCase):
+
+    def test_sort_spec(self):
+        self.assertEqual(sort_spec(['-date']), [('date', DESC), ('_id', DESC)])
+        self.assertEqual(sort_spec([('a', ASC), 'b']),
+                         [('a', ASC), ('b', ASC), ('_id', ASC)])
+        self.assertEqual(sort_spec(['-_id']), [('_id', DESC)])
+
+    def test_token(self):
+        keys = sort_spec(['-date', 'user.name'])
+        document = {'_id': 1, 'date': 2, 'user': {'name': 'FELD'}}
+
+        token = encode_token(keys, document)
+
+        self.assertEqual(decode_token(keys, token), [2, 'FELD', 1])
+        self.assertRaises(ValueError, decode_token, sort_spec(['date']), token)
+        self.assertRaises(ValueError, decode_token, keys, 'invalid')
+
+    def test_seek_spec(self):
+        keys = [('date', DESC), ('_id', DESC)]
+
+        self.assertEqual(seek_spec(keys, [2, 1]),
+                         {'$or': [{'date': {'$lt': 2}}, {'date': None},
+                                  {'date': 2, '_id': {'$lt': 1}}]})
+        self.assertEqual(seek_spec([('_id', ASC)], [1]), {'_id': {'$gt': 1}})
+
+    def test_seek_spec_null(self):
+        self.assertEqual(seek_spec([('date', DESC), ('_id', DESC)], [None, 1]),
+                         {'date': None, '_id': {'$lt': 1}})
+        self.assertEqual(seek_spec([('date', ASC), ('_id', ASC)], [None, 1]),
+                         {'$or': [{'date': {'$ne': None}},
+                                  {'date': None, '_id': {'$gt': 1}}]})
+
+    def test_is_covered(self):
+        indexes = [{'fields': ('kind', '-date', '-_id')},
+                   {'fields': ('name', '_id'), 'unique': True}]
+
+        self.assertTrue(is_covered(sort_spec(['-_id']), None, []))
+        self.assertTrue(is_covered(sort_spec(['name']), None, indexes))
+        self.assertTrue(is_covered(sort_spec(['-name']), None, indexes))
+        self.assertTrue(is_covered(sort_spec(['-date']), {'kind': 'a'},
+                                   indexes))
+        self.assertFalse(is_covered(sort_spec(['-date']), None, indexes))
+        self.assertFalse(is_covered(sort_spec(['-date']),
+                                    {'kind': {'$in': ['a', 'b']}}, indexes))
+        self.assertTrue(is_covered(sort_spec(['date']), {'kind': 'a'},
+                                   indexes))
+        self.assertFalse(is_covered(sort_spec(['-date', '_id']),
+                                    {'kind': 'a'}, indexes))
@@ -0,0 +1,133 @@
+import unittest
+
+from mock import patch
+
+from picomongo import Document, ConnectionManager
+from picomongo.session import Session, current_session
+
+class UserDocument(Document):
+    pass
+
+class EventDocument(Document):
+    pass
+
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure()
+        UserDocument.col.insert({'name': 'FELD', 'views': 1})
+
+    def tearDown(self):
+        UserDocument.col.remove()
+        EventDocument.col.remove()
+
+    def test_current_session(self):
+        self.assertEqual(current_session(), None)
+        with Session() as session:
+            self.assertTrue(current_session() is session)
+            with Session() as inner:
+                self.assertTrue(current_session() is inner)
+            self.assertTrue(current_session() is session)
+        self.assertEqual(current_session(), None)
+
+    def test_commit(self):
+        with Session():
+            user = UserDocument.find_one()
+            user.views += 1
+            user.save()
+            user.name = 'SMITH'
+            user.save()
+            event = EventDocument({'type': 'view'})
+            event.save()
+            other = UserDocument({'name': 'DOE'})
+            other.save()
+
+            self.assertEqual(UserDocument.col.count(), 1)
+            self.assertEqual(EventDocument.col.count(), 0)
+
+        self.assertEqual(UserDocument.col.find_one({'_id': user._id}),
+                         {'_id': user._id, 'name': 'SMITH', 'views': 2})
+        self.assertEqual(UserDocument.col.find_one({'_id': other._id}), other)
+        self.assertEqual(EventDocument.col.find_one(), event)
+        self.assertEqual(user._changes, {})
+
+    def test_loaded_not_saved(self):
+        with Session() as session:
+            user = UserDocument.find_one()
+            user.views = 10
+            self.assertEqual(session._documents, {})
+
+        self.assertEqual(UserDocument.col.find_one()['views'], 1)
+
+    def test_read_keep_concurrent_update(self):
+        UserDocument.col.update({}, {'$set': {'tags': []}})
+
+        with Session():
+            user = UserDocument.find_one()
+            user.tags
+            UserDocument.col.update({}, {'$push': {'tags': 'other'}})
+
+        self.assertEqual(UserDocument.col.find_one()['tags'], ['other'])
+
+    def test_created_not_saved(self):
+        with Session() as session:
+            EventDocument({'type': 'view'})
+            self.assertEqual(session._documents, {})
+
+        self.assertEqual(EventDocument.col.count(), 0)
+
+    def test_add(self):
+        with Session() as session:
+            event = EventDocument({'type': 'view'})
+            session.add(event)
+
+        self.assertEqual(EventDocument.col.find_one(), event)
+
+    def test_delete(self):
+        with Session():
+            user = UserDocument.find_one()
+            user.views = 10
+            user.delete()
+            self.assertEqual(UserDocument.col.count(), 1)
+
+        self.assertEqual(UserDocument.col.count(), 0)
+
+    def test_discard(self):
+        try:
+            with Session():
+                user = UserDocument.find_one()
+                user.views = 10
+                EventDocument({'type': 'view'}).save()
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(UserDocument.col.find_one()['views'], 1)
+        self.assertEqual(EventDocument.col.count(), 0)
+
+    def test_bulk_per_collection(self):
+        with patch.object(UserDocument, 'col') as mock_col:
+            with Session():
+                for name in ('A', 'B', 'C'):
+                    UserDocument({'name': name}).save()
+                user = UserDocument._load({'_id': 1, 'name': 'D'})
+                user.name = 'E'
+                user.save()
+                UserDocument._load({'_id': 2}).delete()
+                UserDocument._load({'_id': 3})
+
+        bulk = mock_col.initialize_unordered_bulk_op.return_value
+        self.assertEqual(mock_col.initialize_unordered_bulk_op.call_count, 1)
+        self.assertEqual(bulk.insert.call_count, 3)
+        self.assertEqual(bulk.find.call_args_list[-2:],
+                         [(({'_id': 1},), {}),
+                          (({'_id': {'$in': [2]}},), {})])
+        self.assertEqual(bulk.execute.call_count, 1)
+
+    def test_commit_count(self):
+        session = Session()
+        with session:
+            UserDocument.find_one().views = 2
+            EventDocument({'type': 'view'}).save()
+
+        self.assertEqual(session.commit(), 0)
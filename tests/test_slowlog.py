@@ -0,0 +1,180 @@
+import unittest
+
+from mock import Mock, patch
+
+from picomongo import Document, ConnectionManager
+from picomongo.monitoring import OperationEvent
+from picomongo.slowlog import SlowLog, declared_index, explain_summary, \
+    query_fields, query_shape
+
+class UserDocument(Document):
+    indexes = [{'fields': ('email',)}, {'fields': ('-date', 'name')}]
+
+def event(spec, duration=0.2, sort=None, error=None):
+    return OperationEvent(UserDocument, 'userdocument', 'test.userdocument',
+                          'find', duration, 1, None, error,
+                          {'spec': spec, 'sort': sort, 'fields': None})
+
+class SlowLogFunctionsTestCase(unittest.TestCase):
+
+    def test_query_shape(self):
+        self.assertEqual(query_shape({'name': 'A', 'age': {'$gt': 18}}),
+                         query_shape({'age': {'$gt': 30}, 'name': 'B'}))
+        self.assertNotEqual(query_shape({'age': {'$gt': 18}}),
+                            query_shape({'age': {'$lt': 18}}))
+        self.assertEqual(query_shape({'$or': [{'a': 1}, {'b': 2}]}),
+                         (('$or', ((('a', 1),), (('b', 1),))),))
+        self.assertEqual(query_shape(None), 1)
+
+    def test_query_fields(self):
+        self.assertEqual(sorted(query_fields({'a': 1, '$or': [{'b': 1},
+                                                              {'a': 2}],
+                                              '$where': 'true'})),
+                         ['a', 'b'])
+        self.assertEqual(query_fields(None), [])
+
+    def test_explain_summary(self):
+        self.assertEqual(explain_summary({'cursor': 'BasicCursor',
+                                          'nscanned': 100,
+                                          'nscannedObjects': 100, 'n': 2}),
+                         {'collscan': True, 'index': None,
+                          'keys_examined': 100, 'docs_examined': 100,
+                          'returned': 2})
+        self.assertEqual(explain_summary({'cursor': 'BtreeCursor email_1',
+                                          'nscanned': 2,
+                                          'nscannedObjects': 2, 'n': 2}
+                                         )['index'], 'email_1')
+
+        summary = explain_summary({
+            'queryPlanner': {'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'date_-1'}}},
+            'executionStats': {'totalKeysExamined': 5,
+                               'totalDocsExamined': 5, 'nReturned': 5}})
+        self.assertEqual(summary, {'collscan': False, 'index': 'date_-1',
+                                   'keys_examined': 5, 'docs_examined': 5,
+                                   'returned': 5})
+        self.assertTrue(explain_summary({'queryPlanner': {'winningPlan': {
+            'stage': 'SORT', 'inputStages': [{'stage': 'COLLSCAN'}]}}}
+                                        )['collscan'])
+
+    def test_declared_index(self):
+        indexes = UserDocument.indexes
+        self.assertEqual(declared_index(indexes, {'email': 'a@b.c'}, None),
+                         ('email',))
+        self.assertEqual(declared_index(indexes, {}, [('date', -1)]),
+                         ('-date', 'name'))
+        self.assertEqual(declared_index(indexes, {'name': 'A'}, None), None)
+
+class SlowLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.slow_log = SlowLog(slow_ms=100, explain=True,
+                                explain_interval=0)
+        self.col = Mock()
+        self.col.find.return_value.explain.return_value = {
+            'cursor': 'BasicCursor', 'nscanned': 100,
+            'nscannedObjects': 100, 'n': 1}
+        self.patcher = patch.object(UserDocument, 'col', self.col)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @patch('picomongo.slowlog.logger')
+    def test_fast(self, logger):
+        self.slow_log(event({'name': 'A'}, duration=0.05))
+        self.slow_log(event({'name': 'A'}, error=ValueError()))
+
+        self.assertEqual(logger.warning.call_count, 0)
+        self.assertEqual(self.col.find.call_count, 0)
+
+    @patch('picomongo.slowlog.logger')
+    def test_slow(self, logger):
+        self.slow_log(event({'name': 'A'}, sort=[('date', -1)]))
+
+        self.assertEqual(logger.warning.call_count, 2)
+        self.col.find.assert_called_once_with({'name': 'A'}, None)
+        self.col.find.return_value.sort.assert_called_once_with([('date', -1)])
+
+        (key, summary), = self.slow_log.shapes()
+        self.assertEqual(key, ('test.userdocument', (('name', 1),),
+                               (('date', -1),)))
+        self.assertTrue(summary['collscan'])
+        self.assertEqual(summary['declared_index'], ('-date', 'name'))
+
+    @patch('picomongo.slowlog.logger')
+    def test_explain_once_per_shape(self, logger):
+        self.slow_log(event({'name': 'A'}))
+        self.slow_log(event({'name': 'B'}))
+        self.slow_log(event({'email': 'a@b.c'}))
+
+        self.assertEqual(self.col.find.call_count, 2)
+        self.assertEqual(len(self.slow_log.shapes()), 2)
+
+    @patch('picomongo.slowlog.logger')
+    def test_explain_interval(self, logger):
+        self.slow_log.explain_interval = 60
+        self.slow_log(event({'name': 'A'}))
+        self.slow_log(event({'email': 'a@b.c'}))
+
+        self.assertEqual(self.col.find.call_count, 1)
+
+    @patch('picomongo.slowlog.logger')
+    def test_max_shapes(self, logger):
+        self.slow_log.max_shapes = 1
+        self.slow_log(event({'name': 'A'}))
+        self.slow_log(event({'email': 'a@b.c'}))
+        self.slow_log(event({'name': 'A'}))
+
+        self.assertEqual(self.col.find.call_count, 3)
+
+    @patch('picomongo.slowlog.logger')
+    def test_explain_error(self, logger):
+        self.col.find.return_value.explain.side_effect = ValueError()
+        self.slow_log(event({'name': 'A'}))
+
+        self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(self.slow_log.shapes(), [])
+
+class DocumentSlowLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ConnectionManager.configure({'userdocument': {'slow_log':
+                                                      {'slow_ms': 0}}})
+        UserDocument.col.insert({'name': 'FELD'})
+
+    def tearDown(self):
+        UserDocument.col.remove()
+        ConnectionManager.configure()
+
+    def test_no_slow_log(self):
+        ConnectionManager.configure()
+        self.assertEqual(UserDocument._slow_log, None)
+
+    def test_no_slow_log_lookup(self):
+        ConnectionManager.configure()
+        with patch('picomongo.utils.SlowLogDescriptor.__get__') as mock_get:
+            UserDocument.find_one({'name': 'FELD'})
+            list(UserDocument.find({'name': 'FELD'}))
+
+        self.assertEqual(mock_get.call_count, 0)
+
+    @patch('picomongo.slowlog.logger')
+    def test_find_one(self, logger):
+        UserDocument.find_one({'name': 'FELD'}, sort=[('name', 1)])
+
+        message = logger.warning.call_args[0]
+        self.assertEqual(message[1:3], ('find_one', 'UserDocument'))
+        self.assertEqual(message[5:], ({'name': 'FELD'}, [('name', 1)], None))
+
+    @patch('picomongo.slowlog.logger')
+    def test_find_one_by_id(self, logger):
+        UserDocument.find_one(1)
+        self.assertEqual(logger.warning.call_args[0][5], {'_id': 1})
+
+    @patch('picomongo.slowlog.logger')
+    def test_find(self, logger):
+        self.assertEqual(len(list(UserDocument.find({'name': 'FELD'}))), 1)
+        self.assertEqual(logger.warning.call_args[0][1:3],
+                         ('find', 'UserDocument'))
@@ -0,0 +1,130 @@
+import threading
+import time
+import unittest
+
+from mock import Mock
+
+from pymongo.errors import InvalidOperation
+
+from picomongo.writebehind import WriteBehindBuffer
+from utils import Call
+
+class WriteBehindBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.col = Mock()
+        self.col.full_name = 'test.writebehind'
+        self.bulk = self.col.initialize_unordered_bulk_op.return_value
+        self.buffer = WriteBehindBuffer(self.col, batch_size=2, max_delay=60)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_flush(self):
+        self.buffer.replace(1, {'_id': 1, 'a': 1})
+        self.buffer.update(2, {'$set': {'a': 1}})
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(self.bulk.find.call_args_list,
+                         [Call({'_id': 1}), Call({'_id': 2})])
+        finder = self.bulk.find.return_value
+        self.assertEqual(finder.upsert.return_value.replace_one.call_args_list,
+                         [Call({'_id': 1, 'a': 1})])
+        self.assertEqual(finder.update_one.call_args_list,
+                         [Call({'$set': {'a': 1}})])
+        self.assertEqual(self.bulk.execute.call_args_list, [Call(None)])
+
+    def test_coalesce_updates(self):
+        self.buffer.update(1, {'$set': {'a': 1, 'b': 1}})
+        self.buffer.update(1, {'$set': {'a': 2}, '$unset': {'b': 1}})
+        self.buffer.update(1, {'$unset': {'c': 1}})
+        self.buffer.flush()
+
+        finder = self.bulk.find.return_value
+        self.assertEqual(finder.update_one.call_args_list,
+                         [Call({'$set': {'a': 2}, '$unset': {'b': 1, 'c': 1}})])
+        self.assertEqual(self.buffer.stats()['coalesced'], 2)
+
+    def test_coalesce_replace(self):
+        self.buffer.update(1, {'$set': {'a': 1}})
+        self.buffer.replace(1, {'_id': 1, 'a': 2, 'b': 2})
+        self.buffer.update(1, {'$set': {'a': 3}, '$unset': {'b': 1}})
+        self.buffer.flush()
+
+        self.assertEqual(self.bulk.find.call_count, 1)
+        replace_one = self.bulk.find.return_value.upsert.return_value.replace_one
+        self.assertEqual(replace_one.call_args_list, [Call({'_id': 1, 'a': 3})])
+
+    def test_flush_on_size(self):
+        self.buffer.replace(1, {'_id': 1})
+        self.buffer.replace(2, {'_id': 2})
+
+        for _ in xrange(100):
+            if self.bulk.execute.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.bulk.find.call_count, 2)
+
+    def test_flush_on_delay(self):
+        self.buffer.max_delay = 0.01
+        self.buffer.replace(1, {'_id': 1})
+
+        for _ in xrange(100):
+            if self.bulk.execute.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.buffer.stats()['writes'], 1)
+
+    def test_backpressure(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def execute(write_concern):
+            sending.set()
+            release.wait()
+        self.bulk.execute.side_effect = execute
+        self.buffer.max_pending = 2
+
+        self.buffer.replace(1, {'_id': 1})
+        self.buffer.replace(2, {'_id': 2})
+        sending.wait()
+        self.buffer.replace(3, {'_id': 3})
+        self.buffer.replace(4, {'_id': 4})
+
+        writer = threading.Thread(target=self.buffer.replace,
+                                  args=(5, {'_id': 5}))
+        writer.start()
+        time.sleep(0.05)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(self.buffer.stats()['waits'], 1)
+
+        release.set()
+        writer.join()
+        self.buffer.flush()
+        self.assertEqual(self.buffer.stats()['writes'], 5)
+
+    def test_discard(self):
+        self.buffer.replace(1, {'_id': 1})
+        self.buffer.discard(1)
+
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertFalse(self.bulk.execute.called)
+
+    def test_errors(self):
+        self.bulk.execute.side_effect = Exception('Failed')
+
+        self.buffer.replace(1, {'_id': 1})
+
+        self.assertEqual(self.buffer.flush(), 0)
+        stats = self.buffer.stats()
+        self.assertEqual((stats['errors'], stats['writes'], stats['pending']),
+                         (1, 0, 0))
+
+    def test_close(self):
+        self.buffer.replace(1, {'_id': 1})
+        self.buffer.close()
+
+        self.assertEqual(self.buffer.stats()['writes'], 1)
+        self.assertRaises(InvalidOperation, self.buffer.replace, 2, {'_id': 2})